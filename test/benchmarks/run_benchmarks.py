@@ -0,0 +1,207 @@
+"""
+Benchmarks of the strain methods on synthetic velocity fields of increasing size.
+Each stage (the model's own steps, the derived-quantity pass, and the comparison statistics) is timed with the
+pipeline's instrumentation, and the accuracy against the analytic strain rates is recorded.
+Results are checked against stored baselines, so slowdowns are caught.
+
+USAGE (from the top of the repository):
+    python -m test.benchmarks.run_benchmarks                      # compare to test/benchmarks/baselines.json
+    python -m test.benchmarks.run_benchmarks --sizes 100,1000,10000,100000 --inc 0.02
+    python -m test.benchmarks.run_benchmarks --save-baseline      # record new baselines on this machine
+Methods that call external programs (gpsgridder: gmt; visr: its fortran executable) run only if those exist.
+"""
+
+import argparse
+import importlib
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import numpy as np
+from tools.strain import configure_functions, instrumentation, strain_tensor_toolbox, compare_strain_grids
+from . import synthetic_fields
+
+BASELINE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baselines.json');
+MODELS = {'delaunay': {},
+          'delaunay_flat': {},
+          'huang': {'estimateradiuskm': '80', 'nstations': '8'},
+          'gpsgridder': {'poisson': '0.5', 'fd': '0.01', 'eigenvalue': '0.0005'},
+          'visr': {'distance_weighting': 'gaussian', 'spatial_weighting': 'voronoi', 'min_max_inc_smooth': '1/100/1',
+                   'executable': os.environ.get('VISR_EXECUTABLE', 'contrib/visr/visr.exe')}};
+MIN_REGRESSION_SECONDS = 0.005;  # ignore differences below the timer noise
+
+
+def model_available(name):
+    if name == 'gpsgridder':
+        return shutil.which('gmt') is not None;
+    if name == 'visr':
+        return os.path.isfile(MODELS['visr']['executable']);
+    return True;
+
+
+def benchmark_params(name, box, inc, outdir):
+    return configure_functions.Params(strain_method=name, input_file='synthetic', range_strain=box, range_data=box,
+                                      inc=[inc, inc], outdir=outdir, method_specific=dict(MODELS[name]));
+
+
+def run_model(name, myVelfield, box, inc, repeat):
+    """
+    Time one model on one velocity field. Returns [stage times (best of repeat, s), result grids].
+    """
+    model_class = getattr(importlib.import_module('tools.strain.models.strain_' + name), name);
+    options = configure_functions.get_report_options();
+    best, result = {}, None;
+    cwd = os.getcwd();
+    for _ in range(repeat):
+        with tempfile.TemporaryDirectory() as outdir:
+            os.chdir(outdir);  # the external programs write their files into the working directory
+            try:
+                with instrumentation.run_report(outdir, options, name) as report:
+                    model = model_class(benchmark_params(name, box, inc, outdir + '/'));
+                    with instrumentation.stage('compute'):
+                        result = model.compute(myVelfield);
+                    with instrumentation.stage('derived_quantities'):
+                        strain_tensor_toolbox.derived_quantities_kernel(result[3], result[4], result[5]);
+            finally:
+                os.chdir(cwd);
+        for record in report.stages:
+            best[record['stage']] = min(best.get(record['stage'], np.inf), record['wall_s']);
+    return best, result;
+
+
+def strain_error(field, result, box):
+    # Median absolute error (nanostrain/yr) of exx, exy, eyy in the interior of the box (15% margins)
+    [lons, lats, _, exx, exy, eyy] = result;
+    lon, lat = np.meshgrid(lons, lats);
+    x, y = synthetic_fields.local_coordinates(lon, lat, box);
+    expected = synthetic_fields.expected_strain(field, x, y);
+    margin_x, margin_y = 0.15 * (box[1] - box[0]), 0.15 * (box[3] - box[2]);
+    interior = ((lon > box[0] + margin_x) & (lon < box[1] - margin_x) &
+                (lat > box[2] + margin_y) & (lat < box[3] - margin_y));
+    errors = [np.nanmedian(np.abs(np.asarray(value)[interior] - target[interior]))
+              for value, target in zip([exx, exy, eyy], expected)];
+    return float(np.max(errors));
+
+
+def run_comparison(results, box, inc, repeat):
+    # Time the comparison statistics over every model's result, as in an ensemble run
+    CompParams = configure_functions.Comps_Params(range_strain=box, inc=[inc, inc],
+                                                  strain_dict={name: '' for name in results.keys()}, outdir='');
+    options = configure_functions.get_report_options();
+    best = np.inf;
+    for _ in range(repeat):
+        with tempfile.TemporaryDirectory() as outdir:
+            with instrumentation.run_report(outdir, options, 'comparison') as report:
+                with instrumentation.stage('comparison'):
+                    all_values = compare_strain_grids.strain_results_to_values(results);
+                    compare_strain_grids.regrid_all(CompParams, all_values, 'bilinear');
+                    compare_strain_grids.compare_all(CompParams, all_values);
+        best = min(best, report.stages[-1]['wall_s']);
+    return {'comparison': best};
+
+
+def run_benchmarks(sizes, fields, models, inc, repeat, box=synthetic_fields.DEFAULT_BOX):
+    """
+    Returns {'model/field/nstations': {'stages': {stage: seconds}, 'error': nanostrain/yr}}, plus
+    'comparison/field/nstations' entries for the comparison statistics across the models.
+    """
+    results = {};
+    for name in models:
+        if not model_available(name):
+            print("Skipping %s: its external program was not found" % name);
+    models = [name for name in models if model_available(name)];
+    for nstations in sizes:
+        for field in fields:
+            myVelfield = synthetic_fields.synthetic_velfield(field, nstations, box);
+            model_results = {};
+            for name in models:
+                stages, model_results[name] = run_model(name, myVelfield, box, inc, repeat);
+                key = "%s/%s/%d" % (name, field, nstations);
+                results[key] = {'stages': stages, 'error': strain_error(field, model_results[name], box)};
+            if len(model_results) > 1:
+                results["comparison/%s/%d" % (field, nstations)] = {'stages': run_comparison(model_results, box,
+                                                                                             inc, repeat)};
+    return results;
+
+
+def print_results(results):
+    for key in results.keys():
+        for stage, seconds in results[key]['stages'].items():
+            print("%-32s %-32s %10.4f s" % (key, stage, seconds));
+        if 'error' in results[key]:
+            print("%-32s %-32s %10.3f nanostrain/yr" % (key, 'median error', results[key]['error']));
+    return;
+
+
+def find_regressions(results, baseline, tolerance=1.5):
+    """
+    Stages that got slower than tolerance times their baseline (and by more than the timer noise),
+    and results that got less accurate than tolerance times their baseline error (plus 0.5 nanostrain/yr).
+    """
+    regressions = [];
+    for key in results.keys():
+        if key not in baseline:
+            continue;
+        for stage, seconds in results[key]['stages'].items():
+            base = baseline[key]['stages'].get(stage);
+            if base is not None and seconds > tolerance * base and seconds - base > MIN_REGRESSION_SECONDS:
+                regressions.append("%s %s: %.4f s, baseline %.4f s" % (key, stage, seconds, base));
+        if 'error' in results[key] and 'error' in baseline[key]:
+            if results[key]['error'] > tolerance * baseline[key]['error'] + 0.5:
+                regressions.append("%s accuracy: %.3f, baseline %.3f nanostrain/yr" % (key, results[key]['error'],
+                                                                                      baseline[key]['error']));
+    return regressions;
+
+
+def machine_description():
+    return {'python': sys.version.split()[0], 'numpy': np.__version__, 'platform': platform.platform(),
+            'processor': platform.processor(), 'cpus': os.cpu_count()};
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the strain methods on synthetic velocity fields.");
+    parser.add_argument('--sizes', default='100,1000,10000', help="numbers of stations, comma-separated");
+    parser.add_argument('--fields', default=','.join(synthetic_fields.FIELDS), help="synthetic fields");
+    parser.add_argument('--models', default=','.join(MODELS.keys()), help="strain methods");
+    parser.add_argument('--inc', type=float, default=0.04, help="grid increment, degrees");
+    parser.add_argument('--repeat', type=int, default=3, help="runs per benchmark; the fastest is kept");
+    parser.add_argument('--baseline', default=BASELINE_FILE, help="baseline file");
+    parser.add_argument('--save-baseline', action='store_true', help="store these results as the baseline");
+    parser.add_argument('--tolerance', type=float, default=1.5, help="slowdown factor reported as a regression");
+    parser.add_argument('--output', default=None, help="also write the results to this json file");
+    args = parser.parse_args(argv);
+
+    sizes = [int(float(x)) for x in args.sizes.split(',')];
+    results = run_benchmarks(sizes, args.fields.split(','), args.models.split(','), args.inc, args.repeat);
+    print_results(results);
+    settings = {'sizes': sizes, 'inc': args.inc, 'repeat': args.repeat, 'box': synthetic_fields.DEFAULT_BOX};
+    if args.output:
+        with open(args.output, 'w') as ofile:
+            json.dump({'machine': machine_description(), 'settings': settings, 'results': results}, ofile, indent=2);
+    if args.save_baseline:
+        baseline = {};
+        if os.path.isfile(args.baseline):
+            with open(args.baseline) as ifile:
+                baseline = json.load(ifile)['results'];
+        baseline.update(results);
+        with open(args.baseline, 'w') as ofile:
+            json.dump({'machine': machine_description(), 'settings': settings, 'results': baseline}, ofile,
+                      indent=2);
+        print("Saved baseline to %s" % args.baseline);
+        return 0;
+    if not os.path.isfile(args.baseline):
+        print("No baseline at %s; run with --save-baseline to create one." % args.baseline);
+        return 0;
+    with open(args.baseline) as ifile:
+        baseline = json.load(ifile)['results'];
+    regressions = find_regressions(results, baseline, args.tolerance);
+    for line in regressions:
+        print("REGRESSION: " + line);
+    print("%d regressions against %s" % (len(regressions), args.baseline));
+    return 1 if regressions else 0;
+
+
+if __name__ == "__main__":
+    sys.exit(main());
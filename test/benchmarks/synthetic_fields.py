@@ -0,0 +1,69 @@
+# Synthetic velocity fields from analytic deformation, for benchmarks and accuracy checks.
+# Stations are scattered uniformly over a lon/lat box; velocities (mm/yr) are evaluated on a transverse Mercator
+# plane centered on the box, so the expected strain rates are known exactly on that plane.
+
+import numpy as np
+from tools.strain import velocity_io, projection
+
+DEFAULT_BOX = [-122.0, -118.0, 34.0, 38.0];
+FIELDS = ['uniform', 'rotation', 'screw'];
+
+
+def station_positions(nstations, box=DEFAULT_BOX, seed=0):
+    rng = np.random.default_rng(seed);
+    elon = rng.uniform(box[0], box[1], nstations);
+    nlat = rng.uniform(box[2], box[3], nstations);
+    return elon, nlat;
+
+
+def local_coordinates(elon, nlat, box=DEFAULT_BOX):
+    # meters east and north of the center of the box
+    proj = projection.Projection('tmerc', lon0=0.5 * (box[0] + box[1]), lat0=0.5 * (box[2] + box[3]));
+    return proj.forward(elon, nlat);
+
+
+def uniform_strain(x, y, exx=20.0, exy=5.0, eyy=-10.0):
+    # Strain rates in nanostrain/yr; with x, y in m, 1e-9/yr * m = 1e-6 mm/yr
+    return 1e-6 * (exx * x + exy * y), 1e-6 * (exy * x + eyy * y);
+
+
+def rigid_rotation(x, y, omega=30.0):
+    # Rotation about the center of the box, omega in nanoradians/yr
+    return -1e-6 * omega * y, 1e-6 * omega * x;
+
+
+def screw_dislocation(x, y, slip=30.0, locking_depth_km=15.0):
+    # Interseismic velocity of a north-striking strike-slip fault through the center (Savage and Burford, 1973)
+    return np.zeros(np.shape(x)), slip / np.pi * np.arctan(x / (locking_depth_km * 1000));
+
+
+def expected_strain(field, x, y):
+    """ Analytic exx, exy, eyy (nanostrain/yr) of a field at local coordinates x, y """
+    if field == 'uniform':
+        return 20.0 * np.ones(np.shape(x)), 5.0 * np.ones(np.shape(x)), -10.0 * np.ones(np.shape(x));
+    if field == 'rotation':
+        return np.zeros(np.shape(x)), np.zeros(np.shape(x)), np.zeros(np.shape(x));
+    D = 15.0 * 1000;
+    dvdx = 30.0 / np.pi * D / (x * x + D * D) * 1e6;  # mm/yr per m -> nanostrain/yr
+    return np.zeros(np.shape(x)), 0.5 * dvdx, np.zeros(np.shape(x));
+
+
+def synthetic_velfield(field, nstations, box=DEFAULT_BOX, noise=0.0, seed=0):
+    """
+    A VelocityField of nstations stations with the velocities of one analytic field:
+    'uniform' (uniform strain), 'rotation' (rigid rotation), or 'screw' (screw dislocation).
+    noise: standard deviation (mm/yr) of gaussian noise added to the velocities; uncertainties are 1 mm/yr.
+    """
+    if field not in FIELDS:
+        raise ValueError("Error! Synthetic field %s not supported. Choose from %s" % (field, FIELDS));
+    elon, nlat = station_positions(nstations, box, seed);
+    x, y = local_coordinates(elon, nlat, box);
+    function = {'uniform': uniform_strain, 'rotation': rigid_rotation, 'screw': screw_dislocation}[field];
+    e, n = function(x, y);
+    if noise > 0:
+        rng = np.random.default_rng(seed + 1);
+        e, n = e + rng.normal(0, noise, nstations), n + rng.normal(0, noise, nstations);
+    ones = np.ones(nstations);
+    names = np.char.add('S', np.arange(nstations).astype(str));
+    return velocity_io.VelocityField(elon=elon, nlat=nlat, e=e, n=n, u=np.zeros(nstations), se=ones, sn=ones, su=ones,
+                                     name=names);
@@ -1,7 +1,19 @@
+import json
+import numpy as np
+import os
+import subprocess
+import sys
+import tempfile
 import unittest
-from tools.strain import strain_tensor_toolbox, configure_functions, compare_grd_functions, velocity_io
-from tools.strain.models import strain_delaunay_flat, strain_delaunay
+import warnings
+from tools.strain import strain_tensor_toolbox, configure_functions, compare_grd_functions, velocity_io, triangulation
+from tools.strain import produce_gridded, projection, output_manager, compare_strain_grids, streaming_comparison
+from tools.strain import regrid, validation, result_cache, instrumentation, api
+from tools.strain.models import strain_delaunay_flat, strain_delaunay, strain_huang
+from test.benchmarks import run_benchmarks, synthetic_fields
 
+STARTUP_BUDGET_S = 0.3;  # importing the driver's modules, best of three fresh interpreters
+HEAVY_MODULES = ['pygmt', 'xarray', 'pandas', 'scipy', 'netCDF4', 'Tectonic_Utils', 'matplotlib'];
 
 class Tests(unittest.TestCase):
 
@@ -47,6 +59,188 @@ class Tests(unittest.TestCase):
         self.assertLess(abs(rot1[0]-rot2[0]), abs(rot1[0]*0.05));  # less than 5% difference
         return;
 
+    def test_delaunay_sphere_batch(self):
+        # The batched spherical solver should reproduce Bill's scalar code, triangle by triangle.
+        phi = np.array([[-123, -123, -123.5], [-122, -121.5, -121.8]]);
+        theta = np.array([[-50, -49.75, -49.5], [-51, -51.2, -50.6]]);
+        u_phi = np.array([[0.023, 0.025, 0.027], [0.010, 0.012, 0.009]]);
+        u_theta = np.array([[0.013, 0.011, 0.011], [0.002, 0.004, 0.001]]);
+        s_phi = np.array([[0.002, 0.002, 0.002], [0.001, 0.003, 0.002]]);
+        s_theta = np.array([[0.002, 0.002, 0.002], [0.002, 0.001, 0.004]]);
+        batch = strain_delaunay.strain_sphere_batch(phi, theta, u_phi, u_theta, s_phi, s_theta);
+        for i in range(2):
+            scalar = strain_delaunay.strain_sphere(phi[i], theta[i], u_phi[i], u_theta[i], s_phi[i], s_theta[i], 1, 0);
+            np.testing.assert_allclose(batch[0][i], scalar[0], rtol=1e-8);  # e_phiphi
+            np.testing.assert_allclose(batch[1][i], scalar[1], rtol=1e-8);  # e_thetaphi
+            np.testing.assert_allclose(batch[2][i], scalar[2], rtol=1e-8);  # e_thetatheta
+            np.testing.assert_allclose(batch[4][i], scalar[13], rtol=1e-8);  # OMEGA
+            np.testing.assert_allclose(batch[5][i], scalar[7], rtol=1e-6);  # s_e_phiphi
+            np.testing.assert_allclose(batch[7][i], scalar[9], rtol=1e-6);  # s_e_thetatheta
+        # A collinear triangle is flagged instead of breaking the stack
+        phi[1] = [-122, -121, -120];
+        theta[1] = [-50, -50, -50];
+        batch = strain_delaunay.strain_sphere_batch(phi, theta, u_phi, u_theta, s_phi, s_theta);
+        self.assertTrue(batch[10][1]);
+        self.assertTrue(np.isnan(batch[0][1]));
+        self.assertFalse(np.isnan(batch[0][0]));
+        return;
+
+    def test_delaunay_flat_uniform_gradient(self):
+        # A linear velocity field should come back in every triangle.
+        elon = np.array([-123, -124, -124, -123, -123.4, -123.7]);
+        nlat = np.array([39, 39, 40, 40, 39.5, 39.2]);
+        tri_index = triangulation.build_triangle_index(elon, nlat);
+        myVelfield = [velocity_io.StationVel(elon=elon[i], nlat=nlat[i], e=0.2*(nlat[i]-39), n=0.3*(nlat[i]-39), u=0,
+                                             se=1, sn=1, su=1, name='') for i in range(6)];
+        [rot, exx, exy, eyy] = strain_delaunay_flat.compute_on_triangles(tri_index, myVelfield);
+        np.testing.assert_allclose(exx, 0.0, atol=1e-9);
+        np.testing.assert_allclose(exy, 0.5 * 0.2 / 111.0 * 1000, rtol=1e-2);  # nanostrain/yr
+        np.testing.assert_allclose(eyy, 0.3 / 111.0 * 1000, rtol=1e-2);
+        np.testing.assert_allclose(rot, 0.5 * 0.2 / 111.0 * 1000, rtol=1e-2);
+        return;
+
+    def test_triangle_index(self):
+        # Vertex values are gathered by station index, even when two stations share a location.
+        elon = np.array([-123, -124, -124, -123, -123]);
+        nlat = np.array([39, 39, 40, 40, 40]);
+        tri_index = triangulation.build_triangle_index(elon, nlat);
+        self.assertEqual(np.shape(tri_index.simplices), (2, 3));
+        np.testing.assert_array_equal(triangulation.gather(tri_index, elon), tri_index.vertices[:, :, 0]);
+        np.testing.assert_array_equal(triangulation.gather(tri_index, nlat), tri_index.vertices[:, :, 1]);
+        np.testing.assert_allclose(tri_index.xcentroid, np.mean(tri_index.vertices[:, :, 0], axis=1));
+        return;
+
+    def test_tri2grid(self):
+        # Each grid node takes the value of its triangle; nodes outside the hull are NaN.
+        tri_index = triangulation.build_triangle_index([-123, -124, -124, -123], [39, 39, 40, 40]);
+        values = np.arange(len(tri_index.simplices)) + 1.0;
+        lons, lats, grids = produce_gridded.tri2grid_fields([0.25, 0.25], [-124.5, -122.5, 38.5, 40.5], tri_index,
+                                                            {'exx': values, 'chi2': 10 * values});
+        self.assertEqual(np.shape(grids['exx']), (len(lats), len(lons)));
+        self.assertTrue(np.isnan(grids['exx'][0, 0]));  # outside the hull
+        inside = tri_index.delaunay.find_simplex([lons[3], lats[3]]);
+        self.assertEqual(grids['exx'][3, 3], values[inside]);
+        self.assertEqual(grids['chi2'][3, 3], 10 * values[inside]);
+        return;
+
+    def test_projection(self):
+        # Vectorized UTM against a reference value, and consistency of the local projections
+        x, y = projection.utm_forward(np.array([-122.5, -122.5]), np.array([38.5, 38.5]), zone=10);
+        np.testing.assert_allclose(x, 543599.062, atol=0.1);
+        np.testing.assert_allclose(y, 4261411.854, atol=0.1);
+        self.assertEqual(projection.utm_zone(-122.5), 10);
+        m_per_deg_lon, m_per_deg_lat = projection.meters_per_degree(40.0);
+        for name in ['tmerc', 'aeqd']:
+            proj = projection.projection_for_data([-123, -122], [39.5, 40.5], name=name);
+            x, y = proj.forward(np.array([-122.5, -122.5, -122.49]), np.array([40.0, 40.01, 40.0]));
+            np.testing.assert_allclose(y[1] - y[0], 0.01 * m_per_deg_lat, rtol=5e-3);  # aeqd is spherical
+            np.testing.assert_allclose(x[2] - x[0], 0.01 * m_per_deg_lon, rtol=5e-3);
+        x, y = projection.Projection('utm', lon0=-122).forward(-122.5, 38.5);  # scalars
+        self.assertEqual(np.shape(x), ());
+        np.testing.assert_allclose([x, y], [543599.062, 4261411.854], atol=0.1);
+        return;
+
+    def test_huang_uniform_gradient(self):
+        # Huang's local plane fit should recover a uniform velocity gradient.
+        elon, nlat = np.meshgrid(np.arange(-123, -121.9, 0.1), np.arange(39, 40.1, 0.1));
+        elon, nlat = elon.ravel(), nlat.ravel();
+        proj = projection.projection_for_data(elon, nlat, name='utm');
+        x, y = proj.forward(elon, nlat);
+        myVelfield = [velocity_io.StationVel(elon=elon[i], nlat=nlat[i], e=1e-5*(y[i]-y[0]), n=0, u=0, se=1, sn=1,
+                                             su=1, name='') for i in range(len(elon))];
+        [lons, lats, rot, exx, exy, eyy] = strain_huang.compute_huang(myVelfield, [-122.8, -122.2, 39.2, 39.8],
+                                                                      [0.1, 0.1], 30, 8);
+        np.testing.assert_allclose(exy, 5.0, rtol=1e-6);  # 1e-5 mm/yr per m = 10 nanostrain/yr shear gradient
+        np.testing.assert_allclose(exx, 0.0, atol=1e-6);
+        np.testing.assert_allclose(rot, 5.0, rtol=1e-6);
+        return;
+
+    def test_eigenvectors_closed_form(self):
+        # The closed-form eigen-decomposition follows np.linalg.eig's ordering and signs, on 1d and 2d inputs.
+        exx = np.array([[1.0, -3.0, 2.0, 5.0], [0.5, -2.0, 1.0, np.nan]]);
+        exy = np.array([[0.0, 1.5, -0.7, 0.0], [2.0, -1.0, 0.0, 1.0]]);
+        eyy = np.array([[2.0, 1.0, 2.0, -1.0], [0.5, 4.0, -3.0, 1.0]]);
+        for shape in [(8,), (2, 4)]:
+            [e1, e2, v00, v01, v10, v11] = strain_tensor_toolbox.compute_eigenvectors(exx.reshape(shape),
+                                                                                      exy.reshape(shape),
+                                                                                      eyy.reshape(shape));
+            self.assertEqual(np.shape(e1), shape);
+            for i in range(7):
+                index = np.unravel_index(i, shape);
+                w, v = np.linalg.eig(np.array([[exx.flat[i], exy.flat[i]], [exy.flat[i], eyy.flat[i]]]));
+                np.testing.assert_allclose([e1[index], e2[index]], w, atol=1e-12);
+                np.testing.assert_allclose([[v00[index], v01[index]], [v10[index], v11[index]]], v, atol=1e-12);
+            self.assertTrue(np.isnan(e1.flat[7]) and np.isnan(v00.flat[7]));
+        [I2nd, max_shear, dilatation, azimuth] = strain_tensor_toolbox.compute_derived_quantities(exx, exy, eyy);
+        self.assertTrue(np.isnan(I2nd[1, 3]) and np.isnan(azimuth[1, 3]));
+        self.assertAlmostEqual(azimuth[0, 0], 90.0);  # shortening along x
+        self.assertAlmostEqual(dilatation[0, 1], -2.0);
+        return;
+
+    def test_derived_quantities_kernel(self):
+        # The fused kernel matches the separate computations, across block boundaries and into preallocated arrays
+        rng = np.random.default_rng(1);
+        exx, exy, eyy = rng.normal(size=(3, 7, 9));
+        [I2nd, max_shear, dilatation, azimuth] = strain_tensor_toolbox.compute_derived_quantities(exx, exy, eyy);
+        [e1, e2, v00, v01, v10, v11] = strain_tensor_toolbox.compute_eigenvectors(exx, exy, eyy);
+        out = {'azimuth': np.zeros((7, 9))};
+        derived = strain_tensor_toolbox.derived_quantities_kernel(exx, exy, eyy, out=out, block_size=10);
+        self.assertIs(derived['azimuth'], out['azimuth']);
+        for name, expected in zip(['I2nd', 'max_shear', 'dilatation', 'azimuth', 'e1', 'e2', 'v00', 'v11'],
+                                  [I2nd, max_shear, dilatation, azimuth, e1, e2, v00, v11]):
+            np.testing.assert_allclose(derived[name], expected);
+        only = strain_tensor_toolbox.derived_quantities_kernel(exx, exy, eyy, quantities=['dilatation']);
+        self.assertEqual(list(only.keys()), ['dilatation']);
+        with self.assertRaises(ValueError):  # a transposed array would be filled through a copy
+            strain_tensor_toolbox.derived_quantities_kernel(exx, exy, eyy, out={'dilatation': np.zeros((9, 7)).T});
+        return;
+
+    def test_combined_netcdf(self):
+        # All gridded quantities go into one compressed file, and comparisons can read single variables from it
+        outdir = tempfile.mkdtemp() + '/';
+        lons, lats = np.arange(-125, -120.9, 0.5), np.arange(38, 42.1, 0.5);
+        grids = {name: np.random.default_rng(2).normal(size=(len(lats), len(lons)))
+                 for name, _ in output_manager.GRID_VARIABLES};
+        grids['rot'][0, 0] = np.nan;
+        options = configure_functions.get_output_options({'format': 'combined', 'float32': 'True', 'chunk': '4'});
+        MyParams = configure_functions.Params(strain_method='huang', input_file='vels.txt',
+                                              range_strain=[-125, -121, 38, 42], range_data=[-125, -121, 38, 42],
+                                              inc=[0.5, 0.5], outdir=outdir, method_specific={'nstations': '8'},
+                                              output_options=options);
+        output_manager.write_combined_netcdf(lons, lats, grids, MyParams, options);
+        ds = output_manager.open_combined_netcdf(outdir + output_manager.COMBINED_FILENAME);
+        self.assertEqual(ds['dila'].attrs['units'], 'per yr');
+        self.assertEqual(ds.attrs['strain_method'], 'huang');
+        self.assertEqual(ds.attrs['config_nstations'], '8');
+        self.assertTrue(ds['exx'].encoding['zlib']);
+        self.assertEqual(ds['exx'].encoding['dtype'], np.dtype('float32'));
+        ds.close();
+        grid_source = output_manager.get_plotting_grids(MyParams, options);  # loaded in memory, file closed
+        np.testing.assert_allclose(grid_source['dila'].values, grids['dila'], rtol=1e-6);
+        [lon, lat, val] = compare_strain_grids.read_combined_variable(outdir + output_manager.COMBINED_FILENAME, 'rot');
+        np.testing.assert_allclose(lon, lons);
+        self.assertTrue(np.isnan(val[0, 0]));
+        np.testing.assert_allclose(val[1:], grids['rot'][1:], rtol=1e-6);
+        return;
+
+    def test_eigenvector_glyphs(self):
+        # Decimated grid glyphs come in opposite pairs, split by eigenvalue sign, with large values saturated
+        xdata, ydata = np.arange(5.0), np.arange(4.0);
+        w1, w2 = np.full((4, 5), 300.0), np.full((4, 5), -2.0);
+        v00, v10 = np.ones((4, 5)), np.zeros((4, 5));
+        v01, v11 = np.zeros((4, 5)), np.ones((4, 5));
+        [positive, negative] = output_manager.grid_eigenvector_glyphs(xdata, ydata, w1, w2, v00, v01, v10, v11,
+                                                                      eigs_dec=2);
+        self.assertEqual(np.shape(positive), (12, 4));  # 2 rows x 3 columns x 2 glyphs
+        np.testing.assert_allclose(positive[0], [0, 0, 200, 0]);
+        np.testing.assert_allclose(positive[1], [0, 0, -200, 0]);
+        np.testing.assert_allclose(negative[2], [2, 0, 0, -2]);
+        [positive, negative] = output_manager.polygon_eigenvector_glyphs([1.0], [2.0], [1000.0], [0.0], [1.0],
+                                                                         [0.0], [0.0], [1.0]);
+        np.testing.assert_allclose(positive, [[1, 2, 40, 0], [1, 2, -40, 0]]);
+        self.assertEqual(len(negative), 2);
+        return;
+
     def test_azimuth_math(self):
         # Test angular math functions
         azimuth_array = [0, 1, 179, 0];
@@ -54,6 +248,159 @@ class Tests(unittest.TestCase):
         self.assertEqual(theta, 0);
         return;
 
+    def test_comparison_cube_statistics(self):
+        # Stacked-grid statistics agree with the scalar math, cell by cell, and skip nans
+        rng = np.random.default_rng(3);
+        azimuths = rng.uniform(0, 180, size=(4, 6, 7));
+        azimuths[0, 0, 0] = np.nan;
+        azimuths[:, 1, 1] = np.nan;
+        strain_values_dict = {'m%d' % i: [np.arange(7), np.arange(6), azimuths[i]] for i in range(4)};
+        mean_vals, sd_vals = compare_grd_functions.angle_means(strain_values_dict);
+        theta, sd = compare_grd_functions.angle_mean_math(list(azimuths[:, 0, 0]));
+        self.assertAlmostEqual(mean_vals[0, 0], theta);
+        self.assertAlmostEqual(sd_vals[0, 0], sd);
+        self.assertTrue(np.isnan(mean_vals[1, 1]));
+        mean_vals, sd_vals = compare_grd_functions.grid_means_stds(strain_values_dict);
+        self.assertAlmostEqual(mean_vals[2, 3], np.mean(azimuths[:, 2, 3]));
+        self.assertAlmostEqual(sd_vals[0, 0], np.std(azimuths[1:, 0, 0]));
+        mean_vals, _ = compare_grd_functions.grid_means_log(strain_values_dict);
+        self.assertAlmostEqual(mean_vals[2, 3], np.log10(np.mean(10 ** azimuths[:, 2, 3])));
+        return;
+
+    def test_streaming_comparison(self):
+        # Streaming statistics over row blocks match the in-memory comparison of the whole grids
+        rng = np.random.default_rng(4);
+        lons, lats = np.arange(-125, -121.9, 0.5), np.arange(38, 41.1, 0.5);
+        outdir = tempfile.mkdtemp() + '/';
+        strain_dict, strain_values_dict = {}, {};
+        for i in range(3):
+            strain_dict['run%d' % i] = tempfile.mkdtemp();
+            values = rng.uniform(0, 180, size=(len(lats), len(lons)));
+            values[i, i] = np.nan;
+            dataset = streaming_comparison.create_output_grid(lons, lats, 'degrees',
+                                                              strain_dict['run%d' % i] + '/azimuth.nc');
+            dataset.variables['z'][:, :] = values;
+            dataset.close();
+            strain_values_dict['run%d' % i] = [lons, lats, values];
+        MyParams = configure_functions.Comps_Params(range_strain=[-125, -122, 38, 41], inc=[0.5, 0.5],
+                                                    strain_dict=strain_dict, outdir=outdir);
+        streaming_comparison.compare_streaming(MyParams, 'azimuth.nc', 'angle', block_rows=3, percentiles=[50]);
+        expected_means, expected_stds = compare_grd_functions.angle_means(strain_values_dict);
+        for prefix, expected in [('means_', expected_means), ('deviations_', expected_stds)]:
+            _, _, variable = streaming_comparison.open_run_grid(outdir, prefix + 'azimuth.nc')[1:];
+            np.testing.assert_allclose(np.ma.filled(variable[:], np.nan), expected, atol=1e-9);
+        cube = np.array([[179.0, 10.0], [1.0, 20.0], [177.0, np.nan]])[:, np.newaxis, :];  # (runs, rows, cols)
+        medians = streaming_comparison.block_percentile_values(cube, [50], 'angle')[0, 0];
+        np.testing.assert_allclose(medians, [179.0, 15.0]);  # a linear median ignores the wrap: 177
+        stats = streaming_comparison.RunningStats((2,));
+        for values in [[1.0, np.nan], [3.0, 2.0], [8.0, np.nan]]:
+            stats.add(np.array(values));
+        mean, std = stats.results();
+        np.testing.assert_allclose(mean, [4.0, 2.0]);
+        np.testing.assert_allclose(std, [np.std([1.0, 3.0, 8.0]), 0.0]);
+        return;
+
+    def test_streaming_comparison_log(self):
+        # Log statistics with a zero mean and a zero deviation give nan in both paths, never -inf
+        lons, lats = np.arange(-125, -123.9, 0.5), np.arange(38, 39.1, 0.5);
+        outdir = tempfile.mkdtemp() + '/';
+        strain_dict, strain_values_dict = {}, {};
+        for i in range(3):
+            strain_dict['run%d' % i] = tempfile.mkdtemp();
+            values = np.full((len(lats), len(lons)), 1.0 + i);
+            values[0, 0] = 2.0;  # identical in every run: zero deviation
+            values[1, 1] = -np.inf;  # zero I2nd in every run: zero mean
+            dataset = streaming_comparison.create_output_grid(lons, lats, 'per year',
+                                                              strain_dict['run%d' % i] + '/I2nd.nc');
+            dataset.variables['z'][:, :] = values;
+            dataset.close();
+            strain_values_dict['run%d' % i] = [lons, lats, values];
+        MyParams = configure_functions.Comps_Params(range_strain=[-125, -124, 38, 39], inc=[0.5, 0.5],
+                                                    strain_dict=strain_dict, outdir=outdir);
+        with warnings.catch_warnings():
+            warnings.simplefilter("error", category=RuntimeWarning);
+            streaming_comparison.compare_streaming(MyParams, 'I2nd.nc', 'log', block_rows=2);
+        expected_means, expected_stds = compare_grd_functions.grid_means_log(strain_values_dict);
+        self.assertTrue(np.isnan(expected_stds[0, 0]) and np.isnan(expected_means[1, 1]));
+        for prefix, expected in [('means_', expected_means), ('deviations_', expected_stds)]:
+            _, _, variable = streaming_comparison.open_run_grid(outdir, prefix + 'I2nd.nc')[1:];
+            np.testing.assert_allclose(np.ma.filled(variable[:], np.nan), expected, atol=1e-9);
+        return;
+
+    def test_compare_all(self):
+        # All quantities are loaded once from each run and compared together, with the azimuth deviations masked
+        lons, lats = np.arange(-125, -120.9, 0.5), np.arange(38, 42.1, 0.5);
+        strain_dict = {};
+        for i in range(3):
+            strain_dict['run%d' % i] = tempfile.mkdtemp() + '/';
+            grids = {name: np.random.default_rng(i).uniform(0, 6, size=(len(lats), len(lons)))
+                     for name, _ in output_manager.GRID_VARIABLES};
+            MyParams = configure_functions.Params(strain_method='run%d' % i, input_file='', range_strain=[0, 1, 0, 1],
+                                                  range_data=[0, 1, 0, 1], inc=[1, 1], outdir=strain_dict['run%d' % i],
+                                                  method_specific={});
+            output_manager.write_combined_netcdf(lons, lats, grids, MyParams,
+                                                 configure_functions.get_output_options({'format': 'combined'}));
+        MyParams = configure_functions.Comps_Params(range_strain=[-125, -121, 38, 42], inc=[0.5, 0.5],
+                                                    strain_dict=strain_dict, outdir='');
+        filenames = [filename for filename, _ in compare_strain_grids.QUANTITIES];
+        all_values = compare_strain_grids.read_all_strain_files(MyParams, filenames, workers=3);
+        _, _, results = compare_strain_grids.compare_all(MyParams, all_values);
+        expected_mean, _ = compare_grd_functions.grid_means_stds(all_values['dila.nc']);
+        np.testing.assert_allclose(results['dila.nc'][0], expected_mean);
+        _, expected_sd = compare_grd_functions.angle_means(all_values['azimuth.nc']);
+        small_I2nd = np.abs(results['I2nd.nc'][0]) <= 3;
+        self.assertTrue(np.all(np.isnan(results['azimuth.nc'][1][small_I2nd])));
+        np.testing.assert_allclose(results['azimuth.nc'][1][~small_I2nd], expected_sd[~small_I2nd]);
+        return;
+
+    def test_regrid(self):
+        # Bilinear regridding reproduces a linear field from a buffered, descending source grid; no extrapolation
+        target_lon, target_lat = regrid.target_axes([-125, -121, 38, 42], [0.5, 0.5]);
+        source_lon, source_lat = np.arange(-125.3, -121.2, 0.2), np.arange(42.3, 37.6, -0.3);
+        values = 2 * source_lon[np.newaxis, :] - 3 * source_lat[:, np.newaxis];
+        strain_values_dict = {'buffered': [source_lon, source_lat, values],
+                              'matching': [target_lon, target_lat, np.zeros((len(target_lat), len(target_lon)))]};
+        regrid.regrid_strain_values(strain_values_dict, target_lon, target_lat, 'bilinear');
+        [lon, lat, regridded] = strain_values_dict['buffered'];
+        np.testing.assert_allclose(lon, target_lon);
+        expected = 2 * target_lon[np.newaxis, :] - 3 * target_lat[:, np.newaxis];
+        np.testing.assert_allclose(regridded[:, :-1], expected[:, :-1]);
+        self.assertTrue(np.all(np.isnan(regridded[:, -1])));  # -121 lies beyond the source grid
+        index = regrid.build_regrid_index(source_lon, source_lat, target_lon, target_lat, 'nearest');
+        nearest = regrid.regrid_values(index, values);
+        self.assertEqual(nearest[0, 0], values[-2, 1]);  # (-125.1, 37.8) is the closest source node to (-125, 38)
+        return;
+
+    def test_regrid_azimuth_wrap(self):
+        # Azimuths on either side of the 0/180 wrap interpolate to an azimuth near the wrap, not to ~90 degrees
+        source_lon, source_lat = np.array([0.0, 1.0]), np.array([0.0, 1.0]);
+        target_lon, target_lat = np.array([0.5]), np.array([0.5]);
+        azimuths = np.array([[179.0, 1.0], [179.0, 1.0]]);
+        index = regrid.build_regrid_index(source_lon, source_lat, target_lon, target_lat, 'bilinear');
+        regridded = regrid.regrid_values(index, azimuths, axial=True);
+        self.assertLess(min(regridded[0, 0], 180 - regridded[0, 0]), 1e-6);
+        strain_values_dict = {'offset': [source_lon, source_lat, np.array([[170.0, 176.0], [170.0, 176.0]])]};
+        regrid.regrid_strain_values(strain_values_dict, target_lon, target_lat, 'bilinear',
+                                    axial=regrid.is_axial("azimuth.nc"));
+        self.assertAlmostEqual(strain_values_dict['offset'][2][0, 0], 173.0);
+        return;
+
+    def test_regrid_nan_neighbours(self):
+        # Target nodes on valid source nodes keep their values next to nan cells (outside a Delaunay hull)
+        source_lon, source_lat = np.arange(0.0, 5.0), np.arange(0.0, 3.0);
+        values = np.tile(np.arange(0.0, 5.0), (3, 1));
+        values[:, 0] = np.nan;
+        values[0, :] = np.nan;
+        for axial in [False, True]:
+            index = regrid.build_regrid_index(source_lon, source_lat, source_lon[1:], source_lat[1:], 'bilinear');
+            regridded = regrid.regrid_values(index, values * 30, axial);
+            np.testing.assert_allclose(regridded, values[1:, 1:] * 30, atol=1e-9);
+        index = regrid.build_regrid_index(source_lon, source_lat, [0.5, 1.5], [1.5], 'bilinear');
+        regridded = regrid.regrid_values(index, values);
+        self.assertTrue(np.isnan(regridded[0, 0]));  # a nan corner with weight still gives nan
+        self.assertAlmostEqual(regridded[0, 1], 1.5);
+        return;
+
     def test_readvels(self):
         # Test reading velocity files
         datafile = "test/testing_data/NorCal_stationvels.txt"
@@ -62,5 +409,242 @@ class Tests(unittest.TestCase):
         return;
 
 
+    def test_velocity_field(self):
+        # Columnar velocity field: zero-copy columns, box selection, masks, and StationVel iteration
+        datafile = "test/testing_data/NorCal_stationvels.txt"
+        myVelfield = velocity_io.read_stationvels(datafile);
+        self.assertIsInstance(myVelfield, velocity_io.VelocityField);
+        self.assertEqual(myVelfield.e.dtype, np.float64);
+        self.assertTrue(myVelfield.e.flags['C_CONTIGUOUS']);
+        box = [-123, -121, 38, 40];
+        selected = myVelfield.select_box(box);
+        expected = [x for x in myVelfield if box[0] < x.elon < box[1] and box[2] < x.nlat < box[3]];
+        self.assertEqual(selected.to_stationvels(), expected);
+        first = myVelfield[0];
+        self.assertIsInstance(first, velocity_io.StationVel);
+        self.assertEqual(first.e, myVelfield.e[0]);
+        self.assertEqual(len(myVelfield.mask(myVelfield.e > 0)), np.sum(myVelfield.e > 0));
+        cached_copy = tempfile.mkdtemp() + '/vels.txt';
+        velocity_io.write_stationvels(myVelfield, cached_copy);
+        velocity_io.read_stationvels(cached_copy, use_cache=True);  # creates the sidecar
+        cached = velocity_io.read_stationvels(cached_copy, use_cache=True);
+        np.testing.assert_allclose(cached.e, myVelfield.e, atol=1e-6);
+        np.testing.assert_array_equal(cached.name, myVelfield.name);
+        rebuilt = velocity_io.as_velocity_field(list(myVelfield));
+        np.testing.assert_array_equal(rebuilt.sn, myVelfield.sn);
+        np.testing.assert_array_equal(rebuilt.name, myVelfield.name);
+        return;
+
+    def test_read_community_formats(self):
+        # MIDAS and NAM08 files are read straight into a VelocityField in mm/yr, keeping only stations in the box
+        outdir = tempfile.mkdtemp() + '/';
+        midas_line = "%s MIDAS4 2005.0000 2019.5000 14.5 5000 4900 4000 %f %f 0.001 0.0002 0.0003 0.001 " \
+                     "0 0 0 0 0 0 0 0 0 0 %f %f 10.0\n";
+        with open(outdir + 'midas.NA12.txt', 'w') as ofile:
+            ofile.write(midas_line % ('P001', -0.01, 0.02, 39.0, 237.5));  # lon 237.5 wraps to -122.5
+            ofile.write(midas_line % ('P002', -0.02, 0.03, 45.0, -122.0));  # outside the box
+        myVelfield = velocity_io.read_velocity_file(outdir + 'midas.NA12.txt', 'auto', coord_box=[-125, -120, 38, 42]);
+        self.assertEqual(list(myVelfield.name), ['P001']);
+        np.testing.assert_allclose([myVelfield.elon[0], myVelfield.e[0], myVelfield.sn[0]], [-122.5, -10.0, 0.3]);
+        with open(outdir + 'NAM08_pbovelfile.vel', 'w') as ofile:
+            ofile.write("header\n" * 37);
+            ofile.write("P003 NAME 20180101 0 0 0 0 40.0 235.0 0 0 0 0 0 0 0 0 0 0 0.005 -0.02 0.001 "
+                        "0.0001 0.0002 0.0009 0.1 0.2 0.3 20040101000000 20180101000000\n");
+        myVelfield = velocity_io.read_velocity_file(outdir + 'NAM08_pbovelfile.vel', 'nam08');
+        np.testing.assert_allclose([myVelfield.elon[0], myVelfield.nlat[0], myVelfield.e[0], myVelfield.n[0]],
+                                   [-125.0, 40.0, -20.0, 5.0]);
+        np.testing.assert_allclose([myVelfield.se[0], myVelfield.sn[0], myVelfield.su[0]], [0.2, 0.1, 0.9]);
+        return;
+    def test_validation(self):
+        # Invalid stations are reported or dropped, and colocated stations are merged by policy
+        names = ['AAAA', 'BBBB', 'CCCC', 'DDDD', 'EEEE'];
+        myVelfield = velocity_io.VelocityField(elon=[-122.0, -122.0, -121.0, -121.00001, -120.0],
+                                               nlat=[38.0, 38.0, 39.0, 39.0, 40.0], e=[1.0, 3.0, 5.0, 7.0, 1.0],
+                                               n=[0.0, 0.0, 0.0, 0.0, np.nan], se=[1, 2, 1, 1, 1], sn=[1, 2, 1, 1, 1],
+                                               su=[1, 2, 1, 1, 1], name=names);
+        with self.assertRaises(ValueError):
+            validation.validate_velfield(myVelfield);
+        [merged, summary] = validation.validate_velfield(myVelfield, invalid='drop');
+        self.assertEqual(summary['nonfinite_velocity'], 1);
+        self.assertEqual(summary['colocated_groups'], [['AAAA', 'BBBB']]);  # exact duplicates only
+        self.assertEqual(list(merged.name), ['AAAA', 'CCCC', 'DDDD']);
+        np.testing.assert_allclose([merged.e[0], merged.se[0]], [1.4, np.sqrt(0.8)]);
+        [merged, summary] = validation.validate_velfield(myVelfield, merge_distance=0.01, merge_policy='mean',
+                                                         invalid='drop');
+        self.assertEqual(summary['colocated_groups'], [['AAAA', 'BBBB'], ['CCCC', 'DDDD']]);
+        np.testing.assert_allclose(merged.e, [2.0, 6.0]);
+        [merged, _] = validation.validate_velfield(myVelfield, coord_box=[-122.5, -120.5, 37, 40],
+                                                   merge_distance=0.01, merge_policy='drop', invalid='drop');
+        self.assertEqual(list(merged.name), ['AAAA', 'CCCC']);
+        dateline = velocity_io.VelocityField(elon=[179.99999, -179.99999, 359.99999, 0.00001], nlat=[10.0] * 4,
+                                             e=[1.0] * 4, n=[1.0] * 4, u=[0.0] * 4, se=[1] * 4, sn=[1] * 4,
+                                             su=[1] * 4, name=['FFFF', 'GGGG', 'HHHH', 'IIII']);
+        merged = validation.merge_groups(dateline, validation.colocated_groups(dateline.elon, dateline.nlat, 0.01));
+        np.testing.assert_allclose(merged.elon, [180.0, 360.0], atol=1e-9);  # the first station's convention
+        np.testing.assert_allclose(merged.nlat, [10.0, 10.0]);
+        return;
+    def test_ensemble_config(self):
+        # A list of methods makes one Params per method, each with its own section and output directory
+        configfile = tempfile.mkdtemp() + '/ensemble_config.txt';
+        with open("test/testing_data/example_config.txt") as ifile:
+            text = ifile.read().replace("method     = delaunay", "method     = delaunay, huang");
+        with open(configfile, 'w') as ofile:
+            ofile.write(text + "\n[ensemble]\nworkers = 2\ncompare = True\n");
+        MyParams = configure_functions.parse_config_file_into_Params(configfile);
+        self.assertTrue(configure_functions.is_ensemble(MyParams));
+        self.assertEqual(MyParams.ensemble_options['workers'], 2);
+        members = configure_functions.ensemble_member_params(MyParams);
+        self.assertEqual([x.strain_method for x in members], ['delaunay', 'huang']);
+        self.assertEqual(members[1].outdir, 'output/huang/');
+        self.assertEqual(members[1].method_specific['nstations'], '13');
+        CompParams = configure_functions.ensemble_comparison_params(MyParams, members);
+        self.assertEqual(CompParams.strain_dict['huang'], 'output/huang/');
+        lons, lats = np.arange(3.0), np.arange(2.0);
+        exx, exy, eyy, rot = np.ones((2, 3)), np.zeros((2, 3)), -np.ones((2, 3)), np.zeros((2, 3));
+        all_values = compare_strain_grids.strain_results_to_values({'a': [lons, lats, rot, exx, exy, eyy]});
+        np.testing.assert_allclose(all_values['dila.nc']['a'][2], 0);
+        np.testing.assert_allclose(all_values['max_shear.nc']['a'][2], 1);
+        return;
+    def test_parameter_sweep(self):
+        # Swept config values expand to every combination; Huang solves them all from one neighbor search
+        self.assertEqual(configure_functions.get_sweep_values("50:100:25"), ['50', '75', '100']);
+        self.assertEqual(configure_functions.get_sweep_values("8, 13"), ['8', '13']);
+        self.assertEqual(configure_functions.get_sweep_values("1/100/1"), ['1/100/1']);
+        self.assertEqual(configure_functions.get_sweep_values("gaussian"), ['gaussian']);
+        combinations = configure_functions.sweep_combinations({'estimateradiuskm': '50:100:50', 'nstations': '8, 13',
+                                                              'projection': 'utm'});
+        self.assertEqual(len(combinations), 4);
+        self.assertEqual(combinations[1], {'estimateradiuskm': '50', 'nstations': '13', 'projection': 'utm'});
+        myVelfield = velocity_io.read_stationvels("test/testing_data/NorCal_stationvels.txt");
+        box, inc = [-124, -121, 38, 41], [0.1, 0.1];
+        neighbors = strain_huang.huang_neighbors(myVelfield, box, inc, 100, 13);
+        for radiuskm, nstations in [(50, 8), (100, 13)]:
+            expected = strain_huang.compute_huang(myVelfield, box, inc, radiuskm, nstations);
+            result = strain_huang.strain_from_neighbors(neighbors, radiuskm, nstations);
+            for expected_grid, grid in zip(expected, result[0:6]):
+                np.testing.assert_array_equal(grid, expected_grid);
+            self.assertGreater(result[6], 0);
+        return;
+    def test_result_cache(self):
+        # Identical inputs hit the cache, changed parameters or force recompute, and old entries are evicted
+        MyParams = configure_functions.parse_config_file_into_Params(configfile="test/testing_data/example_config.txt");
+        myVelfield = velocity_io.read_stationvels("test/testing_data/NorCal_stationvels.txt");
+        cache_options = configure_functions.get_cache_options({'enabled': 'True', 'directory': tempfile.mkdtemp()});
+        calls = [];
+        def compute():
+            calls.append(1);
+            return [[np.arange(3.0), np.arange(2.0)] + [np.full((2, 3), len(calls))] * 4, 0.5];
+        first = result_cache.cached_compute(MyParams, myVelfield, compute, cache_options);
+        second = result_cache.cached_compute(MyParams, myVelfield, compute, cache_options);
+        self.assertEqual(len(calls), 1);
+        np.testing.assert_array_equal(second[0][3], first[0][3]);
+        self.assertEqual(second[1], 0.5);
+        stored, loaded = {'chi2': np.ones((2, 3))}, {};
+        result_cache.store_result(cache_options['directory'], 'uncertain', first[0], None, uncertainties=stored);
+        result_cache.load_result(cache_options['directory'], 'uncertain', loaded);
+        np.testing.assert_array_equal(loaded['chi2'], stored['chi2']);
+        result_cache.cached_compute(MyParams._replace(inc=[0.05, 0.05]), myVelfield, compute, cache_options);
+        result_cache.cached_compute(MyParams, myVelfield, compute, dict(cache_options, force=True));
+        self.assertEqual(len(calls), 3);
+        result_cache.evict(cache_options['directory'], max_size_mb=1e-6);
+        self.assertEqual(len(os.listdir(cache_options['directory'])), 1);
+        return;
+    def test_run_report(self):
+        # Stages nest by path, carry time and memory, and are written as JSON; outside a report they do nothing
+        outdir = tempfile.mkdtemp();
+        with instrumentation.stage('ignored'):
+            pass;
+        options = configure_functions.get_report_options({'trace_memory': 'True'});
+        with instrumentation.run_report(outdir, options, 'test') as report:
+            with instrumentation.stage('outer'):
+                with instrumentation.stage('inner'):
+                    big = np.ones(2000000);
+                del big;
+        self.assertEqual([x['stage'] for x in report.stages], ['outer/inner', 'outer']);
+        self.assertGreater(report.stages[0]['traced_peak_mb'], 15);
+        self.assertGreaterEqual(report.stages[1]['traced_peak_mb'], report.stages[0]['traced_peak_mb']);
+        self.assertGreaterEqual(report.stages[1]['wall_s'], report.stages[0]['wall_s']);
+        with open(outdir + '/' + instrumentation.REPORT_FILENAME) as ifile:
+            self.assertEqual(json.load(ifile)['stages'][1]['stage'], 'outer');
+        return;
+    def test_run_report_nested_profile(self):
+        # A profiled run nested in a profiled stage (an ensemble member) leaves the outer profiler in charge
+        outdir, inner_outdir = tempfile.mkdtemp(), tempfile.mkdtemp();
+        options = configure_functions.get_report_options({'profile': 'True'});
+        with instrumentation.run_report(outdir, options, 'outer') as report:
+            with instrumentation.stage('methods'):
+                with instrumentation.run_report(inner_outdir, options, 'member') as inner_report:
+                    with instrumentation.stage('compute'):
+                        pass;
+        self.assertNotIn('profile', inner_report.stages[0]);
+        self.assertTrue(os.path.isfile(report.stages[0]['profile']));
+        with instrumentation.run_report(inner_outdir, options, 'after') as later_report:
+            with instrumentation.stage('compute'):
+                pass;
+        self.assertTrue(os.path.isfile(later_report.stages[0]['profile']));
+        return;
+    def test_benchmark_suite(self):
+        # Synthetic uniform strain is recovered, and slower stages are reported against a baseline
+        results = run_benchmarks.run_benchmarks([200], ['uniform'], ['delaunay_flat', 'huang'], 0.1, 1);
+        self.assertLess(results['delaunay_flat/uniform/200']['error'], 1.0);
+        self.assertIn('compute/triangulation', results['delaunay_flat/uniform/200']['stages']);
+        self.assertIn('comparison/uniform/200', results);
+        baseline = json.loads(json.dumps(results));
+        self.assertEqual(run_benchmarks.find_regressions(results, baseline), []);
+        baseline['huang/uniform/200']['stages']['compute'] = 1e-6;
+        results['huang/uniform/200']['stages']['compute'] = 1.0;
+        self.assertEqual(len(run_benchmarks.find_regressions(results, baseline)), 1);
+        return;
+
+    def test_in_memory_api(self):
+        # The library API returns one Dataset and leaves nothing behind in the working directory
+        box = [-121.0, -119.0, 35.0, 37.0];
+        myVelfield = synthetic_fields.synthetic_velfield('uniform', 300, box);
+        cwd = os.getcwd();
+        with tempfile.TemporaryDirectory() as workdir:
+            os.chdir(workdir);
+            try:
+                ds = api.compute_strain(myVelfield, 'delaunay_flat', box, 0.1,
+                                        quantities=['dilatation', 'max_shear', 'e1']);
+                ds_huang = api.compute_strain(myVelfield.to_stationvels(), 'huang', box, [0.1, 0.1],
+                                              method_specific={'estimateradiuskm': 60, 'nstations': 8});
+            finally:
+                os.chdir(cwd);
+            self.assertEqual(os.listdir(workdir), []);
+        self.assertEqual(list(ds.data_vars), ['exx', 'exy', 'eyy', 'rot', 'dila', 'max_shear', 'e1']);
+        self.assertEqual(ds['exx'].dims, ('y', 'x'));
+        self.assertEqual(ds['e1'].attrs['units'], 'microstrain');
+        self.assertEqual(ds.attrs['strain_method'], 'delaunay_flat');
+        self.assertEqual(ds.attrs['stations'], 300);
+        self.assertAlmostEqual(float(ds['exx'].sel(x=-120.0, y=36.0, method='nearest')), 20.0, delta=1.0);
+        self.assertIn('I2nd', ds_huang.data_vars);
+        self.assertIn('misfit_mm_yr', ds_huang.attrs);
+        self.assertEqual(ds_huang.attrs['config_nstations'], '8');
+        MyParams = api.strain_params('huang', np.array(box), 0.1, range_data=np.array(box));  # arrays are fine
+        self.assertEqual(MyParams.range_data, box);
+        ds_sphere = api.compute_strain(myVelfield, 'delaunay', box, 0.1);  # gridded with its uncertainties
+        for name in ['s_exx', 's_exy', 's_eyy', 'chi2']:
+            self.assertEqual(ds_sphere[name].shape, ds_sphere['exx'].shape);
+            np.testing.assert_array_equal(np.isnan(ds_sphere[name]), np.isnan(ds_sphere['exx']));
+        with self.assertRaises(ValueError):
+            api.compute_strain(myVelfield, 'gpsgridder', box, 0.1);
+        return;
+
+    def test_startup_time(self):
+        # Starting strain_driver.py loads none of the heavy libraries; the stages that need them import them
+        code = ("import sys, time; start = time.perf_counter(); "
+                "from tools.strain import internal_coordinator, configure_functions; "
+                "print(time.perf_counter() - start); "
+                "print(','.join(sorted(set(m.split('.')[0] for m in sys.modules) & set(sys.argv[1:]))))");
+        times = [];
+        for _ in range(3):
+            output = subprocess.run([sys.executable, '-c', code] + HEAVY_MODULES, capture_output=True, text=True,
+                                    check=True).stdout.split('\n');
+            times.append(float(output[0]));
+            self.assertEqual(output[1], '');
+        self.assertLess(min(times), STARTUP_BUDGET_S,
+                        msg="Startup: %.3f s (budget %.3f s)" % (min(times), STARTUP_BUDGET_S));
+        return;
+
 if __name__ == "__main__":
     unittest.main();
@@ -0,0 +1,108 @@
+# A library interface to the strain calculators, for programs that embed them.
+# compute_strain takes a velocity field in memory and returns one xarray Dataset of the strain components
+# and derived quantities. Nothing is read from or written to disk, no subprocess is started, and nothing is plotted.
+# The command-line driver (internal_coordinator) runs the same steps, then writes and plots the results.
+
+import importlib
+from . import configure_functions, validation, velocity_io, strain_tensor_toolbox, output_manager
+
+DEFAULT_QUANTITIES = ['I2nd', 'max_shear', 'dilatation', 'azimuth'];
+IN_MEMORY_METHODS = ['delaunay', 'delaunay_flat', 'huang'];  # gpsgridder and visr run external programs on files
+DATASET_NAMES = {'dilatation': 'dila'};  # derived quantities stored under the name of their grd file
+
+
+def get_model(model_name):
+    """ Return an instance of the model model_name.
+        Dynamic module discovery. """
+    module_name = __package__ + '.models.strain_' + model_name.lower()
+    model_module = importlib.import_module(module_name)
+    obj = getattr(model_module, model_name)
+    return module_name, obj
+
+
+def strain_params(strain_method, range_strain, inc, range_data=None, method_specific=None, input_options=None):
+    """
+    Params for a run in memory: no input file, no output directory, and no run report or result cache.
+    range_strain, range_data: [W, E, S, N]; range_data defaults to range_strain
+    inc: [xinc, yinc] in degrees, or one number for both
+    method_specific: the parameters of the method's config section, e.g. {'estimateradiuskm': 80, 'nstations': 8}
+    input_options: the [input] options that apply to velocities in memory (merge_distance, merge_policy, invalid)
+    """
+    if strain_method not in IN_MEMORY_METHODS:
+        raise ValueError("Error! Method %s cannot run in memory. Choose from %s" % (strain_method, IN_MEMORY_METHODS));
+    if not hasattr(inc, '__len__'):
+        inc = [inc, inc];
+    if range_data is None:
+        range_data = range_strain;
+    return configure_functions.Params(strain_method=strain_method, input_file='in-memory',
+                                      range_strain=[float(x) for x in range_strain],
+                                      range_data=[float(x) for x in range_data],
+                                      inc=[float(x) for x in inc], outdir=None,
+                                      method_specific=dict(method_specific or {}),
+                                      input_options=configure_functions.get_input_options(input_options),
+                                      cache_options={'enabled': False}, report_options={'enabled': False});
+
+
+def clean_velocities(myVelfield, MyParams):
+    """
+    Validate a velocity field (a VelocityField or a list of StationVel) with the [input] options of MyParams.
+    Returns [VelocityField, validation summary dictionary].
+    """
+    input_options = configure_functions.get_input_options(MyParams.input_options);
+    [myVelfield, summary] = validation.validate_velfield(myVelfield, coord_box=MyParams.range_data,
+                                                         merge_distance=input_options['merge_distance'],
+                                                         merge_policy=input_options['merge_policy'],
+                                                         invalid=input_options['invalid']);
+    if len(myVelfield) == 0:
+        raise ValueError("Error! Velocity field has no velocities.");
+    return [myVelfield, summary];
+
+
+def compute_grids(MyParams, myVelfield, uncertainties=None):
+    # Run one strain method; returns [[lons, lats, rot, exx, exy, eyy], misfit or None]
+    # uncertainties: optional dictionary, filled with the uncertainty and chi2 grids of methods that report them
+    module_name, strain_model = get_model(MyParams.strain_method);
+    constructed_object = strain_model(MyParams);   # calling the constructor, building strain model from our params
+    grids = constructed_object.compute(myVelfield);
+    if uncertainties is not None and constructed_object.Uncertainties() is not None:
+        uncertainties.update(constructed_object.Uncertainties());
+    return [grids, constructed_object.Misfit()];
+
+
+def results_dataset(grids, MyParams, quantities=DEFAULT_QUANTITIES, misfit=None, uncertainties=None):
+    """
+    Dataset of one method's result: exx, exy, eyy, rot, plus the derived quantities (names from
+    strain_tensor_toolbox.DERIVED_QUANTITIES; dilatation is stored as 'dila', as in the grd files).
+    grids: [lons, lats, rot, exx, exy, eyy]
+    uncertainties: optional uncertainty and chi2 grids, as filled by compute_grids
+    """
+    [lons, lats, rot, exx, exy, eyy] = grids;
+    derived = strain_tensor_toolbox.derived_quantities_kernel(exx, exy, eyy, quantities=list(quantities));
+    variables = {'exx': exx, 'exy': exy, 'eyy': eyy, 'rot': rot};
+    for name in quantities:
+        variables[DATASET_NAMES.get(name, name)] = derived[name];
+    variables.update(uncertainties or {});
+    ds = output_manager.strain_dataset(lons, lats, variables, MyParams);
+    if misfit is not None:
+        ds.attrs['misfit_mm_yr'] = float(misfit);
+    return ds;
+
+
+def compute_strain(velocities, strain_method, range_strain, inc, range_data=None, method_specific=None,
+                   quantities=DEFAULT_QUANTITIES, input_options=None):
+    """
+    Compute strain rates from a velocity field in memory.
+    velocities: a velocity_io.VelocityField, or a list of velocity_io.StationVel (mm/yr)
+    strain_method: one of IN_MEMORY_METHODS
+    The other arguments are as in strain_params. quantities: derived quantities to include.
+    Returns an xarray Dataset on x (longitude) and y (latitude) coordinates, with the method and
+    parameters as attributes, the misfit (mm/yr) for methods that report one, and the uncertainty and chi2
+    grids for methods that report them (delaunay).
+    """
+    MyParams = strain_params(strain_method, range_strain, inc, range_data, method_specific, input_options);
+    [myVelfield, _] = clean_velocities(velocity_io.as_velocity_field(velocities), MyParams);
+    uncertainties = {};
+    [grids, misfit] = compute_grids(MyParams, myVelfield, uncertainties);
+    ds = results_dataset(grids, MyParams, quantities, misfit, uncertainties);
+    ds.attrs['stations'] = len(myVelfield);
+    return ds;
@@ -1,8 +1,8 @@
 # A set of code that reads multiple grid files and produces mean and variance statistics
 # In grid form. 
 
+import warnings
 import numpy as np
-from Tectonic_Utils.read_write import netcdf_read_write
 
 
 def defensive_programming(MyParams, strain_values_dict):
@@ -57,101 +57,86 @@ def check_grids(MyParams, strain_values_dict):
     return;
 
 
+def stack_methods(strain_values_dict):
+    # Stack the value arrays of all methods into one (nmethods, ny, nx) cube
+    return np.stack([np.asarray(strain_values_dict[method][2], dtype=float) for method in strain_values_dict.keys()]);
+
+
 def grid_means_stds(strain_values_dict):
     # calculate grid-wise mean and standard deviation, returning arrays with dimension latitude by longitude
-    first_key = list(strain_values_dict.keys())[0]
-    x = strain_values_dict[first_key][0];
-    y = strain_values_dict[first_key][1];
-    mean_vals = np.nan * np.ones([len(y), len(x)])
-    sd_vals = np.nan * np.ones([len(y), len(x)])
-    for j in range(len(y)):
-        for i in range(len(x)):
-            val_list = [];
-            for method in strain_values_dict.keys():
-                val_list.append(strain_values_dict[method][2][j][i]);
-            mean_val = np.nanmean(val_list)
-            sd_val = np.nanstd(val_list)
-            if mean_val != float("-inf"):
-                mean_vals[j][i] = mean_val
-            sd_vals[j][i] = sd_val
+    cube = stack_methods(strain_values_dict);
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", category=RuntimeWarning);  # cells where every method is nan
+        mean_vals = np.nanmean(cube, axis=0);
+        sd_vals = np.nanstd(cube, axis=0);
+    mean_vals[mean_vals == float("-inf")] = np.nan;
     return mean_vals, sd_vals
 
 
 def grid_means_log(strain_values_dict):
     # calculate grid-wise mean on a log quantity, returning array with dimension latitude by longitude
-    first_key = list(strain_values_dict.keys())[0]
-    x = strain_values_dict[first_key][0];
-    y = strain_values_dict[first_key][1];
-    mean_vals = np.nan * np.ones([len(y), len(x)])
-    sd_vals = np.nan * np.ones([len(y), len(x)])
-    for j in range(len(y)):
-        for i in range(len(x)):
-            val_list = [];
-            for method in strain_values_dict.keys():
-                val_list.append(10**strain_values_dict[method][2][j][i]);
-            mean_val = np.nanmean(val_list);
-            sd_val = np.nanstd(val_list)
-            if mean_val != float("-inf"):
-                mean_vals[j][i] = np.log10(mean_val)
-            sd_vals[j][i] = np.log10(sd_val)
-    return mean_vals, sd_vals
+    cube = np.power(10, stack_methods(strain_values_dict));
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", category=RuntimeWarning);  # all-nan cells, and log10 of zero deviation
+        mean_vals = np.nanmean(cube, axis=0);
+        sd_vals = np.nanstd(cube, axis=0);
+    return log10_positive(mean_vals), log10_positive(sd_vals)
+
+
+def log10_positive(values):
+    # log10 of a statistic of a log quantity; zero or negative values (e.g. a zero deviation) become nan, not -inf
+    values = np.asarray(values, dtype=float);
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.log10(np.where(values > 0, values, np.nan));
 
 
 def angle_means(strain_values_dict):
-    # Implementing the angular mean formulas
-    first_key = list(strain_values_dict.keys())[0]
-    x = strain_values_dict[first_key][0];
-    y = strain_values_dict[first_key][1];
-    mean_vals = np.nan * np.ones([len(y), len(x)])
-    sd_vals = np.nan * np.ones([len(y), len(x)])
-    for j in range(len(y)):
-        for i in range(len(x)):
-            azimuth_values = [];
-            for method in strain_values_dict.keys():
-                azimuth_values.append(strain_values_dict[method][2][j][i]);
-            theta, sd = angle_mean_math(azimuth_values);
-            if theta != float("-inf"):
-                mean_vals[j][i] = theta
-            if sd != float("inf"):
-                sd_vals[j][i] = sd
+    # Implementing the angular mean formulas, along the method axis of the stacked grids
+    mean_vals, sd_vals = angle_mean_math(stack_methods(strain_values_dict), axis=0);
+    mean_vals[mean_vals == float("-inf")] = np.nan;
+    sd_vals[sd_vals == float("inf")] = np.nan;
     return mean_vals, sd_vals
 
 
-def angle_mean_math(azimuth_values):
+def angle_mean_math(azimuth_values, axis=0):
     # Angles in degrees
     # separated out so we can unit-test this math
-    sin_list, cos_list = [], [];
-    for phi in azimuth_values:
-        sin_list.append(np.sin(2 * np.radians(90 - phi)));
-        cos_list.append(np.cos(2 * np.radians(90 - phi)));
-    s = np.nanmean(sin_list);
-    c = np.nanmean(cos_list);
-    R = ((s ** 2 + c ** 2) ** .5)
-    V = 1 - R
-    sd = np.degrees((-2 * np.log(R)) ** .5) / 2
+    # azimuth_values can be a list (returns scalars) or an array, averaged along axis (returns arrays)
+    phi = np.asarray(azimuth_values, dtype=float);
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", category=RuntimeWarning);  # all-nan cells
+        s = np.nanmean(np.sin(2 * np.radians(90 - phi)), axis=axis);
+        c = np.nanmean(np.cos(2 * np.radians(90 - phi)), axis=axis);
+    return angle_stats_from_mean_vector(s, c);
+
+
+def angle_stats_from_mean_vector(s, c):
+    # Circular mean and deviation (degrees) from the mean sine and cosine of the doubled angles
+    with np.errstate(divide='ignore', invalid='ignore'):
+        R = np.minimum((s ** 2 + c ** 2) ** .5, 1)  # rounding can push identical angles just past 1
+        V = 1 - R
+        sd = np.degrees((-2 * np.log(R)) ** .5) / 2
     # sd = np.degrees((2*V)**.5)
     # t = np.arctan2(s, c)
     # strike = R*math.e**(math.i*t)
     strike = np.arctan2(s, c) / 2
     theta = 90 - np.degrees(strike)
-    if theta < 0:
-        theta = 180 + theta
-    elif theta > 180:
-        theta = theta - 180
-    return theta, sd;
+    theta = np.where(theta < 0, 180 + theta, np.where(theta > 180, theta - 180, theta));
+    return theta[()], np.asarray(sd)[()];
 
 
 def mask_by_value(outdir, grid1, grid2, cutoff_value):
     # grid1 = usually azimuth deviations
     # grid2 = usually I2nd
+    from Tectonic_Utils.read_write import netcdf_read_write
     lon1, lat1, val1 = netcdf_read_write.read_any_grd(outdir+"/deviations_"+grid1+".nc");
     lon2, lat2, val2 = netcdf_read_write.read_any_grd(outdir+"/means_"+grid2+".nc");
-    masked_vals = np.zeros(np.shape(val2));
-    for i in range(len(lon1)):
-        for j in range(len(lat1)):
-            if abs(val2[j][i]) > cutoff_value:
-                masked_vals[j][i] = val1[j][i];
-            else:
-                masked_vals[j][i] = np.nan;
+    masked_vals = mask_values(val1, val2, cutoff_value);
     netcdf_read_write.produce_output_netcdf(lon1, lat1, masked_vals, 'per yr', outdir+"/deviations_"+grid1+".nc");
     return;
+
+
+def mask_values(val1, val2, cutoff_value):
+    # Keep val1 where abs(val2) exceeds the cutoff; nan elsewhere
+    with np.errstate(invalid='ignore'):
+        return np.where(np.abs(val2) > cutoff_value, val1, np.nan);
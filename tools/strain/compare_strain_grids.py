@@ -1,73 +1,137 @@
 import os
+from concurrent.futures import ThreadPoolExecutor
 from . import compare_grd_functions as comp
-from Tectonic_Utils.read_write import netcdf_read_write
+from . import configure_functions, streaming_comparison, regrid, strain_tensor_toolbox, output_manager
+
+# The compared quantities and the statistics used for each
+QUANTITIES = [("I2nd.nc", comp.grid_means_log), ("max_shear.nc", comp.grid_means_stds),
+              ("dila.nc", comp.grid_means_stds), ("rot.nc", comp.grid_means_stds), ("azimuth.nc", comp.angle_means)];
 
 
 def drive(MyParams):
+    compare_options = configure_functions.get_compare_options(MyParams.compare_options);
+    if compare_options['streaming']:
+        drive_streaming(MyParams, compare_options);
+        return;
     print("Comparing across all strain methods");
-    compare_second_invariants(MyParams, "I2nd.nc");
-    compare_max_shear(MyParams, "max_shear.nc");
-    compare_dilatation(MyParams, "dila.nc");
-    compare_rotation(MyParams, "rot.nc");
-    compare_azimuth(MyParams, "azimuth.nc");
-    return;
-
-
-def compare_second_invariants(MyParams, filename):
-    strain_values_dict, lons, lats = read_strain_files(MyParams, filename);
-    my_means, my_stds = comp.grid_means_log(strain_values_dict)
-    write_means_stds(lons, lats, my_means, my_stds, MyParams.outdir, filename);
-    return;
-
-
-def compare_max_shear(MyParams, filename):
-    strain_values_dict, lons, lats = read_strain_files(MyParams, filename);
-    my_means, my_stds = comp.grid_means_stds(strain_values_dict)
-    write_means_stds(lons, lats, my_means, my_stds, MyParams.outdir, filename);
-    return;
-
-
-def compare_dilatation(MyParams, filename):
-    strain_values_dict, lons, lats = read_strain_files(MyParams, filename);
-    my_means, my_stds = comp.grid_means_stds(strain_values_dict);
-    #     comp.mask_by_value(outdir, "dila", "dila", 15);
-    write_means_stds(lons, lats, my_means, my_stds, MyParams.outdir, filename);
+    filenames = [filename for filename, _ in QUANTITIES];
+    all_values = read_all_strain_files(MyParams, filenames, compare_options['workers']);
+    regrid_all(MyParams, all_values, compare_options['regrid_method']);
+    lons, lats, results = compare_all(MyParams, all_values);
+    for filename in filenames:
+        write_means_stds(lons, lats, results[filename][0], results[filename][1], MyParams.outdir, filename);
     return;
 
 
-def compare_rotation(MyParams, filename):
-    strain_values_dict, lons, lats = read_strain_files(MyParams, filename);
-    my_means, my_stds = comp.grid_means_stds(strain_values_dict);
-    write_means_stds(lons, lats, my_means, my_stds, MyParams.outdir, filename);
+def compare_all(MyParams, all_values):
+    """
+    Validate co-registration once, then compute every statistic in memory.
+    all_values: {filename: {method: [lon, lat, val]}}
+    Returns lons, lats, {filename: [means, stds]}, with the azimuth deviations masked where I2nd is small.
+    """
+    comp.defensive_programming(MyParams, {method + " " + filename: all_values[filename][method]
+                                          for filename in all_values.keys() for method in all_values[filename].keys()});
+    first_filename = list(all_values.keys())[0];
+    first_method = list(all_values[first_filename].keys())[0];
+    lons, lats = all_values[first_filename][first_method][0], all_values[first_filename][first_method][1];
+    results = {};
+    for filename, statistic_function in QUANTITIES:
+        if filename in all_values:
+            results[filename] = list(statistic_function(all_values[filename]));
+    if "azimuth.nc" in results and "I2nd.nc" in results:
+        results["azimuth.nc"][1] = comp.mask_values(results["azimuth.nc"][1], results["I2nd.nc"][0], 3);
+    return lons, lats, results;
+
+
+def drive_in_memory(MyParams, strain_results):
+    """
+    Compare results that are already in memory, such as the methods of an ensemble run, without reading any files.
+    strain_results: {method: [lons, lats, rot, exx, exy, eyy]}
+    """
+    print("Comparing across all strain methods, in memory");
+    all_values = strain_results_to_values(strain_results);
+    compare_options = configure_functions.get_compare_options(MyParams.compare_options);
+    regrid_all(MyParams, all_values, compare_options['regrid_method']);
+    lons, lats, results = compare_all(MyParams, all_values);
+    for filename in all_values.keys():
+        write_means_stds(lons, lats, results[filename][0], results[filename][1], MyParams.outdir, filename);
     return;
 
 
-def compare_azimuth(MyParams, filename):
-    strain_values_dict, lons, lats = read_strain_files(MyParams, filename);
-    my_means, my_stds = comp.angle_means(strain_values_dict)
-    write_means_stds(lons, lats, my_means, my_stds, MyParams.outdir, filename);
+def strain_results_to_values(strain_results):
+    # {method: [lons, lats, rot, exx, exy, eyy]} -> {filename: {method: [lon, lat, val]}}, as read from the grids
+    all_values = {filename: {} for filename, _ in QUANTITIES};
+    for method in strain_results.keys():
+        [lons, lats, rot, exx, exy, eyy] = strain_results[method];
+        derived = strain_tensor_toolbox.derived_quantities_kernel(exx, exy, eyy, ['I2nd', 'max_shear', 'dilatation',
+                                                                                  'azimuth']);
+        grids = {"I2nd.nc": derived['I2nd'], "max_shear.nc": derived['max_shear'], "dila.nc": derived['dilatation'],
+                 "rot.nc": rot, "azimuth.nc": derived['azimuth']};
+        for filename in all_values.keys():
+            all_values[filename][method] = [lons, lats, grids[filename]];
+    return all_values;
+
+
+def drive_streaming(MyParams, compare_options):
+    # Same products as drive(), reading the grids of all runs a block of rows at a time
+    print("Comparing across all strain methods, streaming");
+    for filename, statistic in [("I2nd.nc", 'log'), ("max_shear.nc", 'linear'), ("dila.nc", 'linear'),
+                                ("rot.nc", 'linear'), ("azimuth.nc", 'angle')]:
+        streaming_comparison.compare_streaming(MyParams, filename, statistic, compare_options['block_rows'],
+                                               compare_options['percentiles'], compare_options['regrid_method']);
     comp.mask_by_value(MyParams.outdir, "azimuth", "I2nd", 3);
     return;
 
 
-def read_strain_files(MyParams, filename):
-    # Read strain quantities and guarantee their co-registration
-    strain_values_dict = {};
-    for method in MyParams.strain_dict.keys():
-        specific_filename = MyParams.strain_dict[method]+"/"+filename
-        if os.path.isfile(specific_filename):
-            [lon, lat, val] = netcdf_read_write.read_any_grd(specific_filename);
-            strain_values_dict[method] = [lon, lat, val];
-        else:
-            raise("Error! Can't find file %s " % specific_filename);
-    comp.defensive_programming(MyParams, strain_values_dict);
-    method1 = list(strain_values_dict.keys())[0];
-    lons = strain_values_dict[method1][0];
-    lats = strain_values_dict[method1][1];
-    return strain_values_dict, lons, lats;
+def read_all_strain_files(MyParams, filenames, workers=4):
+    # Read every quantity of every method once, with the files loaded concurrently
+    # Returns {filename: {method: [lon, lat, val]}}
+    jobs = [(filename, method) for filename in filenames for method in MyParams.strain_dict.keys()];
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        grids = list(executor.map(lambda job: read_strain_grid(MyParams.strain_dict[job[1]], job[0]), jobs));
+    all_values = {filename: {} for filename in filenames};
+    for (filename, method), grid in zip(jobs, grids):
+        all_values[filename][method] = grid;
+    return all_values;
+
+
+def regrid_all(MyParams, all_values, regrid_method):
+    # Resample any input that is not on the comparison grid; each distinct source grid is indexed once
+    target_lon, target_lat = regrid.target_axes(MyParams.range_strain, MyParams.inc);
+    index_cache = {};
+    for filename in all_values.keys():
+        regrid.regrid_strain_values(all_values[filename], target_lon, target_lat, regrid_method, index_cache,
+                                    regrid.is_axial(filename));
+    return all_values;
+
+
+def read_strain_grid(directory, filename):
+    # One quantity of one method: the separate grd file if present, otherwise the variable of the combined file
+    specific_filename = directory+"/"+filename;
+    combined_filename = directory+"/"+output_manager.COMBINED_FILENAME;
+    if os.path.isfile(specific_filename):
+        from Tectonic_Utils.read_write import netcdf_read_write
+        return netcdf_read_write.read_any_grd(specific_filename);
+    elif os.path.isfile(combined_filename):
+        return read_combined_variable(combined_filename, filename.replace('.nc', ''));
+    else:
+        raise Exception("Error! Can't find file %s " % specific_filename);
+
+
+def read_combined_variable(combined_filename, variable):
+    # Read one variable from a combined strain netcdf. Only that variable is loaded from disk.
+    import xarray as xr
+    with xr.open_dataset(combined_filename, engine='netcdf4') as ds:
+        if variable not in ds.data_vars:
+            raise Exception("Error! Can't find variable %s in %s " % (variable, combined_filename));
+        lon = ds['x'].values;
+        lat = ds['y'].values;
+        val = ds[variable].values.astype(float);
+    return [lon, lat, val];
 
 
 def write_means_stds(lons, lats, means, stds, outdir, filename):
+    from Tectonic_Utils.read_write import netcdf_read_write
     netcdf_read_write.produce_output_netcdf(lons, lats, means, 'per year', outdir+"/means_"+filename);
     netcdf_read_write.produce_output_netcdf(lons, lats, stds, 'per year', outdir+"/deviations_"+filename);
     return;
@@ -1,14 +1,61 @@
-import subprocess, sys, os
+import sys, os
+import shutil
 import collections
 import configparser
+import itertools
+import numpy as np
 
 Params = collections.namedtuple("Params", ['strain_method', 'input_file', 'range_strain', 'range_data',
-                                           'inc', 'outdir', 'method_specific']);
-Comps_Params = collections.namedtuple("Comps_Params", ['range_strain', 'inc', 'strain_dict', 'outdir']);
+                                           'inc', 'outdir', 'method_specific', 'output_options', 'input_options',
+                                           'ensemble_options', 'cache_options', 'report_options'],
+                                defaults=(None, None, None, None, None));
+Comps_Params = collections.namedtuple("Comps_Params", ['range_strain', 'inc', 'strain_dict', 'outdir',
+                                                       'compare_options'], defaults=(None,));
 
 help_message = "  Welcome to a geodetic strain calculator.\n" \
-               "  USAGE: strain_driver.py config.txt\n" \
+               "  USAGE: strain_driver.py config.txt [--force]\n" \
+               "  --force: recompute, even if the result cache has this run\n" \
                "  See repository source for an example config file.\n"
+# Optional [input] section of the config file
+# format: stationvels (the simple text format), midas, nam08, or auto (guess from the file name)
+# cache: keep a binary copy of the velocity file next to it, reused while the file is unchanged
+# merge_distance: stations closer than this (km) are treated as colocated; 0 catches exact duplicates only
+# merge_policy: colocated stations are averaged ('mean'), inverse-variance averaged ('weighted'),
+#               or reduced to their best-constrained station ('drop')
+# invalid: 'raise' on zero/NaN uncertainties or non-finite velocities, or 'drop' those stations
+INPUT_DEFAULTS = {'format': 'stationvels', 'cache': False, 'merge_distance': 0.0, 'merge_policy': 'weighted',
+                  'invalid': 'raise'};
+INPUT_FORMATS = ['stationvels', 'midas', 'nam08', 'auto'];
+MERGE_POLICIES = ['mean', 'weighted', 'drop'];
+INVALID_POLICIES = ['raise', 'drop'];
+# Optional [cache] section of the config file: a result cache keyed on the cleaned velocities and the parameters
+# enabled: reuse the strain grids of an identical earlier run; directory: where they are kept
+# max_size_mb: least recently used results are evicted beyond this size; force: always recompute (also --force)
+CACHE_DEFAULTS = {'enabled': False, 'directory': os.path.join(os.path.expanduser('~'), '.cache', 'Strain_2D'),
+                  'max_size_mb': 1024, 'force': False};
+# Optional [report] section of the config file: a JSON report of the time and memory of each stage of a run
+# enabled: write run_report.json into the output directory; trace_memory: also record the peak Python allocations
+# of each stage (tracemalloc, slower); profile: write a cProfile dump of each top-level stage
+REPORT_DEFAULTS = {'enabled': True, 'trace_memory': False, 'profile': False};
+# Optional [output] section of the config file
+# format: 'separate' (one grd file per quantity), 'combined' (one compressed multi-variable netcdf), or 'both'
+# eigs_dec: draw eigenvectors on every eigs_dec'th grid node; write_eigs: also write them as text files
+OUTPUT_DEFAULTS = {'format': 'separate', 'float32': False, 'complevel': 4, 'chunk': 256,
+                   'eigs_dec': 12, 'write_eigs': True};
+OUTPUT_FORMATS = ['separate', 'combined', 'both'];
+# Ensembles: a comma-separated list of methods in [general] method runs them all on one validated velocity field.
+# Optional [ensemble] section:
+# workers: processes running methods at once (0: one per method, up to the number of CPUs; 1: run in this process)
+# compare: pass the results straight to the comparison statistics, written into compare_dir inside output_dir
+ENSEMBLE_DEFAULTS = {'workers': 0, 'compare': False, 'compare_dir': 'means'};
+# Optional [compare] section of the comparison config file
+# streaming: read the input grids a block of rows at a time (for large ensembles of runs)
+# block_rows: rows per block; percentiles: comma-separated percentiles to write in streaming mode, e.g. 5,50,95
+# workers: threads used to load the input grids
+# regrid_method: bilinear or nearest resampling of inputs that are not on the comparison grid; 'none' to refuse them
+COMPARE_DEFAULTS = {'streaming': False, 'block_rows': 256, 'percentiles': (), 'workers': 4,
+                    'regrid_method': 'bilinear'};
+REGRID_METHODS = ['none', 'bilinear', 'nearest'];
 comps_help_message = "  Welcome to a geodetic strain-rate comparison tool.\n" \
                      "  USAGE: compare_driver config.txt\n" \
                      "  See repository source for an example config file.\n"
@@ -27,8 +74,10 @@ def strain_config_parser(cmdargs=None, configfile=None):
             configfile = cmdargs[1];
 
     MyParams = parse_config_file_into_Params(configfile);
-    subprocess.call(['mkdir', '-p', MyParams.outdir], shell=False);
-    subprocess.call(['cp', configfile, MyParams.outdir], shell=False);
+    if cmdargs and '--force' in cmdargs[2:]:
+        MyParams = MyParams._replace(cache_options=dict(MyParams.cache_options, force=True));
+    os.makedirs(MyParams.outdir, exist_ok=True);
+    shutil.copy(configfile, MyParams.outdir);
 
     print("\n------------------------------");
     print("Hello! We are...");
@@ -51,8 +100,8 @@ def comparison_config_parser(args=None, configfile=None):
                 sys.exit(0);
             configfile = args[1];
     MyParams = parse_comparison_config_into_Params(configfile);
-    subprocess.call(['mkdir', '-p', MyParams.outdir], shell=False);
-    subprocess.call(['cp', configfile, MyParams.outdir], shell=False);
+    os.makedirs(MyParams.outdir, exist_ok=True);
+    shutil.copy(configfile, MyParams.outdir);
     print("\n------------------------------");
     print("Hello! We are comparing strain calculations...");
     print("   Comparing strain from calculations : \n  %s " % MyParams.strain_dict);
@@ -78,21 +127,129 @@ def parse_config_file_into_Params(configfile):
         range_data = range_strain;
 
     # Reading the method-specific stuff
-    specific_keys = [item for item in config[strain_method].keys()];
+    methods = get_method_list(strain_method);
     method_specific = {};
-    for item in specific_keys:
-        method_specific[item] = config.get(strain_method, item);
+    for method in methods:
+        method_specific[method] = {};
+        for item in config[method].keys():
+            method_specific[method][item] = config.get(method, item);
+    ensemble_options = None;
+    if len(methods) > 1:
+        strain_method = ','.join(methods);
+        ensemble_options = {};
+        if config.has_section('ensemble'):
+            for item in config['ensemble'].keys():
+                ensemble_options[item] = config.get('ensemble', item);
+        ensemble_options = get_ensemble_options(ensemble_options);
+        for method in methods:
+            if swept_keys(method_specific[method]):
+                raise ValueError("Error! Parameter sweeps are run one method at a time, not in an ensemble.");
+    else:
+        method_specific = method_specific[strain_method];
+
+    output_options = {};
+    if config.has_section('output'):
+        for item in config['output'].keys():
+            output_options[item] = config.get('output', item);
+    report_options = {};
+    if config.has_section('report'):
+        for item in config['report'].keys():
+            report_options[item] = config.get('report', item);
+    cache_options = {};
+    if config.has_section('cache'):
+        for item in config['cache'].keys():
+            cache_options[item] = config.get('cache', item);
+    input_options = {};
+    if config.has_section('input'):
+        for item in config['input'].keys():
+            input_options[item] = config.get('input', item);
 
     # Cleanup
-    output_dir = output_dir + '/' + strain_method + '/'
+    output_dir = output_dir + '/' if ensemble_options else output_dir + '/' + strain_method + '/'
     range_strain = get_float_range(range_strain);
     range_data = get_float_range(range_data);
     inc = get_float_inc(inc);
+    output_options = get_output_options(output_options);
+    input_options = get_input_options(input_options);
+    cache_options = get_cache_options(cache_options);
+    report_options = get_report_options(report_options);
     MyParams = Params(strain_method=strain_method, input_file=input_file, range_strain=range_strain,
-                      range_data=range_data, inc=inc, outdir=output_dir, method_specific=method_specific);
+                      range_data=range_data, inc=inc, outdir=output_dir, method_specific=method_specific,
+                      output_options=output_options, input_options=input_options,
+                      ensemble_options=ensemble_options, cache_options=cache_options,
+                      report_options=report_options);
     return MyParams;
 
 
+def get_sweep_values(string_value):
+    """
+    The values of one method-specific config key, for parameter sweeps.
+    '13, 15, 20' is a list and '50:100:25' an inclusive start:stop:step range; anything else is a single value.
+    Only numeric lists and ranges are expanded.
+    """
+    parts = [x.strip() for x in string_value.split(':')];
+    if len(parts) == 3 and all([is_number(x) for x in parts]):
+        [start, stop, step] = [float(x) for x in parts];
+        if step <= 0 or stop < start:
+            raise ValueError("Error! Bad sweep range %s; use start:stop:step with step > 0" % string_value);
+        nvalues = int(np.floor((stop - start) / step + 1e-9)) + 1;
+        return ["%g" % (start + i * step) for i in range(nvalues)];
+    values = [x.strip() for x in string_value.split(',')];
+    if len(values) > 1 and all([is_number(x) for x in values]):
+        return values;
+    return [string_value];
+
+
+def is_number(string_value):
+    try:
+        float(string_value);
+    except ValueError:
+        return False;
+    return True;
+
+
+def sweep_combinations(method_specific):
+    # Every combination of the swept values of a method-specific dictionary, as a list of dictionaries
+    keys = list(method_specific.keys());
+    values = [get_sweep_values(method_specific[key]) for key in keys];
+    return [dict(zip(keys, combination)) for combination in itertools.product(*values)];
+
+
+def swept_keys(method_specific):
+    return [key for key in method_specific.keys() if len(get_sweep_values(method_specific[key])) > 1];
+
+
+def is_sweep(MyParams):
+    return not is_ensemble(MyParams) and len(swept_keys(MyParams.method_specific)) > 0;
+
+
+def get_method_list(strain_method):
+    # 'delaunay, huang' -> ['delaunay', 'huang']
+    return [x.strip() for x in strain_method.split(',') if x.strip() != ''];
+
+
+def is_ensemble(MyParams):
+    return len(get_method_list(MyParams.strain_method)) > 1;
+
+
+def ensemble_member_params(MyParams):
+    # One single-method Params per method of an ensemble, each writing into its own output_dir/method/
+    members = [];
+    for method in get_method_list(MyParams.strain_method):
+        members.append(MyParams._replace(strain_method=method, outdir=MyParams.outdir + method + '/',
+                                         method_specific=MyParams.method_specific[method], ensemble_options=None));
+    return members;
+
+
+def ensemble_comparison_params(MyParams, members):
+    # Comparison parameters for the in-memory comparison of an ensemble's results
+    ensemble_options = get_ensemble_options(MyParams.ensemble_options);
+    return Comps_Params(range_strain=MyParams.range_strain, inc=MyParams.inc,
+                        strain_dict={member.strain_method: member.outdir for member in members},
+                        outdir=MyParams.outdir + ensemble_options['compare_dir'] + '/',
+                        compare_options=get_compare_options());
+
+
 def parse_comparison_config_into_Params(configfile):
     # Dedicated file to building a valid Params structure from the comps configfile
     if not os.path.isfile(configfile):
@@ -110,10 +267,113 @@ def parse_comparison_config_into_Params(configfile):
     strain_dict = {};
     for item in specific_keys:
         strain_dict[item] = config.get("inputs", item);
-    MyParams = Comps_Params(inc=inc, range_strain=range_strain, outdir=output_dir, strain_dict=strain_dict);
+    compare_options = {};
+    if config.has_section('compare'):
+        for item in config['compare'].keys():
+            compare_options[item] = config.get('compare', item);
+    compare_options = get_compare_options(compare_options);
+    MyParams = Comps_Params(inc=inc, range_strain=range_strain, outdir=output_dir, strain_dict=strain_dict,
+                            compare_options=compare_options);
     return MyParams;
 
 
+def get_input_options(input_options=None):
+    """ Fill in the defaults for the [input] options, and convert the strings from the config file """
+    options = dict(INPUT_DEFAULTS);
+    if input_options:
+        options.update(input_options);
+    if isinstance(options['cache'], str):
+        options['cache'] = options['cache'].strip().lower() in ['true', 'yes', '1'];
+    if options['format'] not in INPUT_FORMATS:
+        raise ValueError("Error! Velocity format %s not supported. Choose from %s" % (options['format'], INPUT_FORMATS));
+    options['merge_distance'] = float(options['merge_distance']);
+    if options['merge_distance'] < 0:
+        raise ValueError("Error! merge_distance cannot be negative.");
+    if options['merge_policy'] not in MERGE_POLICIES:
+        raise ValueError("Error! Merge policy %s not supported. Choose from %s" % (options['merge_policy'],
+                                                                                  MERGE_POLICIES));
+    if options['invalid'] not in INVALID_POLICIES:
+        raise ValueError("Error! Invalid-station policy %s not supported. Choose from %s" % (options['invalid'],
+                                                                                            INVALID_POLICIES));
+    return options;
+
+
+def get_ensemble_options(ensemble_options=None):
+    """ Fill in the defaults for the [ensemble] options, and convert the strings from the config file """
+    options = dict(ENSEMBLE_DEFAULTS);
+    if ensemble_options:
+        options.update(ensemble_options);
+    if isinstance(options['compare'], str):
+        options['compare'] = options['compare'].strip().lower() in ['true', 'yes', '1'];
+    options['workers'] = int(options['workers']);
+    if options['workers'] < 0:
+        raise ValueError("Error! Number of ensemble workers cannot be negative.");
+    return options;
+
+
+def get_cache_options(cache_options=None):
+    """ Fill in the defaults for the [cache] options, and convert the strings from the config file """
+    options = dict(CACHE_DEFAULTS);
+    if cache_options:
+        options.update(cache_options);
+    for key in ['enabled', 'force']:
+        if isinstance(options[key], str):
+            options[key] = options[key].strip().lower() in ['true', 'yes', '1'];
+    options['directory'] = os.path.expanduser(options['directory']);
+    options['max_size_mb'] = float(options['max_size_mb']);
+    if options['max_size_mb'] <= 0:
+        raise ValueError("Error! Cache max_size_mb must be positive.");
+    return options;
+
+
+def get_report_options(report_options=None):
+    """ Fill in the defaults for the [report] options, and convert the strings from the config file """
+    options = dict(REPORT_DEFAULTS);
+    if report_options:
+        options.update(report_options);
+    for key in ['enabled', 'trace_memory', 'profile']:
+        if isinstance(options[key], str):
+            options[key] = options[key].strip().lower() in ['true', 'yes', '1'];
+    return options;
+
+
+def get_output_options(output_options=None):
+    """ Fill in the defaults for the [output] options, and convert the strings from the config file """
+    options = dict(OUTPUT_DEFAULTS);
+    if output_options:
+        options.update(output_options);
+    if options['format'] not in OUTPUT_FORMATS:
+        raise ValueError("Error! Output format %s not supported. Choose from %s" % (options['format'], OUTPUT_FORMATS));
+    for key in ['float32', 'write_eigs']:
+        if isinstance(options[key], str):
+            options[key] = options[key].strip().lower() in ['true', 'yes', '1'];
+    for key in ['complevel', 'chunk', 'eigs_dec']:
+        options[key] = int(options[key]);
+    if options['eigs_dec'] < 1:
+        raise ValueError("Error! eigs_dec must be a positive integer, got %d" % options['eigs_dec']);
+    return options;
+
+
+def get_compare_options(compare_options=None):
+    """ Fill in the defaults for the [compare] options, and convert the strings from the config file """
+    options = dict(COMPARE_DEFAULTS);
+    if compare_options:
+        options.update(compare_options);
+    if isinstance(options['streaming'], str):
+        options['streaming'] = options['streaming'].strip().lower() in ['true', 'yes', '1'];
+    options['block_rows'] = int(options['block_rows']);
+    options['workers'] = int(options['workers']);
+    if isinstance(options['percentiles'], str):
+        options['percentiles'] = [float(x) for x in options['percentiles'].split(',') if x.strip() != ''];
+    if options['regrid_method'] not in REGRID_METHODS:
+        raise ValueError("Error! Regrid method %s not supported. Choose from %s" % (options['regrid_method'],
+                                                                                    REGRID_METHODS));
+    for p in options['percentiles']:
+        if not 0 <= p <= 100:
+            raise ValueError("Error! Percentiles must be between 0 and 100, got %f" % p);
+    return options;
+
+
 def get_float_range(string_range):
     # string range: format "-125/-121/32/35"
     # float range: array of floats
@@ -1,26 +1,29 @@
 # The input manager for GPS Strain analysis. 
 
-from . import velocity_io
+import os
+from . import velocity_io, configure_functions, validation, instrumentation, api
 
 # ----------------- INPUTS -------------------------
 def inputs(MyParams):
     print("------------------------------");
     # Purpose: generate input velocity field.
-    myVelfield = velocity_io.read_stationvels(MyParams.input_file);
-    myVelfield = clean_velfield(myVelfield, coord_box=MyParams.range_data);
-    if len(myVelfield) == 0:
-        raise ValueError("Error! Velocity field has no velocities.");
-    for item in myVelfield:
-        if item.se == 0 or item.sn == 0 or item.su == 0:
-            raise ValueError("Error! Velocity uncertainty cannot be zero.");
+    input_options = configure_functions.get_input_options(MyParams.input_options);
+    with instrumentation.stage('read'):
+        myVelfield = velocity_io.read_velocity_file(MyParams.input_file, file_format=input_options['format'],
+                                                    coord_box=MyParams.range_data, use_cache=input_options['cache']);
+    print("{} stations before applying cleaning.".format(len(myVelfield)));
+    with instrumentation.stage('validate'):
+        [myVelfield, summary] = api.clean_velocities(myVelfield, MyParams);
+    print("%d stations after selection criteria.\n" % (len(myVelfield)));
+    if os.path.isdir(MyParams.outdir):
+        validation.write_summary(summary, MyParams.outdir);
     return myVelfield;
 
 
 def clean_velfield(myVelfield, coord_box=(-180, 180, -90, 90)):
+    # Returns a VelocityField of the stations inside coord_box
+    myVelfield = velocity_io.as_velocity_field(myVelfield);
     print("{} stations before applying cleaning.".format(len(myVelfield)));
-    select_velfield = [];
-    for station_vel in myVelfield:
-        if (coord_box[0] < station_vel.elon < coord_box[1]) and (coord_box[2] < station_vel.nlat < coord_box[3]):
-            select_velfield.append(station_vel);
+    select_velfield = myVelfield.select_box(coord_box);
     print("%d stations after selection criteria.\n" % (len(select_velfield)));
     return select_velfield;
@@ -0,0 +1,139 @@
+# Per-stage timing and memory instrumentation of a strain run.
+# Stages are marked with `with instrumentation.stage('name'):` anywhere in the pipeline, including inside models.
+# While a run report is active, each stage records its wall time, CPU time, and memory; nested stages are
+# recorded with their full path (e.g. compute/triangulation). With no active report, stages cost almost nothing.
+# At the end of a run the report is written as JSON into the output directory, with optional cProfile dumps.
+
+import contextlib
+import cProfile
+import datetime
+import json
+import os
+import sys
+import time
+import tracemalloc
+try:
+    import resource  # not available on Windows
+except ImportError:
+    resource = None;
+
+REPORT_FILENAME = 'run_report.json';
+_active_reports = [];  # a stack, so a run started inside another run (e.g. an ensemble member) reports separately
+_active_profiler = None;  # only one cProfile can be enabled at a time; stages of nested runs are not profiled
+
+
+class RunReport:
+    """
+    Stage records of one run.
+    trace_memory: also record the peak of Python allocations in each stage (tracemalloc; slows the run down)
+    profile: dump a cProfile of each top-level stage as profile_<stage>.prof, unless another report's stage is
+             already being profiled (a run nested inside a profiled stage is part of that stage's profile)
+    """
+    def __init__(self, outdir, description='', trace_memory=False, profile=False):
+        self.outdir = outdir;
+        self.description = description;
+        self.trace_memory = trace_memory;
+        self.profile = profile;
+        self.stages = [];
+        self._path = [];
+        self._peaks = [];  # traced peak so far of each open stage
+        self._started_tracing = False;
+        self.started = datetime.datetime.now().isoformat(timespec='seconds');
+        self._wall_start = time.perf_counter();
+        self._cpu_start = time.process_time();
+
+    def start(self):
+        if self.trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start();
+            self._started_tracing = True;
+        return;
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        global _active_profiler;
+        self._path.append(name);
+        profiler = None;
+        if self.profile and len(self._path) == 1 and _active_profiler is None:
+            profiler = cProfile.Profile();
+            profiler.enable();
+            _active_profiler = profiler;
+        if self.trace_memory:
+            if self._peaks:
+                self._peaks[-1] = max(self._peaks[-1], tracemalloc.get_traced_memory()[1]);
+            tracemalloc.reset_peak();
+            self._peaks.append(0);
+        wall_start, cpu_start = time.perf_counter(), time.process_time();
+        try:
+            yield;
+        finally:
+            record = {'stage': '/'.join(self._path), 'wall_s': time.perf_counter() - wall_start,
+                      'cpu_s': time.process_time() - cpu_start, 'max_rss_mb': max_rss_mb()};
+            if self.trace_memory:
+                peak = max(self._peaks.pop(), tracemalloc.get_traced_memory()[1]);
+                record['traced_peak_mb'] = peak / 1e6;
+                if self._peaks:
+                    self._peaks[-1] = max(self._peaks[-1], peak);
+                tracemalloc.reset_peak();
+            if profiler is not None:
+                profiler.disable();
+                _active_profiler = None;
+                record['profile'] = profile_filename(self.outdir, name);
+                profiler.dump_stats(record['profile']);
+            self.stages.append(record);
+            self._path.pop();
+        return;
+
+    def summary(self):
+        return {'description': self.description, 'started': self.started,
+                'wall_s': time.perf_counter() - self._wall_start, 'cpu_s': time.process_time() - self._cpu_start,
+                'max_rss_mb': max_rss_mb(), 'python': sys.version.split()[0], 'pid': os.getpid(),
+                'stages': self.stages};
+
+    def write(self):
+        if self._started_tracing:
+            tracemalloc.stop();
+        filename = os.path.join(self.outdir, REPORT_FILENAME);
+        print("Writing run report to %s " % filename);
+        with open(filename, 'w') as ofile:
+            json.dump(self.summary(), ofile, indent=2);
+        return filename;
+
+
+def max_rss_mb():
+    # High-water mark of the resident memory of this process, in MB (None where unavailable)
+    if resource is None:
+        return None;
+    scale = 1e6 if sys.platform == 'darwin' else 1e3;  # bytes on macOS, kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale;
+
+
+def profile_filename(outdir, stage_name):
+    return os.path.join(outdir, 'profile_%s.prof' % stage_name.replace('/', '_').replace(' ', '_'));
+
+
+@contextlib.contextmanager
+def run_report(outdir, report_options, description=''):
+    """
+    Record the stages of everything run inside this block, and write the report into outdir at the end.
+    report_options: from configure_functions.get_report_options; does nothing unless report_options['enabled'].
+    """
+    if not report_options['enabled']:
+        yield None;
+        return;
+    report = RunReport(outdir, description, report_options['trace_memory'], report_options['profile']);
+    report.start();
+    _active_reports.append(report);
+    try:
+        yield report;
+    finally:
+        _active_reports.remove(report);
+        if os.path.isdir(outdir):
+            report.write();
+    return;
+
+
+def stage(name):
+    # Context manager recording one stage in the active report; a no-op when there is none
+    if not _active_reports:
+        return contextlib.nullcontext();
+    return _active_reports[-1].stage(name);
@@ -1,24 +1,121 @@
 """
 Driver program for strain calculation
 """
-import importlib
-from . import input_manager, output_manager
-
-
-def get_model(model_name):
-    """ Return an instance of the model model_name.
-        Dynamic module discovery. """
-    module_name = 'Strain_2D.tools.strain.models.strain_' + model_name.lower()
-    model_module = importlib.import_module(module_name)
-    obj = getattr(model_module, model_name)
-    return module_name, obj
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from . import input_manager, output_manager, configure_functions, compare_strain_grids, result_cache
+from . import instrumentation, api
 
 
 def strain_coordinator(MyParams):
-    velField = input_manager.inputs(MyParams);
-    module_name, strain_model = get_model(MyParams.strain_method);
-    constructed_object = strain_model(MyParams);   # calling the constructor, building strain model from our params
-    [lons, lats, rot, exx, exy, eyy] = constructed_object.compute(velField);  # computing strain
-    # constructed_object.outputs_special();
-    output_manager.outputs_2d(lons, lats, rot, exx, exy, eyy, MyParams, velField);  # 2D grid output format
+    # Every stage of the run is timed into run_report.json in the output directory (see [report] in the config)
+    report_options = configure_functions.get_report_options(MyParams.report_options);
+    with instrumentation.run_report(MyParams.outdir, report_options, MyParams.strain_method):
+        if configure_functions.is_ensemble(MyParams):
+            ensemble_coordinator(MyParams);
+        elif configure_functions.is_sweep(MyParams):
+            sweep_coordinator(MyParams);
+        else:
+            with instrumentation.stage('inputs'):
+                velField = input_manager.inputs(MyParams);
+            run_strain_method(MyParams, velField);
     return
+
+
+def run_strain_method(MyParams, velField):
+    # Compute and write the outputs of one method; returns [lons, lats, rot, exx, exy, eyy]
+    cache_options = configure_functions.get_cache_options(MyParams.cache_options);
+    uncertainties = {};  # uncertainty and chi2 grids, for methods that report them
+    with instrumentation.stage('compute'):
+        [[lons, lats, rot, exx, exy, eyy], _] = result_cache.cached_compute(
+            MyParams, velField, lambda: api.compute_grids(MyParams, velField, uncertainties),
+            cache_options, uncertainties);  # computing strain, or reusing an identical earlier run
+    with instrumentation.stage('outputs'):
+        output_manager.outputs_2d(lons, lats, rot, exx, exy, eyy, MyParams, velField,
+                                  uncertainties);  # 2D grid output format
+    return [lons, lats, rot, exx, exy, eyy];
+
+
+def run_ensemble_member(MyParams, velField):
+    # run_strain_method for one method of an ensemble, with its own run report in its output directory
+    report_options = configure_functions.get_report_options(MyParams.report_options);
+    with instrumentation.run_report(MyParams.outdir, report_options, MyParams.strain_method):
+        return run_strain_method(MyParams, velField);
+
+
+def ensemble_coordinator(MyParams):
+    """
+    Run every method of an ensemble on one velocity field, read and validated once.
+    Methods run concurrently in separate processes, each writing into output_dir/method/.
+    With compare = True in [ensemble], the results go straight to the comparison statistics.
+    Returns {method: [lons, lats, rot, exx, exy, eyy]}.
+    """
+    ensemble_options = configure_functions.get_ensemble_options(MyParams.ensemble_options);
+    with instrumentation.stage('inputs'):
+        velField = input_manager.inputs(MyParams);
+    members = configure_functions.ensemble_member_params(MyParams);
+    for member in members:
+        os.makedirs(member.outdir, exist_ok=True);
+    workers = ensemble_options['workers'] or min(len(members), os.cpu_count() or 1);
+    print("Running %d methods with %d workers: %s" % (len(members), workers, MyParams.strain_method));
+    results = {};
+    with instrumentation.stage('methods'):
+        if workers == 1:
+            for member in members:
+                results[member.strain_method] = run_ensemble_member(member, velField);
+        else:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                futures = {member.strain_method: executor.submit(run_ensemble_member, member, velField)
+                           for member in members};
+                for method in futures.keys():
+                    results[method] = futures[method].result();
+    if ensemble_options['compare']:
+        CompParams = configure_functions.ensemble_comparison_params(MyParams, members);
+        os.makedirs(CompParams.outdir, exist_ok=True);
+        with instrumentation.stage('compare'):
+            compare_strain_grids.drive_in_memory(CompParams, results);
+    return results;
+
+
+def sweep_coordinator(MyParams):
+    """
+    Run one method for every combination of the values swept in its config section (lists like 13, 15, 20 or
+    ranges like 50:100:25), on one velocity field read and validated once.
+    Work that does not depend on the swept values is done once, by the method's prepare_sweep.
+    Each combination writes into output_dir/method/sweep_NNN/, and a table of the combinations with their
+    timing and misfit goes to output_dir/method/sweep_summary.txt.
+    Returns the rows of that table.
+    """
+    with instrumentation.stage('inputs'):
+        velField = input_manager.inputs(MyParams);
+    keys = configure_functions.swept_keys(MyParams.method_specific);
+    combinations = configure_functions.sweep_combinations(MyParams.method_specific);
+    members = [MyParams._replace(method_specific=combination, outdir=MyParams.outdir + "sweep_%03d/" % i)
+               for i, combination in enumerate(combinations)];
+    print("Sweeping %s over %d combinations of %s" % (MyParams.strain_method, len(members), keys));
+    module_name, strain_model = api.get_model(MyParams.strain_method);
+    start = time.perf_counter();
+    with instrumentation.stage('prepare_sweep'):
+        shared = strain_model(members[0]).prepare_sweep(velField, combinations);
+    shared_time = time.perf_counter() - start;
+    cache_options = configure_functions.get_cache_options(MyParams.cache_options);
+    rows = [];
+    for member in members:
+        os.makedirs(member.outdir, exist_ok=True);
+        constructed_object = strain_model(member);
+        sweep_name = os.path.basename(member.outdir.rstrip('/'));
+        start = time.perf_counter();
+        with instrumentation.stage(sweep_name + '/compute'):
+            [[lons, lats, rot, exx, exy, eyy], misfit] = result_cache.cached_compute(
+                member, velField,
+                lambda: [constructed_object.compute_sweep(velField, shared), constructed_object.Misfit()],
+                cache_options);
+        compute_time = time.perf_counter() - start;
+        with instrumentation.stage(sweep_name + '/outputs'):
+            output_manager.outputs_2d(lons, lats, rot, exx, exy, eyy, member, velField);
+        output_time = time.perf_counter() - start - compute_time;
+        rows.append([sweep_name, [member.method_specific[key] for key in keys],
+                     compute_time, output_time, misfit]);
+    output_manager.write_sweep_summary(rows, keys, shared_time, MyParams.outdir + output_manager.SWEEP_SUMMARY);
+    return rows;
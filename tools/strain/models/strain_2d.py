@@ -10,11 +10,29 @@ class Strain_2d(ABC):
         self._grid_inc = grid_inc
         self._strain_range = strain_range
         self._data_range = data_range
+        self._misfit = None  # methods that fit the data can report a misfit (mm/yr) after compute
+        self._uncertainties = None  # methods that propagate data uncertainties can report them as grids after compute
 
     def Method(self):
         return self._Name
 
+    def Misfit(self):
+        return self._misfit
+
+    def Uncertainties(self):
+        # dictionary of name: grid (e.g. s_exx, chi2), or None
+        return self._uncertainties
+
     @abstractmethod
     def compute(self, myVelfield):
         # generic method to be implemented in each method
         pass
+
+    def prepare_sweep(self, myVelfield, method_specific_list):
+        # Work shared by every combination of a parameter sweep (see internal_coordinator.sweep_coordinator).
+        # Methods with nothing to share return None, and each combination is computed from scratch.
+        return None
+
+    def compute_sweep(self, myVelfield, shared):
+        # compute() for one combination of a sweep, reusing what prepare_sweep returned
+        return self.compute(myVelfield)
@@ -49,8 +49,7 @@
 
 
 import numpy as np
-from scipy.spatial import Delaunay
-from .. import output_manager, produce_gridded
+from .. import instrumentation, output_manager, produce_gridded, triangulation, velocity_io
 from . import strain_2d
 
 
@@ -63,122 +62,142 @@ class delaunay(strain_2d.Strain_2d):
     def compute(self, myVelfield):
         print("------------------------------\nComputing strain via Delaunay on a sphere, and converting to a grid.");
 
-        [xcentroid, ycentroid, triangle_vertices, rot, exx, exy, eyy] = compute_with_delaunay_polygons(myVelfield);
+        myVelfield = velocity_io.as_velocity_field(myVelfield);
+        with instrumentation.stage('triangulation'):
+            tri_index = triangulation.build_triangle_index(myVelfield.elon, myVelfield.nlat);
+        with instrumentation.stage('solve'):
+            [rot, exx, exy, eyy, uncertainties] = compute_on_triangles(tri_index, myVelfield);
 
-        lons, lats, rot_grd, exx_grd, exy_grd, eyy_grd = produce_gridded.tri2grid(self._grid_inc, self._strain_range,
-                                                                                  triangle_vertices, rot, exx, exy, eyy);
+        with instrumentation.stage('gridding'):
+            # strain components, uncertainties and chi2 are all filled by the same gather
+            fields = dict({'rot': rot, 'exx': exx, 'exy': exy, 'eyy': eyy}, **uncertainties);
+            lons, lats, grids = produce_gridded.tri2grid_fields(self._grid_inc, self._strain_range, tri_index, fields);
+        self._uncertainties = {name: grids[name] for name in uncertainties.keys()};
 
         # Here we output convenient things on polygons, since it's intuitive for the user.
-        # output_manager.outputs_1d(xcentroid, ycentroid, triangle_vertices, rot, exx, exy, eyy, myVelfield, MyParams);
+        # output_manager.outputs_1d(tri_index, rot, exx, exy, eyy, myVelfield, MyParams);
 
         print("Success computing strain via Delaunay method.\n");
-        return [lons, lats, rot_grd, exx_grd, exy_grd, eyy_grd];
+        return [lons, lats, grids['rot'], grids['exx'], grids['exy'], grids['eyy']];
 
 
 def compute_with_delaunay_polygons(myVelfield):
-    elon = [x.elon for x in myVelfield];
-    nlat = [x.nlat for x in myVelfield];
-    e = [x.e for x in myVelfield];
-    n = [x.n for x in myVelfield];
-    se = [x.se for x in myVelfield];
-    sn = [x.sn for x in myVelfield];
-    z = np.array([elon, nlat]);
-    z = z.T;
-    tri = Delaunay(z);
-
-    triangle_vertices = z[tri.simplices];
-    trishape = np.shape(triangle_vertices);  # 516 x 3 x 2, for example
-    print("Number of triangle elements: %d" % (trishape[0]));
-
-    # We are going to solve for the velocity gradient tensor at the centroid of each triangle.
-    centroids = [];
-    for i in range(trishape[0]):
-        xcor_mean = np.mean(
-                [
-                    triangle_vertices[i, 0, 0], 
-                    triangle_vertices[i, 1, 0], 
-                    triangle_vertices[i, 2, 0]
-                ]
-            );
-        ycor_mean = np.mean(
-                [
-                    triangle_vertices[i, 0, 1], 
-                    triangle_vertices[i, 1, 1], 
-                    triangle_vertices[i, 2, 1]
-                ]
-            );
-        centroids.append([xcor_mean, ycor_mean]);
-    xcentroid = [x[0] for x in centroids];
-    ycentroid = [x[1] for x in centroids];
-
-    # Initialize arrays.
-    rot = [];
-    exx, exy, eyy = [], [], [];
-
-    # for each triangle:
-    for i in range(trishape[0]):
-        # Get the velocities of each vertex (VE1, VN1, VE2, VN2, VE3, VN3)
-        # Get velocities for Vertex 1 (triangle_vertices[i,0,0] and triangle_vertices[i,0,1])
-        xindex1 = np.where(elon == triangle_vertices[i, 0, 0])
-        yindex1 = np.where(nlat == triangle_vertices[i, 0, 1])
-        index1 = int(np.intersect1d(xindex1, yindex1)[0]);
-        xindex2 = np.where(elon == triangle_vertices[i, 1, 0])
-        yindex2 = np.where(nlat == triangle_vertices[i, 1, 1])
-        index2 = int(np.intersect1d(xindex2, yindex2)[0]);
-        xindex3 = np.where(elon == triangle_vertices[i, 2, 0])
-        yindex3 = np.where(nlat == triangle_vertices[i, 2, 1])
-        index3 = int(np.intersect1d(xindex3, yindex3)[0]);
-
-        phi = np.array(
-                [
-                    triangle_vertices[i, 0, 0], 
-                    triangle_vertices[i, 1, 0], 
-                    triangle_vertices[i, 2, 0]
-                ]
-            );
-        theta = np.array(
-                [
-                    triangle_vertices[i, 0, 1], 
-                    triangle_vertices[i, 1, 1], 
-                    triangle_vertices[i, 2, 1]
-                ]
-            );
-        theta = [i - 90 for i in theta];
-        u_phi = np.array([e[index1], e[index2], e[index3]]);
-        u_theta = np.array([n[index1], n[index2], n[index3]]);
-        u_theta = np.array([-i for i in u_theta]);  # colatitude needs negative theta values.
-        s_phi = np.array([se[index1], se[index2], se[index3]]);
-        s_theta = np.array([sn[index1], sn[index2], sn[index3]]);
-
-
-        # HERE WE PLUG IN BILL'S CODE!
-        weight = 1;
-        paramsel = 0;
-        [e_phiphi, e_thetaphi, e_thetatheta, omega_r, U_theta, U_phi, s_omega_r, \
-            s_e_phiphi, s_e_thetaphi, s_e_thetatheta, s_U_theta, s_U_phi, chi2, \
-            OMEGA, THETA_p, PHI_p, s_OMEGA, s_THETA_p, s_PHI_p, r_PHITHETA, u_phi_p, \
-            u_theta_p] = strain_sphere(
-                phi, 
-                theta, 
-                u_phi, 
-                u_theta, 
-                s_phi, 
-                s_theta, 
-                weight, 
-                paramsel
-            );
-
-        # The components that are easily computed
-        # Units: nanostrain per year.
-        # There might be a sign issue here compared to other codes.
-        exx.append(-e_phiphi * 1e6);
-        exy.append(e_thetaphi * 1e6);
-        eyy.append(-e_thetatheta * 1e6);
-
-        # # Compute a number of values based on tensor properties.
-        rot.append(OMEGA * 1000 * 1000);
-
-    return [xcentroid, ycentroid, triangle_vertices, rot, exx, exy, eyy];
+    myVelfield = velocity_io.as_velocity_field(myVelfield);
+    tri_index = triangulation.build_triangle_index(myVelfield.elon, myVelfield.nlat);
+    [rot, exx, exy, eyy, _] = compute_on_triangles(tri_index, myVelfield);
+    return [tri_index.xcentroid, tri_index.ycentroid, tri_index.vertices, rot, exx, exy, eyy];
+
+
+def compute_on_triangles(tri_index, myVelfield):
+    # Get the velocities and uncertainties of each vertex straight from the triangle index.
+    myVelfield = velocity_io.as_velocity_field(myVelfield);
+    phi = tri_index.vertices[:, :, 0];
+    theta = tri_index.vertices[:, :, 1] - 90;
+    u_phi = triangulation.gather(tri_index, myVelfield.e);
+    u_theta = -triangulation.gather(tri_index, myVelfield.n);  # colatitude needs negative theta values.
+    s_phi = triangulation.gather(tri_index, myVelfield.se);
+    s_theta = triangulation.gather(tri_index, myVelfield.sn);
+
+    # HERE WE PLUG IN BILL'S CODE, solving every triangle at once.
+    [e_phiphi, e_thetaphi, e_thetatheta, _, OMEGA, s_e_phiphi, s_e_thetaphi, s_e_thetatheta, _, chi2,
+     _] = strain_sphere_batch(phi, theta, u_phi, u_theta, s_phi, s_theta);
+
+    # The components that are easily computed
+    # Units: nanostrain per year.
+    # There might be a sign issue here compared to other codes.
+    exx = -e_phiphi * 1e6;
+    exy = e_thetaphi * 1e6;
+    eyy = -e_thetatheta * 1e6;
+
+    # # Compute a number of values based on tensor properties.
+    rot = OMEGA * 1000 * 1000;
+
+    # Per-triangle uncertainties and misfit, in the same units as the strain components
+    uncertainties = {'s_exx': s_e_phiphi * 1e6, 's_exy': s_e_thetaphi * 1e6, 's_eyy': s_e_thetatheta * 1e6,
+                     'chi2': chi2};
+    return [rot, exx, exy, eyy, uncertainties];
+
+
+def strain_sphere_batch(phi, theta, u_phi, u_theta, s_phi, s_theta):
+    """
+    Vectorized version of strain_sphere for many triangles at once, with weight=1 and paramsel=0.
+    Inputs are (ntri, 3) arrays in the same units and conventions as strain_sphere.
+    The (ntri, 6, 6) stack of design matrices is solved in one call.
+    Colinear or singular triangles are flagged and return NaN instead of stopping the whole stack.
+    Returns [e_phiphi, e_thetaphi, e_thetatheta, omega_r, OMEGA, s_e_phiphi, s_e_thetaphi, s_e_thetatheta,
+             s_omega_r, chi2, degenerate], each an array of length ntri.
+    """
+    theta = np.deg2rad(np.asarray(theta, dtype=float));  # convert to radians
+    phi = np.deg2rad(np.asarray(phi, dtype=float));
+    u_phi = np.asarray(u_phi, dtype=float);
+    u_theta = np.asarray(u_theta, dtype=float);
+    s_phi = np.asarray(s_phi, dtype=float);
+    s_theta = np.asarray(s_theta, dtype=float);
+    r0 = 6.378e6;  # mean equitorial Earth radius
+    ntri, n = np.shape(phi);
+
+    theta_0 = np.mean(theta, axis=1, keepdims=True);
+    phi_0 = np.mean(phi, axis=1, keepdims=True);
+    del_phi = phi - phi_0;
+    del_theta = theta - theta_0;
+
+    # check for colinearity, same tests as strain_sphere: residuals of a line fit, or identical coordinates.
+    sxx = np.sum(del_phi * del_phi, axis=1, keepdims=True);
+    with np.errstate(divide='ignore', invalid='ignore'):
+        slope = np.sum(del_phi * del_theta, axis=1, keepdims=True) / sxx;
+    resc = np.where(sxx > 0, del_theta - slope * del_phi, del_theta);
+    colin_1 = np.max(np.abs(resc), axis=1) < 1e-5;
+    colin_2 = np.all(np.abs(del_phi) < 1e-5, axis=1) | np.all(np.abs(del_theta) < 1e-5, axis=1);
+    degenerate = colin_1 | colin_2 | ~np.all(np.isfinite(u_phi + u_theta + s_phi + s_theta), axis=1);
+
+    # Make the stack of matrices needed for least squares inversion
+    d = np.stack((u_phi, u_theta), axis=2).reshape(ntri, 2 * n);  # interleaved, like the matlab reshape()
+    sin0, cos0 = np.sin(theta_0), np.cos(theta_0);
+    G = np.zeros((ntri, 2 * n, 6));
+    G[:, 0::2, 0] = -r0;
+    G[:, 0::2, 1] = -r0 * cos0 * del_phi;
+    G[:, 0::2, 2] = r0 * del_theta;
+    G[:, 0::2, 3] = r0 * sin0 * del_phi;
+    G[:, 0::2, 4] = r0 * del_theta;
+    G[:, 1::2, 0] = -r0 * cos0 * del_phi;
+    G[:, 1::2, 1] = r0;
+    G[:, 1::2, 2] = -r0 * sin0 * del_phi;
+    G[:, 1::2, 4] = r0 * sin0 * del_phi;
+    G[:, 1::2, 5] = r0 * del_theta;
+
+    # The data covariance is ordered like strain_sphere: all phi sigmas first, then all theta sigmas.
+    covd = np.hstack((np.square(s_phi), np.square(s_theta)));
+    W = 1.0 / covd;
+    G[degenerate] = np.eye(2 * n, 6);  # placeholder so that one bad triangle can't break the stacked solve
+    W[degenerate] = 1.0;
+    d[degenerate] = 0.0;
+
+    # Solve the weighted normal equations and the model covariance together.
+    GtW = np.transpose(G, (0, 2, 1)) * W[:, np.newaxis, :];
+    GtWG = np.matmul(GtW, G);
+    rhs = np.concatenate((np.matmul(GtW, d[:, :, np.newaxis]), np.broadcast_to(np.eye(6), (ntri, 6, 6))), axis=2);
+    solution = np.linalg.solve(GtWG, rhs);
+    m = solution[:, :, 0];
+    covm_diag = np.diagonal(solution[:, :, 1:], axis1=1, axis2=2);
+
+    residual = d - np.matmul(G, m[:, :, np.newaxis])[:, :, 0];
+    chi2 = np.sum(residual * residual * W, axis=1) / (2 * n);
+
+    omega_theta, omega_phi, omega_r = m[:, 0], m[:, 1], m[:, 2];
+    e_phiphi, e_thetaphi, e_thetatheta = m[:, 3], m[:, 4], m[:, 5];
+    OMEGA = np.sqrt(np.square(omega_r) + np.square(omega_phi) + np.square(omega_theta));
+    s_omega_r = np.sqrt(covm_diag[:, 2]);
+    s_e_phiphi = np.sqrt(covm_diag[:, 3]);
+    s_e_thetaphi = np.sqrt(covm_diag[:, 4]);
+    s_e_thetatheta = np.sqrt(covm_diag[:, 5]);
+
+    outputs = [e_phiphi, e_thetaphi, e_thetatheta, omega_r, OMEGA, s_e_phiphi, s_e_thetaphi, s_e_thetatheta,
+               s_omega_r, chi2];
+    for item in outputs:
+        item[degenerate] = np.nan;
+    if np.any(degenerate):
+        print('Warning:  %d triangles are collinear or degenerate. Their strain is NaN.' % np.sum(degenerate));
+    return outputs + [degenerate];
 
 
 def strain_sphere(phi, theta, u_phi, u_theta, s_phi, s_theta, weight, paramsel):
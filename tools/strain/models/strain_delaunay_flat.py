@@ -13,9 +13,8 @@ ftp://ftp.ingv.it/pub/salvatore.barba/RevEu/Cai_StrainBIFROST_2007.pdf
 """
 
 import numpy as np
-from scipy.spatial import Delaunay
-from numpy.linalg import inv
-from .. import strain_tensor_toolbox, output_manager, produce_gridded
+from .. import strain_tensor_toolbox, output_manager, produce_gridded, triangulation, projection, velocity_io
+from .. import instrumentation
 from . import strain_2d
 
 
@@ -28,13 +27,19 @@ class delaunay_flat(strain_2d.Strain_2d):
     def compute(self, myVelfield):
         print("------------------------------\nComputing strain via Delaunay on flat earth, and converting to a grid.");
 
-        [xcentroid, ycentroid, triangle_vertices, rot, exx, exy, eyy] = compute_with_delaunay_polygons(myVelfield);
+        myVelfield = velocity_io.as_velocity_field(myVelfield);
+        with instrumentation.stage('triangulation'):
+            tri_index = triangulation.build_triangle_index(myVelfield.elon, myVelfield.nlat);
+        with instrumentation.stage('solve'):
+            [rot, exx, exy, eyy] = compute_on_triangles(tri_index, myVelfield);
 
-        lons, lats, rot_grd, exx_grd, exy_grd, eyy_grd = produce_gridded.tri2grid(self._grid_inc, self._strain_range,
-                                                                                  triangle_vertices, rot, exx, exy, eyy);
+        with instrumentation.stage('gridding'):
+            lons, lats, rot_grd, exx_grd, exy_grd, eyy_grd = produce_gridded.tri2grid(self._grid_inc,
+                                                                                      self._strain_range, tri_index,
+                                                                                      rot, exx, exy, eyy);
 
         # Here we output convenient things on polygons, since it's intuitive for the user.
-        # output_manager.outputs_1d(xcentroid, ycentroid, triangle_vertices, rot, exx, exy, eyy, myVelfield, MyParams);
+        # output_manager.outputs_1d(tri_index, rot, exx, exy, eyy, myVelfield, MyParams);
 
         print("Success computing strain via Delaunay method.\n");
         return [lons, lats, rot_grd, exx_grd, exy_grd, eyy_grd];
@@ -42,87 +47,45 @@ class delaunay_flat(strain_2d.Strain_2d):
 
 # ----------------- COMPUTE -------------------------
 def compute_with_delaunay_polygons(myVelfield):
+    myVelfield = velocity_io.as_velocity_field(myVelfield);
+    tri_index = triangulation.build_triangle_index(myVelfield.elon, myVelfield.nlat);
+    [rot, exx, exy, eyy] = compute_on_triangles(tri_index, myVelfield);
+    return [tri_index.xcentroid, tri_index.ycentroid, tri_index.vertices, rot, exx, exy, eyy];
+
+
+def compute_on_triangles(tri_index, myVelfield):
+    # The velocity gradient on a linear triangle comes straight from the derivatives of its
+    # barycentric shape functions, so all triangles are solved together with array operations.
     print("Computing strain via delaunay method.");
-    elon = [x.elon for x in myVelfield];
-    nlat = [x.nlat for x in myVelfield];
-    e = [x.e for x in myVelfield];
-    n = [x.n for x in myVelfield];
-    z = np.array([elon, nlat]);
-    z = z.T;
-    tri = Delaunay(z);
-
-    triangle_vertices = z[tri.simplices];
-    trishape = np.shape(triangle_vertices);  # 516 x 3 x 2, for example
-
-    # We are going to solve for the velocity gradient tensor at the centroid of each triangle.
-    centroids = [];
-    for i in range(trishape[0]):
-        xcor_mean = np.mean([triangle_vertices[i, 0, 0], triangle_vertices[i, 1, 0], triangle_vertices[i, 2, 0]]);
-        ycor_mean = np.mean([triangle_vertices[i, 0, 1], triangle_vertices[i, 1, 1], triangle_vertices[i, 2, 1]]);
-        centroids.append([xcor_mean, ycor_mean]);
-    xcentroid = [x[0] for x in centroids];
-    ycentroid = [x[1] for x in centroids];
-
-    # Initialize arrays.
-    rot = [];
-    exx, exy, eyy = [], [], [];
-
-    # for each triangle:
-    for i in range(trishape[0]):
-        # Get the velocities of each vertex (VE1, VN1, VE2, VN2, VE3, VN3)
-        # Get velocities for Vertex 1 (triangle_vertices[i,0,0] and triangle_vertices[i,0,1])
-        xindex1 = np.where(elon == triangle_vertices[i, 0, 0])
-        yindex1 = np.where(nlat == triangle_vertices[i, 0, 1])
-        index1 = np.intersect1d(xindex1, yindex1);
-        xindex2 = np.where(elon == triangle_vertices[i, 1, 0])
-        yindex2 = np.where(nlat == triangle_vertices[i, 1, 1])
-        index2 = np.intersect1d(xindex2, yindex2);
-        xindex3 = np.where(elon == triangle_vertices[i, 2, 0])
-        yindex3 = np.where(nlat == triangle_vertices[i, 2, 1])
-        index3 = np.intersect1d(xindex3, yindex3);
-
-        VE1 = e[index1[0]];
-        VN1 = n[index1[0]];
-        VE2 = e[index2[0]];
-        VN2 = n[index2[0]];
-        VE3 = e[index3[0]];
-        VN3 = n[index3[0]];
-        obs_vel = np.array([[VE1], [VN1], [VE2], [VN2], [VE3], [VN3]]);
-
-        # Get the distance between centroid and vertex (in km)
-        dE1 = (triangle_vertices[i, 0, 0] - xcentroid[i]) * 111.0 * np.cos(np.deg2rad(ycentroid[i]));
-        dE2 = (triangle_vertices[i, 1, 0] - xcentroid[i]) * 111.0 * np.cos(np.deg2rad(ycentroid[i]));
-        dE3 = (triangle_vertices[i, 2, 0] - xcentroid[i]) * 111.0 * np.cos(np.deg2rad(ycentroid[i]));
-        dN1 = (triangle_vertices[i, 0, 1] - ycentroid[i]) * 111.0;
-        dN2 = (triangle_vertices[i, 1, 1] - ycentroid[i]) * 111.0;
-        dN3 = (triangle_vertices[i, 2, 1] - ycentroid[i]) * 111.0;
-
-        Design_Matrix = np.array(
-            [[1, 0, dE1, dN1, 0, 0], [0, 1, 0, 0, dE1, dN1], [1, 0, dE2, dN2, 0, 0], [0, 1, 0, 0, dE2, dN2],
-             [1, 0, dE3, dN3, 0, 0], [0, 1, 0, 0, dE3, dN3]]);
-
-        # Invert to get the components of the velocity gradient tensor.
-        DMinv = inv(Design_Matrix);
-        vel_grad = np.dot(DMinv, obs_vel);  # this is the money step.
-        # VE_centroid = vel_grad[0][0];
-        # VN_centroid = vel_grad[1][0];
-        dVEdE = vel_grad[2][0];
-        dVEdN = vel_grad[3][0];
-        dVNdE = vel_grad[4][0];
-        dVNdN = vel_grad[5][0];
-
-        # The components that are easily computed
-        [exx_triangle, exy_triangle, eyy_triangle,
-         rotation_triangle] = strain_tensor_toolbox.compute_strain_components_from_dx(dVEdE, dVNdE, dVEdN, dVNdN);
-
-        # # Compute a number of values based on tensor properties.
-        # [e11, e22, v] = strain_tensor_toolbox.eigenvector_eigenvalue(exx, exy, eyy);
-
-        exx.append(exx_triangle);
-        exy.append(exy_triangle);
-        eyy.append(eyy_triangle);
-        rot.append(abs(rotation_triangle));
+    myVelfield = velocity_io.as_velocity_field(myVelfield);
+    triangle_vertices = tri_index.vertices;
+    xcentroid = tri_index.xcentroid[:, np.newaxis];
+    ycentroid = tri_index.ycentroid[:, np.newaxis];
+    vertex_e = triangulation.gather(tri_index, myVelfield.e);  # (ntri, 3) velocities of each vertex
+    vertex_n = triangulation.gather(tri_index, myVelfield.n);
+
+    # Get the distance between centroid and vertex (in km), with the local ellipsoidal scale at each centroid
+    [m_per_deg_lon, m_per_deg_lat] = projection.meters_per_degree(ycentroid);
+    dE = (triangle_vertices[:, :, 0] - xcentroid) * m_per_deg_lon * 0.001;
+    dN = (triangle_vertices[:, :, 1] - ycentroid) * m_per_deg_lat * 0.001;
+
+    # Shape-function derivatives: dNi/dE = (dN_j - dN_k) / 2A, dNi/dN = (dE_k - dE_j) / 2A, for (i, j, k) cyclic
+    dN_j, dN_k = np.roll(dN, -1, axis=1), np.roll(dN, -2, axis=1);
+    dE_j, dE_k = np.roll(dE, -1, axis=1), np.roll(dE, -2, axis=1);
+    twice_area = np.sum(dE * (dN_j - dN_k), axis=1, keepdims=True);
+    twice_area[twice_area == 0] = np.nan;  # degenerate triangles get NaN strain
+    shape_dE = (dN_j - dN_k) / twice_area;
+    shape_dN = (dE_k - dE_j) / twice_area;
+
+    # The components of the velocity gradient tensor (this is the money step).
+    dVEdE = np.sum(vertex_e * shape_dE, axis=1);
+    dVEdN = np.sum(vertex_e * shape_dN, axis=1);
+    dVNdE = np.sum(vertex_n * shape_dE, axis=1);
+    dVNdN = np.sum(vertex_n * shape_dN, axis=1);
+
+    # The components that are easily computed
+    [exx, exy, eyy, rot] = strain_tensor_toolbox.compute_strain_components_from_dx(dVEdE, dVNdE, dVEdN, dVNdN);
+    rot = np.abs(rot);
 
     print("Success computing strain via delaunay flat-earth method.\n");
-
-    return [xcentroid, ycentroid, triangle_vertices, rot, exx, exy, eyy];
+    return [rot, exx, exy, eyy];
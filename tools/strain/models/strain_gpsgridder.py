@@ -7,7 +7,7 @@
 import numpy as np
 import subprocess
 from Tectonic_Utils.read_write import netcdf_read_write
-from .. import velocity_io, configure_functions, strain_tensor_toolbox
+from .. import velocity_io, configure_functions, strain_tensor_toolbox, projection
 from . import strain_2d
 
 
@@ -23,6 +23,7 @@ class gpsgridder(strain_2d.Strain_2d):
         [lons, lats, rot_grd, exx_grd, exy_grd, eyy_grd] = compute_gpsgridder(myVelfield, self._strain_range,
                                                                                self._grid_inc, self._poisson, self._fd,
                                                                                self._eigenvalue, self._tempdir);
+        self._misfit = read_misfit(self._tempdir + "misfitfile.txt");
         return [lons, lats, rot_grd, exx_grd, exy_grd, eyy_grd];
 
 
@@ -38,6 +39,14 @@ def verify_inputs_gpsgridder(method_specific_dict):
     eigenvalue = method_specific_dict["eigenvalue"];
     return poisson, fd, eigenvalue;
 
+def read_misfit(misfitfile):
+    # rms of the u and v misfits written by gpsgridder -E: lon lat u u_model u_misfit v v_model v_misfit ...
+    try:
+        table = np.loadtxt(misfitfile, ndmin=2);
+    except (OSError, ValueError):
+        return None;
+    return float(np.sqrt(np.mean(np.concatenate((table[:, 4], table[:, 7])) ** 2)));
+
 # ----------------- COMPUTE -------------------------
 def compute_gpsgridder(myVelfield, range_strain, inc, poisson, fd, eigenvalue, tempoutdir):
     print("------------------------------\nComputing strain via gpsgridder method.");
@@ -70,33 +79,26 @@ def compute_gpsgridder(myVelfield, range_strain, inc, poisson, fd, eigenvalue, t
     [_, _, vdata] = netcdf_read_write.read_any_grd(file2);
     xinc = float(subprocess.check_output('gmt grdinfo -M -C '+file1+' | awk \'{print $8}\'', shell=True));  # x-inc
     yinc = float(subprocess.check_output('gmt grdinfo -M -C '+file1+' | awk \'{print $9}\'', shell=True));  # y-inc
-    xinc = xinc * 111.000 * np.cos(np.deg2rad(range_strain[2]));  # in km (not degrees)
-    yinc = yinc * 111.000;   # in km (not degrees)
-    [ydim, xdim] = np.shape(udata)
+    [m_per_deg_lon, m_per_deg_lat] = projection.meters_per_degree(np.asarray(ydata)[:-1, np.newaxis]);
+    xinc = xinc * m_per_deg_lon * 0.001;  # in km (not degrees), for each row of the grid
+    yinc = yinc * m_per_deg_lat * 0.001;  # in km (not degrees)
     exx = np.zeros(np.shape(vdata));
     exy = np.zeros(np.shape(vdata));
     eyy = np.zeros(np.shape(vdata));
     rot = np.zeros(np.shape(vdata));  # 2nd invariant of rotation rate tensor
 
-    # the strain calculation
-    for j in range(ydim-1):
-        for i in range(xdim-1):
-            up = udata[j][i];
-            vp = vdata[j][i];
-            uq = udata[j][i+1];
-            vq = vdata[j][i+1];
-            ur = udata[j+1][i];
-            vr = vdata[j+1][i];
-
-            [dudx, dvdx, dudy, dvdy] = strain_tensor_toolbox.compute_displacement_gradients(up, vp, ur, vr, uq, vq,
-                                                                                            xinc, yinc);
+    # the strain calculation, on every cell at once: P is the cell, Q its east neighbor, R its north neighbor.
+    up, vp = udata[:-1, :-1], vdata[:-1, :-1];
+    uq, vq = udata[:-1, 1:], vdata[:-1, 1:];
+    ur, vr = udata[1:, :-1], vdata[1:, :-1];
+    [dudx, dvdx, dudy, dvdy] = strain_tensor_toolbox.compute_displacement_gradients(up, vp, ur, vr, uq, vq, xinc, yinc);
 
-            # The basic strain tensor components (units: nanostrain per year)
-            [exx1, exy1, eyy1, rot1] = strain_tensor_toolbox.compute_strain_components_from_dx(dudx, dvdx, dudy, dvdy);
-            rot[j][i] = abs(rot1);
-            exx[j][i] = exx1;
-            exy[j][i] = exy1;
-            eyy[j][i] = eyy1;
+    # The basic strain tensor components (units: nanostrain per year)
+    [exx1, exy1, eyy1, rot1] = strain_tensor_toolbox.compute_strain_components_from_dx(dudx, dvdx, dudy, dvdy);
+    rot[:-1, :-1] = np.abs(rot1);
+    exx[:-1, :-1] = exx1;
+    exy[:-1, :-1] = exy1;
+    eyy[:-1, :-1] = eyy1;
 
     print("Success computing strain via gpsgridder method.\n");
 
@@ -1,10 +1,15 @@
 # Courtesy of Mong-han Huang
 # Strain calculation tool based on a certain number of nearby stations
 
+import collections
 import numpy as np
-from Tectonic_Utils.geodesy import utm_conversion
+from scipy.spatial import cKDTree
+from .. import projection, velocity_io, instrumentation
 from . import strain_2d
 
+# Projected stations and grid nodes, with each node's nearest stations (indices and distances in m, nearest first)
+HuangNeighbors = collections.namedtuple('HuangNeighbors', ['xlons', 'ylats', 'elon', 'nlat', 'e', 'n', 'dist', 'idx']);
+
 
 class huang(strain_2d.Strain_2d):
     """ Huang class for 2d strain rate, with general strain_2d behavior """
@@ -12,11 +17,30 @@ class huang(strain_2d.Strain_2d):
         strain_2d.Strain_2d.__init__(self, params.inc, params.range_strain, params.range_data);
         self._Name = 'huang'
         self._radiuskm, self._nstations = verify_inputs_huang(params.method_specific);
+        self._projection, self._utm_zone = projection.read_projection_options(params.method_specific, default='utm');
 
     def compute(self, myVelfield):
-        [lons, lats, rot_grd, exx_grd, exy_grd, eyy_grd] = compute_huang(myVelfield, self._strain_range,
-                                                                         self._grid_inc, self._radiuskm,
-                                                                         self._nstations);
+        with instrumentation.stage('neighbor_search'):
+            neighbors = huang_neighbors(myVelfield, self._strain_range, self._grid_inc, self._radiuskm,
+                                        self._nstations, self._projection, self._utm_zone);
+        with instrumentation.stage('solve'):
+            [lons, lats, rot_grd, exx_grd, exy_grd, eyy_grd, self._misfit] = strain_from_neighbors(neighbors,
+                                                                                                   self._radiuskm,
+                                                                                                   self._nstations);
+        return [lons, lats, rot_grd, exx_grd, exy_grd, eyy_grd];
+
+    def prepare_sweep(self, myVelfield, method_specific_list):
+        # Projection and neighbor search once, for the largest radius and number of stations in the sweep
+        settings = [verify_inputs_huang(x) for x in method_specific_list];
+        with instrumentation.stage('neighbor_search'):
+            return huang_neighbors(myVelfield, self._strain_range, self._grid_inc, max([x[0] for x in settings]),
+                                   max([x[1] for x in settings]), self._projection, self._utm_zone);
+
+    def compute_sweep(self, myVelfield, shared):
+        with instrumentation.stage('solve'):
+            [lons, lats, rot_grd, exx_grd, exy_grd, eyy_grd, self._misfit] = strain_from_neighbors(shared,
+                                                                                                   self._radiuskm,
+                                                                                                   self._nstations);
         return [lons, lats, rot_grd, exx_grd, exy_grd, eyy_grd];
 
 
@@ -31,16 +55,29 @@ def verify_inputs_huang(method_specific_dict):
     return radiuskm, nstations;
 
 
-def compute_huang(myVelfield, range_strain, inc, radiuskm, nstations):
+def compute_huang(myVelfield, range_strain, inc, radiuskm, nstations, projection_name='utm', utm_zone=None):
+    neighbors = huang_neighbors(myVelfield, range_strain, inc, radiuskm, nstations, projection_name, utm_zone);
+    [xlons, ylats, rot, exx, exy, eyy, _] = strain_from_neighbors(neighbors, radiuskm, nstations);
+    return [xlons, ylats, rot, exx, exy, eyy];
+
+
+def huang_neighbors(myVelfield, range_strain, inc, radiuskm, nstations, projection_name='utm', utm_zone=None):
+    """
+    The part of Huang's method that does not depend on its parameters, for up to nstations within radiuskm:
+    projected station and node coordinates, and each node's nearest stations sorted by distance.
+    Any smaller radius or number of stations can be solved from the result with strain_from_neighbors.
+    """
     print("------------------------------\nComputing strain via Huang method.");
 
     # Set up grids for the computation
     ylats = np.arange(range_strain[2], range_strain[3]+0.00001, inc[1]);
     xlons = np.arange(range_strain[0], range_strain[1]+0.00001, inc[0]);
-    gx = len(xlons);  # number of x - grid
-    gy = len(ylats);  # number of y - grid
 
-    [elon, nlat, e, n, _, _] = velfield_to_huang_format(myVelfield);
+    # One projection for stations and grid alike (default: UTM, in the zone at the center of the data)
+    myVelfield = velocity_io.as_velocity_field(myVelfield);
+    proj = projection.projection_for_data(myVelfield.elon, myVelfield.nlat, name=projection_name, zone=utm_zone);
+    print("Projecting coordinates with %s" % proj);
+    [elon, nlat, e, n, _, _] = velfield_to_huang_format(myVelfield, proj);
 
     # set up a local coordinate reference
     refx = np.min(elon);
@@ -48,115 +85,97 @@ def compute_huang(myVelfield, range_strain, inc, radiuskm, nstations):
     elon = elon - refx;
     nlat = nlat - refy;
 
+    # 1. Grid nodes in the same local coordinates as the stations
+    grid_lon, grid_lat = np.meshgrid(xlons, ylats);
+    [gridX_loc, gridY_loc] = coord_to_local_utm(grid_lon.ravel(), grid_lat.ravel(), refx, refy, proj);
+    nodes = np.column_stack((gridX_loc, gridY_loc));
+
+    # 2. Find the nstations closest stations to every node at once, out to the radius (in meters)
+    tree = cKDTree(np.column_stack((elon, nlat)));
+    dist, idx = tree.query(nodes, k=nstations, distance_upper_bound=np.nextafter(radiuskm * 1000, np.inf));
+    dist, idx = dist.reshape(-1, nstations), idx.reshape(-1, nstations);
+    return HuangNeighbors(xlons=xlons, ylats=ylats, elon=elon, nlat=nlat, e=e, n=n, dist=dist, idx=idx);
+
+
+def strain_from_neighbors(neighbors, radiuskm, nstations):
+    """
+    Solve Huang's local plane fits from precomputed neighbors, for any radius and number of stations up to theirs.
+    Returns [xlons, ylats, rot, exx, exy, eyy, misfit], misfit being the rms residual of the plane fits in mm/yr.
+    """
+    xlons, ylats = neighbors.xlons, neighbors.ylats;
+    elon, nlat, e, n = neighbors.elon, neighbors.nlat, neighbors.e, neighbors.n;
+    gx = len(xlons);  # number of x - grid
+    gy = len(ylats);  # number of y - grid
+
     # Setting calculation parameters
     EstimateRadius = radiuskm * 1000;  # convert to meters
     ns = nstations;  # number of selected stations
-
-    # 2. The main loop, getting displacement gradients around stations
-    # find at least 5 smallest distance stations
-    Uxx = np.zeros((gy, gx));
-    Uyy = np.zeros((gy, gx));
-    Uxy = np.zeros((gy, gx));
-    Uyx = np.zeros((gy, gx));
-    exx = np.zeros((gy, gx));
-    exy = np.zeros((gy, gx));
-    eyy = np.zeros((gy, gx));
-    rot = np.zeros((gy, gx));
-    for i in range(gx):
-        for j in range(gy):
-            [gridX_loc, gridY_loc] = coord_to_local_utm(xlons[i], ylats[j], refx, refy);
-            X = elon;
-            Y = nlat;
-            l1 = len(elon);
-
-            # the distance from stations to grid
-            r = np.zeros((l1,));
-            for ii in range(l1):
-                r[ii] = np.sqrt((gridX_loc - X[ii]) * (gridX_loc - X[ii]) + (gridY_loc - Y[ii]) * (gridY_loc - Y[ii]));
-                # for a particular grid point, we are computing the distance to every station
-
-            stations = np.zeros((l1, 5));
-            stations[:, 0] = r;
-            stations[:, 1] = elon.reshape((l1,));
-            stations[:, 2] = nlat.reshape((l1,));
-            stations[:, 3] = e.reshape((l1,));
-            stations[:, 4] = n.reshape((l1,));
-
-            iX = stations[stations[:, 0].argsort()];  # sort data, iX represented the order of the sorting of 1st column
-            # we choose the first ns data
-            SelectStations = np.zeros((ns, 5));
-            for iiii in range(ns):
-                SelectStations[iiii, :] = iX[iiii, :];
-            # print(SelectStations);
-            Px, Py = 0, 0;
-            Px2, Py2, Pxy = 0, 0, 0;
-            dU, dV = 0, 0;
-            dxU, dyU = 0, 0;
-            dxV, dyV = 0, 0;  # should be inside the if statement or not?
-            # print(SelectStations[ns-1, 0]);  # the distance of the cutoff station (in m)
-            if SelectStations[ns-1, 0] <= EstimateRadius:
-                for iii in range(ns):
-                    Px = Px + SelectStations[iii, 1];
-                    Py = Py + SelectStations[iii, 2];
-                    Px2 = Px2 + SelectStations[iii, 1] * SelectStations[iii, 1];
-                    Py2 = Py2 + SelectStations[iii, 2] * SelectStations[iii, 2];
-                    Pxy = Pxy + SelectStations[iii, 1] * SelectStations[iii, 2];
-                    dU = dU + SelectStations[iii, 3];
-                    dxU = dxU + SelectStations[iii, 1] * SelectStations[iii, 3];
-                    dyU = dyU + SelectStations[iii, 2] * SelectStations[iii, 3];
-                    dV = dV + SelectStations[iii, 4];
-                    dxV = dxV + SelectStations[iii, 1] * SelectStations[iii, 4];
-                    dyV = dyV + SelectStations[iii, 2] * SelectStations[iii, 4];
-            G = [[ns, Px, Py], [Px, Px2, Pxy], [Py, Pxy, Py2]];
-            if np.sum(G) == ns:
-                Uxx[j, i] = 0;
-                Uyy[j, i] = 0;
-                Uxy[j, i] = 0;
-                Uyx[j, i] = 0;
-            else:
-                dx = np.array([[dU], [dxU], [dyU]]);
-                dy = np.array([[dV], [dxV], [dyV]]);
-                modelx = np.dot(np.linalg.inv(G), dx);
-                modely = np.dot(np.linalg.inv(G), dy);
-                Uxx[j, i] = modelx[1];
-                Uyy[j, i] = modely[2];
-                Uxy[j, i] = modelx[2];
-                Uyx[j, i] = modely[1];
-
-            # skipping misfit right now
-            # misfit estimation   d = m1 + m2 x + m3 y
-
-            # 3. Moving on to strain calculation
-            sxx = Uxx[j, i];
-            syy = Uyy[j, i];
-            sxy = .5 * (Uxy[j, i] + Uyx[j, i]);
-            omega = .5 * (Uxy[j, i] - Uyx[j, i]);
-            exx[j, i] = sxx * 1e9;
-            exy[j, i] = sxy * 1e9;
-            eyy[j, i] = syy * 1e9;
-            rot[j, i] = omega * 1e9;
+    if ns > np.shape(neighbors.idx)[1]:
+        raise ValueError("Error! Neighbors were found for %d stations, not %d" % (np.shape(neighbors.idx)[1], ns));
+
+    # Getting displacement gradients around stations
+    # A node is only used if all of its ns closest stations are within the radius.
+    dist, idx = neighbors.dist[:, :ns], neighbors.idx[:, :ns];
+    valid = dist[:, -1] <= EstimateRadius;
+
+    # Normal equations for d = m1 + m2 x + m3 y, assembled and solved for every valid node together.
+    X = elon[idx[valid]];
+    Y = nlat[idx[valid]];
+    U = e[idx[valid]];
+    V = n[idx[valid]];
+    Px, Py = np.sum(X, axis=1), np.sum(Y, axis=1);
+    Px2, Py2, Pxy = np.sum(X * X, axis=1), np.sum(Y * Y, axis=1), np.sum(X * Y, axis=1);
+    G = np.stack((np.stack((np.full(len(Px), float(ns)), Px, Py), axis=1),
+                  np.stack((Px, Px2, Pxy), axis=1),
+                  np.stack((Py, Pxy, Py2), axis=1)), axis=1);
+    data = np.stack((np.stack((np.sum(U, axis=1), np.sum(X * U, axis=1), np.sum(Y * U, axis=1)), axis=1),
+                     np.stack((np.sum(V, axis=1), np.sum(X * V, axis=1), np.sum(Y * V, axis=1)), axis=1)), axis=2);
+    model = np.linalg.solve(G, data);  # model[:, :, 0] is for east, model[:, :, 1] for north
+
+    # Nodes without enough stations inside the radius keep zero gradients, as before.
+    Uxx = np.zeros((gy * gx,));
+    Uyy = np.zeros((gy * gx,));
+    Uxy = np.zeros((gy * gx,));
+    Uyx = np.zeros((gy * gx,));
+    Uxx[valid] = model[:, 1, 0];
+    Uyy[valid] = model[:, 2, 1];
+    Uxy[valid] = model[:, 2, 0];
+    Uyx[valid] = model[:, 1, 1];
+
+    # misfit estimation   d = m1 + m2 x + m3 y, rms over every fit, in mm/yr
+    residual_u = U - (model[:, 0:1, 0] + model[:, 1:2, 0] * X + model[:, 2:3, 0] * Y);
+    residual_v = V - (model[:, 0:1, 1] + model[:, 1:2, 1] * X + model[:, 2:3, 1] * Y);
+    misfit = np.sqrt(np.mean(np.concatenate((residual_u, residual_v)) ** 2)) * 1000 if np.any(valid) else np.nan;
+
+    # 3. Moving on to strain calculation
+    sxx = Uxx.reshape((gy, gx));
+    syy = Uyy.reshape((gy, gx));
+    sxy = .5 * (Uxy + Uyx).reshape((gy, gx));
+    omega = .5 * (Uxy - Uyx).reshape((gy, gx));
+    exx = sxx * 1e9;
+    exy = sxy * 1e9;
+    eyy = syy * 1e9;
+    rot = omega * 1e9;
 
     print("Success computing strain via Huang method.\n");
 
-    return [xlons, ylats, rot, exx, exy, eyy];
+    return [xlons, ylats, rot, exx, exy, eyy, misfit];
 
 
-def velfield_to_huang_format(myVelfield):
-    elon, nlat = [], [];
-    e, n, esig, nsig = [], [], [], [];
-    for item in myVelfield:
-        [x, y, _] = utm_conversion.deg2utm([item.nlat], [item.elon]);
-        elon.append(x);
-        nlat.append(y);
-        e.append(item.e*0.001);
-        n.append(item.n*0.001);
-        esig.append(item.se*0.001);
-        nsig.append(item.sn*0.001);
+def velfield_to_huang_format(myVelfield, proj):
+    # Project all stations in one call; velocities from mm/yr to m/yr
+    myVelfield = velocity_io.as_velocity_field(myVelfield);
+    [elon, nlat] = proj.forward(myVelfield.elon, myVelfield.nlat);
+    e = myVelfield.e * 0.001;
+    n = myVelfield.n * 0.001;
+    esig = myVelfield.se * 0.001;
+    nsig = myVelfield.sn * 0.001;
+    return [elon, nlat, e, n, esig, nsig];
 
-    return [np.array(elon), np.array(nlat), np.array(e), np.array(n), np.array(esig), np.array(nsig)];
 
-def coord_to_local_utm(lon, lat, utm_xref, utm_yref):
-    [x, y, _] = utm_conversion.deg2utm([lat], [lon]);
+def coord_to_local_utm(lon, lat, utm_xref, utm_yref, proj):
+    # lon, lat can be arrays; returns projected coordinates relative to the reference point
+    [x, y] = proj.forward(lon, lat);
     local_utmx = x - utm_xref;
     local_utmy = y - utm_yref;
     return [local_utmx, local_utmy];
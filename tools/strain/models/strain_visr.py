@@ -8,7 +8,7 @@
 
 
 import numpy as np
-from .. import produce_gridded
+from .. import produce_gridded, velocity_io
 from . import strain_2d
 import subprocess, sys, os
 
@@ -113,11 +113,11 @@ def write_fortran_data_file(data_file, Velfield):
     ofile = open(data_file, 'w');
     # 35    format(a8,2f10.4,2(f7.2,f5.2),f7.3)
     # 0102_GPS -119.2642   34.5655 -29.02 0.79  22.96 0.73  0.082     4   7.2  1994.4
-    for item in Velfield:
-        ofile.write(item.name+"_GPS ");
-        ofile.write("%9.4f %9.4f " % (item.elon, item.nlat) );
-        ofile.write("%6.2f %4.2f %6.2f %4.2f %6.3f " % (item.e, item.se, item.n, item.sn, 0.001) );
-        ofile.write("    5   2.1  2005.0\n");
+    v = velocity_io.as_velocity_field(Velfield);
+    rows = zip(v.name.tolist(), v.elon.tolist(), v.nlat.tolist(), v.e.tolist(), v.se.tolist(), v.n.tolist(),
+               v.sn.tolist());
+    ofile.write("".join(["%s_GPS %9.4f %9.4f %6.2f %4.2f %6.2f %4.2f  0.001     5   2.1  2005.0\n" % row
+                         for row in rows]));
     ofile.close();
     return;
 
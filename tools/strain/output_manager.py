@@ -1,47 +1,145 @@
 # The output manager for GPS Strain analysis. 
 # ----------------- OUTPUTS -------------------------
+# xarray, Tectonic_Utils and pygmt (with its GMT session) are imported by the stages that use them,
+# so runs that skip those stages, and programs that only import this module, do not pay for them.
 
+import datetime
 import numpy as np
-from Tectonic_Utils.read_write import netcdf_read_write
-from . import strain_tensor_toolbox, velocity_io, pygmt_plots
+from . import strain_tensor_toolbox, velocity_io, configure_functions, instrumentation
 
+# Gridded products: variable name (also the name of the separate grd file) and units
+GRID_VARIABLES = [('exx', 'microstrain'), ('exy', 'microstrain'), ('eyy', 'microstrain'), ('azimuth', 'degrees'),
+                  ('I2nd', 'per yr'), ('rot', 'per yr'), ('dila', 'per yr'), ('max_shear', 'per yr')];
+# Further quantities a strain Dataset can hold: eigenvalues and eigenvector components
+EXTRA_VARIABLES = [('e1', 'microstrain'), ('e2', 'microstrain'), ('v00', '1'), ('v01', '1'), ('v10', '1'),
+                   ('v11', '1')];
+# Uncertainties of the strain components and the misfit, written by the methods that report them
+UNCERTAINTY_VARIABLES = [('s_exx', 'microstrain'), ('s_exy', 'microstrain'), ('s_eyy', 'microstrain'),
+                         ('chi2', '1')];
+COMBINED_FILENAME = 'strain_grids.nc';
+SWEEP_SUMMARY = 'sweep_summary.txt';
 
-def outputs_2d(xdata, ydata, rot, exx, exy, eyy, MyParams, myVelfield):
+
+def outputs_2d(xdata, ydata, rot, exx, exy, eyy, MyParams, myVelfield, uncertainties=None):
+    # uncertainties: optional dictionary of uncertainty and chi2 grids, written alongside the strain grids
     print("------------------------------\nWriting 2d outputs:");
     velocity_io.write_stationvels(myVelfield, MyParams.outdir+"tempgps.txt");
-    [I2nd, max_shear, dilatation, azimuth] = strain_tensor_toolbox.compute_derived_quantities(exx, exy, eyy);
-    [e1, e2, v00, v01, v10, v11] = strain_tensor_toolbox.compute_eigenvectors(exx, exy, eyy);
-    netcdf_read_write.produce_output_netcdf(xdata, ydata, exx, 'microstrain', MyParams.outdir + 'exx.nc');
-    netcdf_read_write.produce_output_netcdf(xdata, ydata, exy, 'microstrain', MyParams.outdir + 'exy.nc');
-    netcdf_read_write.produce_output_netcdf(xdata, ydata, eyy, 'microstrain', MyParams.outdir + 'eyy.nc');
-    netcdf_read_write.produce_output_netcdf(xdata, ydata, azimuth, 'degrees', MyParams.outdir + 'azimuth.nc');
-    netcdf_read_write.produce_output_netcdf(xdata, ydata, I2nd, 'per yr', MyParams.outdir + 'I2nd.nc');
-    netcdf_read_write.produce_output_netcdf(xdata, ydata, rot, 'per yr', MyParams.outdir + 'rot.nc');
-    netcdf_read_write.produce_output_netcdf(xdata, ydata, dilatation, 'per yr', MyParams.outdir + 'dila.nc');
-    netcdf_read_write.produce_output_netcdf(xdata, ydata, max_shear, 'per yr', MyParams.outdir + 'max_shear.nc');
-    print("Max I2: %f " % (np.amax(I2nd)));
-    print("Min/Max rot:   %f,   %f " % (np.amin(rot), np.amax(rot)) );
-    write_grid_eigenvectors(xdata, ydata, e1, e2, v00, v01, v10, v11, MyParams);
-    positive_eigs = velocity_io.read_horiz_vels(MyParams.outdir+"positive_eigs.txt");
-    negative_eigs = velocity_io.read_horiz_vels(MyParams.outdir+"negative_eigs.txt");
+    with instrumentation.stage('derived_quantities'):
+        derived = strain_tensor_toolbox.derived_quantities_kernel(exx, exy, eyy);  # everything in one pass
+    [I2nd, max_shear, dilatation, azimuth] = [derived['I2nd'], derived['max_shear'], derived['dilatation'],
+                                              derived['azimuth']];
+    [e1, e2, v00, v01, v10, v11] = [derived[x] for x in ['e1', 'e2', 'v00', 'v01', 'v10', 'v11']];
+    output_options = configure_functions.get_output_options(MyParams.output_options);
+    grids = {'exx': exx, 'exy': exy, 'eyy': eyy, 'azimuth': azimuth, 'I2nd': I2nd, 'rot': rot,
+             'dila': dilatation, 'max_shear': max_shear};
+    grids.update(uncertainties or {});
+    with instrumentation.stage('netcdf'):
+        if output_options['format'] in ['separate', 'both']:
+            from Tectonic_Utils.read_write import netcdf_read_write
+            for name, units in written_variables(grids):
+                netcdf_read_write.produce_output_netcdf(xdata, ydata, grids[name], units,
+                                                        MyParams.outdir + name + '.nc');
+        if output_options['format'] in ['combined', 'both']:
+            write_combined_netcdf(xdata, ydata, grids, MyParams, output_options);
+    print("Max I2: %f " % (np.nanmax(I2nd)));
+    print("Min/Max rot:   %f,   %f " % (np.nanmin(rot), np.nanmax(rot)) );
+    with instrumentation.stage('eigenvectors'):
+        [positive_eigs, negative_eigs] = write_grid_eigenvectors(xdata, ydata, e1, e2, v00, v01, v10, v11, MyParams);
 
     # PYGMT PLOTS
-    pygmt_plots.plot_rotation(MyParams.outdir+'rot.nc', myVelfield, MyParams.range_strain, MyParams.outdir,
-                              MyParams.outdir+'rotation.png');
-    pygmt_plots.plot_dilatation(MyParams.outdir+'dila.nc', MyParams.range_strain, MyParams.outdir, positive_eigs,
-                                negative_eigs, MyParams.outdir+'dilatation.png');
-    pygmt_plots.plot_I2nd(MyParams.outdir+'I2nd.nc', MyParams.range_strain, MyParams.outdir, positive_eigs,
-                          negative_eigs, MyParams.outdir+'I2nd.png');
-    pygmt_plots.plot_maxshear(MyParams.outdir+'max_shear.nc', MyParams.range_strain, MyParams.outdir, positive_eigs,
-                              negative_eigs, MyParams.outdir+'max_shear.png');
-    pygmt_plots.plot_azimuth(MyParams.outdir+'azimuth.nc', MyParams.range_strain, MyParams.outdir, positive_eigs,
-                             negative_eigs, MyParams.outdir+'azimuth.png');
+    with instrumentation.stage('plots'):
+        from . import pygmt_plots
+        grid_source = get_plotting_grids(MyParams, output_options);
+        pygmt_plots.plot_rotation(grid_source['rot'], myVelfield, MyParams.range_strain, MyParams.outdir,
+                                  MyParams.outdir+'rotation.png');
+        pygmt_plots.plot_dilatation(grid_source['dila'], MyParams.range_strain, MyParams.outdir, positive_eigs,
+                                    negative_eigs, MyParams.outdir+'dilatation.png');
+        pygmt_plots.plot_I2nd(grid_source['I2nd'], MyParams.range_strain, MyParams.outdir, positive_eigs,
+                              negative_eigs, MyParams.outdir+'I2nd.png');
+        pygmt_plots.plot_maxshear(grid_source['max_shear'], MyParams.range_strain, MyParams.outdir, positive_eigs,
+                                  negative_eigs, MyParams.outdir+'max_shear.png');
+        pygmt_plots.plot_azimuth(grid_source['azimuth'], MyParams.range_strain, MyParams.outdir, positive_eigs,
+                                 negative_eigs, MyParams.outdir+'azimuth.png');
+    return;
+
+
+def write_combined_netcdf(xdata, ydata, grids, MyParams, output_options):
+    """
+    Write all gridded quantities into one netcdf4 file with shared x/y coordinates.
+    Each variable carries its units; zlib compression, chunking and float32 storage come from output_options.
+    The method, input file, and configuration are recorded as global attributes.
+    """
+    filename = MyParams.outdir + COMBINED_FILENAME;
+    print("Writing combined output netcdf to file %s " % filename);
+    dtype = 'float32' if output_options['float32'] else 'float64';
+    chunks = (min(output_options['chunk'], len(ydata)), min(output_options['chunk'], len(xdata)));
+    encoding = {};
+    variables = written_variables(grids);
+    for name, _ in variables:
+        encoding[name] = {'dtype': dtype, 'zlib': True, 'complevel': output_options['complevel'],
+                          'chunksizes': chunks, '_FillValue': np.nan};
+    ds = strain_dataset(xdata, ydata, {name: grids[name] for name, _ in variables}, MyParams);
+    ds.to_netcdf(filename, engine='netcdf4', encoding=encoding);
     return;
 
 
-def outputs_1d(xcentroid, ycentroid, polygon_vertices, rot, exx, exy, eyy, myVelfield, MyParams):
+def written_variables(grids):
+    # The (name, units) of the gridded products to write: every GRID_VARIABLE, and the uncertainties present
+    return GRID_VARIABLES + [(name, units) for name, units in UNCERTAINTY_VARIABLES if name in grids];
+
+
+def strain_dataset(xdata, ydata, grids, MyParams):
+    """
+    An xarray Dataset of gridded quantities on shared x/y coordinates, in memory.
+    grids: dictionary of name: 2D array, with names from GRID_VARIABLES, EXTRA_VARIABLES or UNCERTAINTY_VARIABLES
+           (which give the units)
+    """
+    import xarray as xr
+    units = dict(GRID_VARIABLES + EXTRA_VARIABLES + UNCERTAINTY_VARIABLES);
+    data_vars = {name: xr.Variable(('y', 'x'), np.asarray(grids[name]), attrs={'units': units[name]})
+                 for name in grids.keys()};
+    ds = xr.Dataset(data_vars, coords={'x': ('x', np.asarray(xdata, dtype=float), {'units': 'degrees_east'}),
+                                       'y': ('y', np.asarray(ydata, dtype=float), {'units': 'degrees_north'})});
+    ds.attrs = provenance_attributes(MyParams);
+    return ds;
+
+
+def provenance_attributes(MyParams):
+    # Global attributes recording how a product was made
+    attrs = {'history': 'Created by Strain_2D on %s' % datetime.datetime.now().isoformat(timespec='seconds'),
+             'strain_method': MyParams.strain_method,
+             'input_file': MyParams.input_file,
+             'range_strain': configure_functions.get_string_range(MyParams.range_strain),
+             'range_data': configure_functions.get_string_range(MyParams.range_data),
+             'inc': configure_functions.get_string_inc(MyParams.inc)};
+    for key, value in MyParams.method_specific.items():
+        attrs['config_' + key] = str(value);
+    return attrs;
+
+
+def open_combined_netcdf(filename):
+    # Variables are read lazily: only the ones that get used are loaded from disk
+    import xarray as xr
+    return xr.open_dataset(filename, engine='netcdf4');
+
+
+def get_plotting_grids(MyParams, output_options):
+    # Plot from the separate grd files when they exist; otherwise from variables of the combined file
+    if output_options['format'] in ['separate', 'both']:
+        return {name: MyParams.outdir + name + '.nc' for name, _ in GRID_VARIABLES};
+    with open_combined_netcdf(MyParams.outdir + COMBINED_FILENAME) as ds:  # loaded, so the file is not left open
+        return {name: ds[name].load() for name, _ in GRID_VARIABLES};
+
+
+def outputs_1d(tri_index, rot, exx, exy, eyy, myVelfield, MyParams):
+    # tri_index is the triangulation.TriangleIndex that the Delaunay methods computed on.
     print("------------------------------\nWriting 1d outputs:");
-    [I2nd, max_shear, dilatation, azimuth] = strain_tensor_toolbox.compute_derived_quantities(exx, exy, eyy);
+    polygon_vertices = tri_index.vertices;
+    xcentroid, ycentroid = tri_index.xcentroid, tri_index.ycentroid;
+    derived = strain_tensor_toolbox.derived_quantities_kernel(exx, exy, eyy);  # everything in one pass
+    [I2nd, max_shear, dilatation, azimuth] = [derived['I2nd'], derived['max_shear'], derived['dilatation'],
+                                              derived['azimuth']];
+    [e1, e2, v00, v01, v10, v11] = [derived[x] for x in ['e1', 'e2', 'v00', 'v01', 'v10', 'v11']];
     write_multisegment_file(polygon_vertices, rot, MyParams.outdir+"rot_polygons.txt");
     write_multisegment_file(polygon_vertices, I2nd, MyParams.outdir+"I2nd_polygons.txt");
     write_multisegment_file(polygon_vertices, dilatation, MyParams.outdir+"Dilatation_polygons.txt");
@@ -53,20 +151,16 @@ def outputs_1d(xcentroid, ycentroid, polygon_vertices, rot, exx, exy, eyy, myVel
     velocity_io.write_stationvels(myVelfield, MyParams.outdir+"tempgps.txt");
 
     # Write the eigenvectors and eigenvalues
-    positive_file = open(MyParams.outdir + "positive_eigs_polygons.txt", 'w');
-    negative_file = open(MyParams.outdir + "negative_eigs_polygons.txt", 'w');
-    [e1, e2, v00, v01, v10, v11] = strain_tensor_toolbox.compute_eigenvectors(exx, exy, eyy);
-    for i in range(len(I2nd)):
-        write_single_eigenvector(positive_file, negative_file, e1[i], v00[i], v10[i], xcentroid[i], ycentroid[i]);
-        write_single_eigenvector(positive_file, negative_file, e2[i], v01[i], v11[i], xcentroid[i], ycentroid[i]);
-    positive_file.close();
-    negative_file.close();
-    positive_eigs = velocity_io.read_horiz_vels(MyParams.outdir+"positive_eigs_polygons.txt");
-    negative_eigs = velocity_io.read_horiz_vels(MyParams.outdir+"negative_eigs_polygons.txt");
-    print("Max I2: %f " % (max(I2nd)));
-    print("Min/Max rot:   %f,   %f " % (np.amin(rot), np.amax(rot)) );
+    output_options = configure_functions.get_output_options(MyParams.output_options);
+    [positive_eigs, negative_eigs] = polygon_eigenvector_glyphs(xcentroid, ycentroid, e1, e2, v00, v01, v10, v11);
+    if output_options['write_eigs']:
+        write_glyph_file(positive_eigs, MyParams.outdir + "positive_eigs_polygons.txt");
+        write_glyph_file(negative_eigs, MyParams.outdir + "negative_eigs_polygons.txt");
+    print("Max I2: %f " % (np.nanmax(I2nd)));
+    print("Min/Max rot:   %f,   %f " % (np.nanmin(rot), np.nanmax(rot)) );
 
     # Plot the polygons as additional output (more intuitive)
+    from . import pygmt_plots
     pygmt_plots.plot_dilatation_1D(MyParams.range_strain, polygon_vertices, dilatation, MyParams.outdir, positive_eigs,
                                    negative_eigs, MyParams.outdir+'polygon_dilatation.eps');
     pygmt_plots.plot_I2nd_1D(MyParams.range_strain, polygon_vertices, I2nd, MyParams.outdir, positive_eigs,
@@ -75,75 +169,74 @@ def outputs_1d(xcentroid, ycentroid, polygon_vertices, rot, exx, exy, eyy, myVel
 
 
 def write_grid_eigenvectors(xdata, ydata, w1, w2, v00, v01, v10, v11, MyParams):
-    # Need eigs_interval and outdir from MyParams.
-    positive_file = open(MyParams.outdir + "positive_eigs.txt", 'w');
-    negative_file = open(MyParams.outdir + "negative_eigs.txt", 'w');
+    # Need outdir and the eigenvector options from MyParams.
+    # Returns the positive and negative glyph arrays; the text files are optional.
+    output_options = configure_functions.get_output_options(MyParams.output_options);
+    [positive_eigs, negative_eigs] = grid_eigenvector_glyphs(xdata, ydata, w1, w2, v00, v01, v10, v11,
+                                                             output_options['eigs_dec']);
+    if output_options['write_eigs']:
+        write_glyph_file(positive_eigs, MyParams.outdir + "positive_eigs.txt");
+        write_glyph_file(negative_eigs, MyParams.outdir + "negative_eigs.txt");
+    return [positive_eigs, negative_eigs];
+
 
-    eigs_dec = 12;
+def grid_eigenvector_glyphs(xdata, ydata, w1, w2, v00, v01, v10, v11, eigs_dec=12):
+    """
+    Eigenvector glyphs on every eigs_dec'th grid node, as (N, 4) arrays of lon, lat, e, n.
+    Each eigenvector is drawn as a pair of opposite glyphs scaled by its eigenvalue;
+    eigenvalues larger than do_not_print_value are drawn at overmax_scale.
+    Returns [positive_eigs, negative_eigs], split by the sign of the eigenvalue.
+    """
     do_not_print_value = 200;
     overmax_scale = 200;
+    rows, cols = slice(None, None, eigs_dec), slice(None, None, eigs_dec);
+    X, Y = np.meshgrid(np.asarray(xdata)[cols], np.asarray(ydata)[rows]);
+    eigenvalues = [np.asarray(w1)[rows, cols], np.asarray(w2)[rows, cols]];
+    vectors = [(np.asarray(v00)[rows, cols], np.asarray(v10)[rows, cols]),
+               (np.asarray(v01)[rows, cols], np.asarray(v11)[rows, cols])];
+    glyphs, values = [], [];
+    for w, (vx, vy) in zip(eigenvalues, vectors):
+        scale = np.where(np.abs(w) > do_not_print_value, overmax_scale, w);
+        glyphs.append(np.stack((X, Y, vx * scale, vy * scale), axis=-1));
+        glyphs.append(np.stack((X, Y, -vx * scale, -vy * scale), axis=-1));
+        values = values + [w, w];
+    # Order glyphs node by node, as (w1, +v), (w1, -v), (w2, +v), (w2, -v)
+    glyphs = np.stack(glyphs, axis=-2).reshape(-1, 4);
+    values = np.stack(values, axis=-1).reshape(-1);
+    return [glyphs[values > 0], glyphs[values < 0]];
 
-    for j in range(len(ydata)):
-        for k in range(len(xdata)):
-            if np.mod(j, eigs_dec) == 0 and np.mod(k, eigs_dec) == 0:
-                if w1[j][k] > 0:
-                    scale = w1[j][k];
-                    if abs(scale) > do_not_print_value:
-                        scale = overmax_scale;
-                    positive_file.write(
-                        "%s %s %s %s 0 0 0\n" % (xdata[k], ydata[j], v00[j][k] * scale, v10[j][k] * scale));
-                    positive_file.write(
-                        "%s %s %s %s 0 0 0\n" % (xdata[k], ydata[j], -v00[j][k] * scale, -v10[j][k] * scale));
-                if w1[j][k] < 0:
-                    scale = w1[j][k];
-                    if abs(scale) > do_not_print_value:
-                        scale = overmax_scale;
-                    negative_file.write(
-                        "%s %s %s %s 0 0 0\n" % (xdata[k], ydata[j], v00[j][k] * scale, v10[j][k] * scale));
-                    negative_file.write(
-                        "%s %s %s %s 0 0 0\n" % (xdata[k], ydata[j], -v00[j][k] * scale, -v10[j][k] * scale));
-                if w2[j][k] > 0:
-                    scale = w2[j][k];
-                    if abs(scale) > do_not_print_value:
-                        scale = overmax_scale;
-                    positive_file.write(
-                        "%s %s %s %s 0 0 0\n" % (xdata[k], ydata[j], v01[j][k] * scale, v11[j][k] * scale));
-                    positive_file.write(
-                        "%s %s %s %s 0 0 0\n" % (xdata[k], ydata[j], -v01[j][k] * scale, -v11[j][k] * scale));
-                if w2[j][k] < 0:
-                    scale = w2[j][k];
-                    if abs(scale) > do_not_print_value:
-                        scale = overmax_scale;
-                    negative_file.write(
-                        "%s %s %s %s 0 0 0\n" % (xdata[k], ydata[j], v01[j][k] * scale, v11[j][k] * scale));
-                    negative_file.write(
-                        "%s %s %s %s 0 0 0\n" % (xdata[k], ydata[j], -v01[j][k] * scale, -v11[j][k] * scale));
-    positive_file.close();
-    negative_file.close();
-    return;
 
-def write_single_eigenvector(positive_file, negative_file, e, v0, v1, x, y):
-    # e = eigenvalue, [v0, v1] = eigenvector.
-    # Writes a single eigenvector eigenvalue pair.
-    # Also has functionality to saturate eigenvectors so they don't blow up.
+def polygon_eigenvector_glyphs(xcentroid, ycentroid, e1, e2, v00, v01, v10, v11):
+    """
+    Eigenvector glyphs at triangle centroids, as (N, 4) arrays of lon, lat, e, n.
+    Glyphs are scaled by 0.4 * eigenvalue and saturated at overall_max so they don't blow up.
+    Returns [positive_eigs, negative_eigs]; eigenvalues of zero go with the negative glyphs.
+    """
     overall_max = 40.0;
-    scale = 0.4 * e;
-
-    vx = v0 * scale;
-    vy = v1 * scale;
-    if np.sqrt(vx * vx + vy * vy) > overall_max:
-        scale = scale * (overall_max / np.sqrt(vx * vx + vy * vy))
-        vx = v0 * scale;
-        vy = v1 * scale;
-
-    if e > 0:
-        positive_file.write("%s %s %s %s 0 0 0\n" % (x, y, vx, vy));
-        positive_file.write("%s %s %s %s 0 0 0\n" % (x, y, -vx, -vy));
-    else:
-        negative_file.write("%s %s %s %s 0 0 0\n" % (x, y, vx, vy));
-        negative_file.write("%s %s %s %s 0 0 0\n" % (x, y, -vx, -vy));
+    glyphs, values = [], [];
+    for e, v0, v1 in [(e1, v00, v10), (e2, v01, v11)]:
+        e = np.asarray(e, dtype=float);
+        scale = 0.4 * e;
+        length = np.sqrt((v0 * scale) ** 2 + (v1 * scale) ** 2);
+        with np.errstate(divide='ignore', invalid='ignore'):
+            scale = np.where(length > overall_max, scale * (overall_max / length), scale);
+        vx, vy = v0 * scale, v1 * scale;
+        glyphs.append(np.column_stack((xcentroid, ycentroid, vx, vy)));
+        glyphs.append(np.column_stack((xcentroid, ycentroid, -vx, -vy)));
+        values = values + [e, e];
+    glyphs = np.stack(glyphs, axis=1).reshape(-1, 4);
+    values = np.stack(values, axis=1).reshape(-1);
+    return [glyphs[values > 0], glyphs[values <= 0]];
+
+
+def write_glyph_file(glyphs, filename):
+    # Glyphs in the GMT velocity format read by velocity_io.read_horiz_vels, in one write
+    ofile = open(filename, 'w');
+    ofile.write("".join(["%s %s %s %s 0 0 0\n" % (x, y, e, n) for x, y, e, n in glyphs.tolist()]));
+    ofile.close();
     return;
 
+
 def write_multisegment_file(polygon_vertices, quantity, filename):
     # Write a quantity for each polygon, in GMT-readable format
     ofile = open(filename, 'w');
@@ -155,3 +248,18 @@ def write_multisegment_file(polygon_vertices, quantity, filename):
         ofile.write(str(polygon_vertices[i, 2, 0]) + " " + str(polygon_vertices[i, 2, 1]) + "\n");
     ofile.close();
     return;
+
+
+def write_sweep_summary(rows, keys, shared_time, filename):
+    """
+    Table of a parameter sweep: one line per combination with its directory, swept values,
+    compute and output times (s), and misfit (mm/yr, nan for methods that do not report one).
+    """
+    print("Writing sweep summary to %s " % filename);
+    with open(filename, 'w') as ofile:
+        ofile.write("# shared precomputation: %.3f s\n" % shared_time);
+        ofile.write("# directory " + " ".join(keys) + " compute_s output_s misfit\n");
+        for [directory, values, compute_time, output_time, misfit] in rows:
+            ofile.write("%s %s %.3f %.3f %s\n" % (directory, " ".join(values), compute_time, output_time,
+                                                  "nan" if misfit is None else "%.6f" % misfit));
+    return;
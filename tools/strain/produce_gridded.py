@@ -1,24 +1,30 @@
 # Convert triangulation polygon values into gridded netcdf
+# scipy.interpolate and Tectonic_Utils are only needed by the tape functions, which import them themselves.
 
 import numpy as np
-import matplotlib.path
-import scipy.interpolate as interp
 from . import strain_tensor_toolbox
-from Tectonic_Utils.read_write import netcdf_read_write
 
 
-def tri2grid(grid_inc, range_strain,  triangle_vertices, rot, exx, exy, eyy):
+def tri2grid(grid_inc, range_strain, tri_index, rot, exx, exy, eyy):
     # steps to bring delaunay 1-D quantities into the same 2-D form as the other methods
+    fields = {'rot': rot, 'exx': exx, 'exy': exy, 'eyy': eyy};
+    lons, lats, grids = tri2grid_fields(grid_inc, range_strain, tri_index, fields);
+    return lons, lats, grids['rot'], grids['exx'], grids['exy'], grids['eyy'];
+
+
+def tri2grid_fields(grid_inc, range_strain, tri_index, fields):
+    # Grid any number of per-triangle fields (strain components, uncertainties, chi2...)
+    # fields: dictionary of name: array with one value per triangle
+    # Each grid node is located once, then every field is filled with a single gather.
     lons, lats, grid = make_grid(range_strain, grid_inc);
-    print("Producing gridded dataset of Exx")
-    exx_grd = find_in_triangles(triangle_vertices, exx, lons, lats, grid);
-    print("Producing gridded dataset of: Exy")
-    exy_grd = find_in_triangles(triangle_vertices, exy, lons, lats, grid);
-    print("Producing gridded dataset of: Eyy")
-    eyy_grd = find_in_triangles(triangle_vertices, eyy, lons, lats, grid);
-    print("Producing gridded dataset of: Rot")
-    rot_grd = find_in_triangles(triangle_vertices, rot, lons, lats, grid);
-    return lons, lats, rot_grd, exx_grd, exy_grd, eyy_grd;
+    print("Producing gridded dataset of: %s" % ', '.join(fields.keys()));
+    simplex = find_in_triangles(tri_index, lons, lats);
+    names = list(fields.keys());
+    values = np.full((len(names), len(tri_index.simplices) + 1), np.nan);  # last column: outside every triangle
+    for i, name in enumerate(names):
+        values[i, :-1] = fields[name];
+    gridded = values[:, simplex];
+    return lons, lats, {name: gridded[i] for i, name in enumerate(names)};
 
 
 # makes grid for delaunay
@@ -36,17 +42,13 @@ def make_grid(coordbox, inc):
     return lons, lats, grid
 
 
-# searches path created by triangle vertices for each gridpoint, then assigns that triangle's value to the gridpoint
-def find_in_triangles(triangles, values, lons, lats, grid):
-    val_arr = np.nan*np.ones(np.shape(grid));
-    for j in range(np.shape(grid)[0]):
-        for k in range(np.shape(grid)[1]):
-            for i in range(len(triangles)):
-                tripath = matplotlib.path.Path(triangles[i])
-                if tripath.contains_point((lons[k], lats[j])):
-                    val_arr[j][k] = values[i];
-                    break;
-    return val_arr
+# locates every grid node in the triangulation at once.
+# Returns the index of the triangle holding each node, shaped like the grid, -1 outside the convex hull.
+def find_in_triangles(tri_index, lons, lats):
+    xx, yy = np.meshgrid(lons, lats);
+    nodes = np.column_stack((xx.ravel(), yy.ravel()));
+    simplex = tri_index.delaunay.find_simplex(nodes);
+    return simplex.reshape(np.shape(xx));
 
 
 def drive_tape(myParams):
@@ -68,6 +70,7 @@ def drive_tape(myParams):
     # azimuth
     azimuth = strain_tensor_toolbox.max_shortening_azimuth(e1, e2, v00, v01, v10, v11)
     newx, newy, newaz = nn_interp(x, y, azimuth, myParams.coord_box, myParams.grid_inc);
+    from Tectonic_Utils.read_write import netcdf_read_write
     netcdf_read_write.produce_output_netcdf(newx, newy, newaz, 'degrees', myParams.outdir+'azimuth.nc');
     write_tape_eigenvectors(x, y, e1, e2, v00, v01, v10, v11)
     return;
@@ -123,6 +126,7 @@ def nn_interp(x, y, vals, coord_box, inc):
     newy = np.arange(ymin, ymax, inc[1])
     tempvals = []
 
+    import scipy.interpolate as interp
     nn_interpolator = interp.NearestNDInterpolator((x, y), vals)
     for i in range(len(newx)):
         for j in range(len(newy)):
@@ -200,6 +204,7 @@ def write_tape_eigenvectors(xdata, ydata, w1, w2, v00, v01, v10, v11):
 
 # outputs a netcdf to the desired results directory
 def output_tape(lon, lat, vals, outdir, file):
+    from Tectonic_Utils.read_write import netcdf_read_write
     netcdf_read_write.produce_output_netcdf(lon, lat, vals, 'per yr', outdir+file);
     print("Success fitting wavelet-generated data to the required grid!");
     return;
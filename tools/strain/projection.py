@@ -0,0 +1,153 @@
+# Vectorized map projections shared by the strain methods.
+# Whole coordinate arrays are projected in one call, so no method has to convert points one at a time.
+# Supported: UTM (with an explicit or automatic zone), and transverse Mercator or
+# azimuthal equidistant projections centered on the data.
+# Projected coordinates are cached, so methods run in the same process can reuse them.
+
+import collections
+import hashlib
+import numpy as np
+
+WGS84_A = 6378137.0;  # semi-major axis, meters
+WGS84_F = 1 / 298.257223563;  # flattening
+WGS84_E2 = WGS84_F * (2 - WGS84_F);  # first eccentricity squared
+MEAN_RADIUS = 6371008.8;  # mean Earth radius, meters, for the spherical projections
+SUPPORTED_PROJECTIONS = ['utm', 'tmerc', 'aeqd'];
+
+_projected_cache = collections.OrderedDict();
+_max_cache_entries = 16;
+
+
+class Projection:
+    """
+    A map projection from lon/lat (degrees) to x/y (meters).
+    name: 'utm', 'tmerc' (transverse Mercator), or 'aeqd' (azimuthal equidistant)
+    lon0, lat0: projection center for tmerc and aeqd
+    zone: UTM zone (1-60); south: use the southern-hemisphere false northing
+    """
+    def __init__(self, name='utm', lon0=0.0, lat0=0.0, zone=None, south=False):
+        if name not in SUPPORTED_PROJECTIONS:
+            raise ValueError("Error! Projection %s not supported. Choose from %s" % (name, SUPPORTED_PROJECTIONS));
+        if name == 'utm' and zone is None:
+            zone = utm_zone(lon0);
+        self.name = name;
+        self.lon0 = float(lon0);
+        self.lat0 = float(lat0);
+        self.zone = zone;
+        self.south = south;
+
+    def __repr__(self):
+        if self.name == 'utm':
+            return "Projection(utm, zone=%d%s)" % (self.zone, 'S' if self.south else 'N');
+        return "Projection(%s, lon0=%f, lat0=%f)" % (self.name, self.lon0, self.lat0);
+
+    def forward(self, lon, lat):
+        """ Project arrays of lon, lat in degrees. Returns x, y in meters, shaped like the inputs. """
+        lon = np.asarray(lon, dtype=float);
+        lat = np.asarray(lat, dtype=float);
+        key = (repr(self), lon.shape, hashlib.sha1(lon.tobytes() + lat.tobytes()).hexdigest());
+        if key in _projected_cache:
+            _projected_cache.move_to_end(key);
+            return _projected_cache[key];
+        if self.name == 'utm':
+            x, y = utm_forward(lon, lat, self.zone, self.south);
+        elif self.name == 'tmerc':
+            x, y = tmerc_forward(lon, lat, self.lon0, self.lat0);
+        else:
+            x, y = aeqd_forward(lon, lat, self.lon0, self.lat0);
+        x, y = np.asarray(x, dtype=float), np.asarray(y, dtype=float);  # scalar inputs give 0-d arrays
+        x.flags.writeable = False;  # cached arrays are shared between callers
+        y.flags.writeable = False;
+        _projected_cache[key] = (x, y);
+        if len(_projected_cache) > _max_cache_entries:
+            _projected_cache.popitem(last=False);
+        return x, y;
+
+
+def projection_for_data(lon, lat, name='utm', zone=None):
+    """ Build a projection centered on the data (the middle of its lon/lat extent). """
+    lon0 = 0.5 * (np.nanmin(lon) + np.nanmax(lon));
+    lat0 = 0.5 * (np.nanmin(lat) + np.nanmax(lat));
+    if zone is not None:
+        zone = int(zone);
+        if not 1 <= zone <= 60:
+            raise ValueError("Error! UTM zone must be between 1 and 60, got %d" % zone);
+    return Projection(name=name, lon0=lon0, lat0=lat0, zone=zone, south=bool(lat0 < 0));
+
+
+def read_projection_options(method_specific_dict, default='utm'):
+    """ Optional config keys: projection = utm/tmerc/aeqd, utm_zone = integer """
+    name = method_specific_dict.get('projection', default);
+    zone = method_specific_dict.get('utm_zone', None);
+    if name not in SUPPORTED_PROJECTIONS:
+        raise ValueError("Error! Projection %s not supported. Choose from %s" % (name, SUPPORTED_PROJECTIONS));
+    return name, zone;
+
+
+def clear_cache():
+    _projected_cache.clear();
+    return;
+
+
+def utm_zone(lon):
+    # Standard 6-degree UTM zones, without the Norway/Svalbard exceptions
+    lon = (np.asarray(lon, dtype=float) + 180) % 360 - 180;
+    return (np.floor((lon + 180) / 6).astype(int) % 60) + 1;
+
+
+def utm_forward(lon, lat, zone, south=False):
+    lon0 = (int(zone) - 1) * 6 - 180 + 3;
+    x, y = tmerc_forward(lon, lat, lon0, 0.0, k0=0.9996);
+    x = x + 500000.0;
+    if south:
+        y = y + 10000000.0;
+    return x, y;
+
+
+def tmerc_forward(lon, lat, lon0, lat0=0.0, k0=1.0):
+    # Ellipsoidal transverse Mercator, series of Snyder (1987), USGS PP 1395, eqs. 8-9 and 8-10
+    phi = np.deg2rad(lat);
+    dlam = np.deg2rad((np.asarray(lon, dtype=float) - lon0 + 180) % 360 - 180);
+    ep2 = WGS84_E2 / (1 - WGS84_E2);
+    sin_phi, cos_phi, tan_phi = np.sin(phi), np.cos(phi), np.tan(phi);
+    N = WGS84_A / np.sqrt(1 - WGS84_E2 * sin_phi * sin_phi);
+    T = tan_phi * tan_phi;
+    C = ep2 * cos_phi * cos_phi;
+    A = dlam * cos_phi;
+    x = k0 * N * (A + (1 - T + C) * A**3 / 6 + (5 - 18 * T + T * T + 72 * C - 58 * ep2) * A**5 / 120);
+    y = k0 * (meridian_arc(phi) - meridian_arc(np.deg2rad(lat0)) +
+              N * tan_phi * (A * A / 2 + (5 - T + 9 * C + 4 * C * C) * A**4 / 24 +
+                             (61 - 58 * T + T * T + 600 * C - 330 * ep2) * A**6 / 720));
+    return x, y;
+
+
+def meridian_arc(phi):
+    # Distance along the meridian from the equator to latitude phi (radians), meters
+    e2 = WGS84_E2;
+    e4, e6 = e2 * e2, e2 * e2 * e2;
+    return WGS84_A * ((1 - e2 / 4 - 3 * e4 / 64 - 5 * e6 / 256) * phi -
+                      (3 * e2 / 8 + 3 * e4 / 32 + 45 * e6 / 1024) * np.sin(2 * phi) +
+                      (15 * e4 / 256 + 45 * e6 / 1024) * np.sin(4 * phi) -
+                      (35 * e6 / 3072) * np.sin(6 * phi));
+
+
+def aeqd_forward(lon, lat, lon0, lat0):
+    # Spherical azimuthal equidistant projection centered on lon0, lat0
+    phi, phi0 = np.deg2rad(lat), np.deg2rad(lat0);
+    dlam = np.deg2rad(np.asarray(lon, dtype=float) - lon0);
+    cos_c = np.sin(phi0) * np.sin(phi) + np.cos(phi0) * np.cos(phi) * np.cos(dlam);
+    c = np.arccos(np.clip(cos_c, -1, 1));
+    sin_c = np.sin(c);
+    k = np.divide(c, sin_c, out=np.ones(np.shape(c)), where=sin_c > 1e-12);
+    x = MEAN_RADIUS * k * np.cos(phi) * np.sin(dlam);
+    y = MEAN_RADIUS * k * (np.cos(phi0) * np.sin(phi) - np.sin(phi0) * np.cos(phi) * np.cos(dlam));
+    return x, y;
+
+
+def meters_per_degree(lat):
+    """ Local length of one degree of longitude and of latitude on the WGS84 ellipsoid, in meters """
+    phi = np.deg2rad(lat);
+    w = np.sqrt(1 - WGS84_E2 * np.sin(phi) ** 2);
+    m_per_deg_lon = np.pi / 180 * WGS84_A * np.cos(phi) / w;
+    m_per_deg_lat = np.pi / 180 * WGS84_A * (1 - WGS84_E2) / w ** 3;
+    return m_per_deg_lon, m_per_deg_lat;
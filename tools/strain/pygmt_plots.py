@@ -1,4 +1,18 @@
+# The grid argument of the gridded maps can be a grd filename or an xarray DataArray.
+# Eigenvectors (positive_eigs, negative_eigs) are (N, 4) arrays of lon, lat, e, n.
 import pygmt
+from . import velocity_io
+
+
+def plot_eigenvectors(fig, positive_eigs, negative_eigs):
+    # All glyphs of one sign are drawn in a single call
+    if len(positive_eigs) > 0:
+        fig.plot(x=positive_eigs[:, 0], y=positive_eigs[:, 1], style='v0.20+e+a40+gblue+h0.5+p0.3p,blue+z0.003+n0.3',
+                 pen='0.6p,blue', direction=[positive_eigs[:, 2], positive_eigs[:, 3]]);  # vectors
+    if len(negative_eigs) > 0:
+        fig.plot(x=negative_eigs[:, 0], y=negative_eigs[:, 1], style='v0.20+b+a40+gred+h0.5+p0.3p,black+z0.003+n0.3',
+                 pen='0.6p,black', direction=[negative_eigs[:, 2], negative_eigs[:, 3]]);  # vectors
+    return;
 
 
 def plot_rotation(filename, station_vels, region, outdir, outfile):
@@ -9,10 +23,11 @@ def plot_rotation(filename, station_vels, region, outdir, outfile):
     fig.grdimage(filename, region=region, C=outdir+"/mycpt.cpt");
     fig.coast(region=region, projection=proj, N='1', W='1.0p,black', S='lightblue',
               L="n0.12/0.12+c" + str(region[2]) + "+w50", B="1.0");
-    for n in station_vels:
-        fig.plot(x=n.elon, y=n.nlat, S='c0.04i', G='black', W='0.4p,white');  # station locations
-        fig.plot(x=n.elon, y=n.nlat, style='v0.20+e+a40+gblack+h0+p1p,black+z0.04', pen='0.6p,black',
-                 direction=[[n.e], [n.n]]);  # displacement vectors
+    station_vels = velocity_io.as_velocity_field(station_vels);
+    if len(station_vels) > 0:
+        fig.plot(x=station_vels.elon, y=station_vels.nlat, S='c0.04i', G='black', W='0.4p,white');  # station locations
+        fig.plot(x=station_vels.elon, y=station_vels.nlat, style='v0.20+e+a40+gblack+h0+p1p,black+z0.04',
+                 pen='0.6p,black', direction=[station_vels.e, station_vels.n]);  # displacement vectors
     fig.plot(x=region[0] + 0.9, y=region[2] + 0.1, style='v0.20+e+a40+gblack+h0+p1p,black+z0.04', pen='0.6p,black',
              direction=[[20], [0]]);  # scale vector
     fig.text(x=region[0] + 0.5, y=region[2] + 0.1, text="20 mm/yr", font='10p,Helvetica,black')
@@ -30,12 +45,7 @@ def plot_dilatation(filename, region, outdir, positive_eigs, negative_eigs, outf
     fig.grdimage(filename, region=region, C=outdir+"mycpt.cpt");
     fig.coast(region=region, projection=proj, N='1', W='1.0p,black', S='lightblue',
               L="n0.12/0.12+c" + str(region[2]) + "+w50", B="1.0");
-    for n in positive_eigs:
-        fig.plot(x=n.elon, y=n.nlat, style='v0.20+e+a40+gblue+h0.5+p0.3p,blue+z0.003+n0.3', pen='0.6p,blue',
-                 direction=[[n.e], [n.n]]);  # vectors
-    for n in negative_eigs:
-        fig.plot(x=n.elon, y=n.nlat, style='v0.20+b+a40+gred+h0.5+p0.3p,black+z0.003+n0.3', pen='0.6p,black',
-                 direction=[[n.e], [n.n]]);  # vectors
+    plot_eigenvectors(fig, positive_eigs, negative_eigs);
     # Scale vector
     fig.plot(x=region[0] + 1.1, y=region[2] + 0.1, style='v0.20+b+a40+gred+h0.5+p0.3p,black+z0.003+n0.3',
              pen='0.6p,black', direction=[[200], [0]]);
@@ -56,12 +66,7 @@ def plot_I2nd(filename, region, outdir, positive_eigs, negative_eigs, outfile):
     fig.grdimage(filename, region=region, C=outdir+"mycpt.cpt");
     fig.coast(region=region, projection=proj, N='1', W='1.0p,black', S='lightblue',
               L="n0.12/0.12+c" + str(region[2]) + "+w50", B="1.0");
-    for n in positive_eigs:
-        fig.plot(x=n.elon, y=n.nlat, style='v0.20+e+a40+gblue+h0.5+p0.3p,blue+z0.003+n0.3', pen='0.6p,blue',
-                 direction=[[n.e], [n.n]]);  # vectors
-    for n in negative_eigs:
-        fig.plot(x=n.elon, y=n.nlat, style='v0.20+b+a40+gred+h0.5+p0.3p,black+z0.003+n0.3', pen='0.6p,black',
-                 direction=[[n.e], [n.n]]);  # vectors
+    plot_eigenvectors(fig, positive_eigs, negative_eigs);
     # Scale vector
     fig.plot(x=region[0] + 1.1, y=region[2] + 0.1, style='v0.20+b+a40+gred+h0.5+p0.3p,black+z0.003+n0.3',
              pen='0.6p,black', direction=[[200], [0]]);
@@ -82,12 +87,7 @@ def plot_maxshear(filename, region, outdir, positive_eigs, negative_eigs, outfil
     fig.grdimage(filename, region=region, C=outdir+"mycpt.cpt");
     fig.coast(region=region, projection=proj, N='1', W='1.0p,black', S='lightblue',
               L="n0.12/0.12+c" + str(region[2]) + "+w50", B="1.0");
-    for n in positive_eigs:
-        fig.plot(x=n.elon, y=n.nlat, style='v0.20+e+a40+gblue+h0.5+p0.3p,blue+z0.003+n0.3', pen='0.6p,blue',
-                 direction=[[n.e], [n.n]]);  # vectors
-    for n in negative_eigs:
-        fig.plot(x=n.elon, y=n.nlat, style='v0.20+b+a40+gred+h0.5+p0.3p,black+z0.003+n0.3', pen='0.6p,black',
-                 direction=[[n.e], [n.n]]);  # vectors
+    plot_eigenvectors(fig, positive_eigs, negative_eigs);
     # Scale vector
     fig.plot(x=region[0] + 1.1, y=region[2] + 0.1, style='v0.20+b+a40+gred+h0.5+p0.3p,black+z0.003+n0.3',
              pen='0.6p,black', direction=[[200], [0]]);
@@ -108,12 +108,7 @@ def plot_azimuth(filename, region, outdir, positive_eigs, negative_eigs, outfile
     fig.grdimage(filename, region=region, C=outdir+"mycpt.cpt");
     fig.coast(region=region, projection=proj, N='1', W='1.0p,black', S='lightblue',
               L="n0.12/0.12+c" + str(region[2]) + "+w50", B="1.0");
-    for n in positive_eigs:
-        fig.plot(x=n.elon, y=n.nlat, style='v0.20+e+a40+gblue+h0.5+p0.3p,blue+z0.003+n0.3', pen='0.6p,blue',
-                 direction=[[n.e], [n.n]]);  # vectors
-    for n in negative_eigs:
-        fig.plot(x=n.elon, y=n.nlat, style='v0.20+b+a40+gred+h0.5+p0.3p,black+z0.003+n0.3', pen='0.6p,black',
-                 direction=[[n.e], [n.n]]);  # vectors
+    plot_eigenvectors(fig, positive_eigs, negative_eigs);
     # Scale vector
     fig.plot(x=region[0] + 1.1, y=region[2] + 0.1, style='v0.20+b+a40+gred+h0.5+p0.3p,black+z0.003+n0.3',
              pen='0.6p,black', direction=[[200], [0]]);
@@ -140,12 +135,7 @@ def plot_dilatation_1D(region, polygon_vertices, dilatation, outdir, positive_ei
         fig.plot(x=lons, y=lats, Z=str(dilatation[i]), pen="thinner,black", G="+z", C=outdir+"mycpt.cpt");
 
     fig.coast(N='2', W='1.0p,black', S='lightblue', L="n0.12/0.12+c" + str(region[2]) + "+w50");
-    for n in positive_eigs:
-        fig.plot(x=n.elon, y=n.nlat, style='v0.20+e+a40+gblue+h0.5+p0.3p,blue+z0.003+n0.3', pen='0.6p,blue',
-                 direction=[[n.e], [n.n]]);  # vectors
-    for n in negative_eigs:
-        fig.plot(x=n.elon, y=n.nlat, style='v0.20+b+a40+gred+h0.5+p0.3p,black+z0.003+n0.3', pen='0.6p,black',
-                 direction=[[n.e], [n.n]]);  # vectors
+    plot_eigenvectors(fig, positive_eigs, negative_eigs);
     # Scale vector
     fig.plot(x=region[0] + 1.1, y=region[2] + 0.1, style='v0.20+b+a40+gred+h0.5+p0.3p,black+z0.003+n0.3',
              pen='0.6p,black', direction=[[200], [0]]);
@@ -172,12 +162,7 @@ def plot_I2nd_1D(region, polygon_vertices, I2nd, outdir, positive_eigs, negative
         fig.plot(x=lons, y=lats, Z=str(I2nd[i]), pen="thinner,black", G="+z", C=outdir+"mycpt.cpt");
 
     fig.coast(N='2', W='1.0p,black', S='lightblue', L="n0.12/0.12+c" + str(region[2]) + "+w50");
-    for n in positive_eigs:
-        fig.plot(x=n.elon, y=n.nlat, style='v0.20+e+a40+gblue+h0.5+p0.3p,blue+z0.003+n0.3', pen='0.6p,blue',
-                 direction=[[n.e], [n.n]]);  # vectors
-    for n in negative_eigs:
-        fig.plot(x=n.elon, y=n.nlat, style='v0.20+b+a40+gred+h0.5+p0.3p,black+z0.003+n0.3', pen='0.6p,black',
-                 direction=[[n.e], [n.n]]);  # vectors
+    plot_eigenvectors(fig, positive_eigs, negative_eigs);
     # Scale vector
     fig.plot(x=region[0] + 1.1, y=region[2] + 0.1, style='v0.20+b+a40+gred+h0.5+p0.3p,black+z0.003+n0.3',
              pen='0.6p,black', direction=[[200], [0]]);
@@ -0,0 +1,137 @@
+# Resampling of strain grids onto the target grid of a comparison.
+# Grids are rectilinear, so interpolation is separable: the indices and weights along x and along y are
+# precomputed once per distinct source grid and then applied to whole arrays (or blocks of rows) at once.
+
+import collections
+import numpy as np
+from . import produce_gridded
+from .configure_functions import REGRID_METHODS
+
+# Along each axis: the two bracketing source indices and the weight of the second, or -1 outside the source grid
+RegridIndex = collections.namedtuple('RegridIndex', ['method', 'ix0', 'ix1', 'wx', 'iy0', 'iy1', 'wy']);
+
+
+def target_axes(range_strain, inc):
+    # The grid that the strain methods compute on, from the config range and increment
+    lons, lats, _ = produce_gridded.make_grid(range_strain, inc);
+    return lons, lats;
+
+
+def grid_matches(lon, lat, target_lon, target_lat, tolerance=1e-6):
+    return (len(lon) == len(target_lon) and len(lat) == len(target_lat) and
+            np.allclose(lon, target_lon, atol=tolerance, rtol=0) and
+            np.allclose(lat, target_lat, atol=tolerance, rtol=0));
+
+
+def axis_index(source_axis, target_axis, method):
+    """
+    Bracketing indices and weights of each target coordinate on one (ascending or descending) source axis.
+    Target coordinates outside the source axis, by more than half a source cell for 'nearest', get index -1.
+    """
+    source_axis = np.asarray(source_axis, dtype=float);
+    target_axis = np.asarray(target_axis, dtype=float);
+    n = len(source_axis);
+    descending = n > 1 and source_axis[-1] < source_axis[0];
+    ascending_axis = source_axis[::-1] if descending else source_axis;
+    i1 = np.clip(np.searchsorted(ascending_axis, target_axis), 1, max(n - 1, 1));
+    i0 = i1 - 1;
+    spacing = ascending_axis[i1] - ascending_axis[i0];
+    weight = np.divide(target_axis - ascending_axis[i0], spacing, out=np.zeros(len(target_axis)), where=spacing > 0);
+    if method == 'nearest':
+        outside = (weight < -0.5) | (weight > 1.5);
+        i0 = np.where(weight > 0.5, i1, i0);
+        i1, weight = i0, np.zeros(len(target_axis));
+    else:
+        tolerance = 1e-9;
+        outside = (weight < -tolerance) | (weight > 1 + tolerance);
+        weight = np.clip(weight, 0, 1);
+    if descending:
+        i0, i1 = n - 1 - i0, n - 1 - i1;
+    i0 = np.where(outside, -1, i0);
+    i1 = np.where(outside, -1, i1);
+    return i0, i1, weight;
+
+
+def build_regrid_index(lon, lat, target_lon, target_lat, method='bilinear'):
+    if method not in REGRID_METHODS[1:]:
+        raise ValueError("Error! Regrid method %s not supported. Choose from %s" % (method, REGRID_METHODS));
+    if len(lon) < 2 or len(lat) < 2:
+        raise ValueError("Error! Cannot regrid a grid with fewer than two rows or columns");
+    ix0, ix1, wx = axis_index(lon, target_lon, method);
+    iy0, iy1, wy = axis_index(lat, target_lat, method);
+    return RegridIndex(method=method, ix0=ix0, ix1=ix1, wx=wx, iy0=iy0, iy1=iy1, wy=wy);
+
+
+def regrid_rows(index, read_rows, row_start, row_end, axial=False):
+    """
+    Rows row_start:row_end of the target grid.
+    read_rows(start, end) returns rows start:end of the source grid (an array slice, or a lazy netcdf read);
+    only the source rows that the target rows need are requested.
+    axial: values are axial angles in degrees (azimuths, which wrap at 0/180), interpolated as doubled-angle vectors
+    """
+    iy0, iy1, wy = index.iy0[row_start:row_end], index.iy1[row_start:row_end], index.wy[row_start:row_end];
+    output = np.full((len(wy), len(index.wx)), np.nan);
+    inside_y = iy0 >= 0;
+    inside_x = index.ix0 >= 0;
+    if not np.any(inside_y) or not np.any(inside_x):
+        return output;
+    first = min(np.min(iy0[inside_y]), np.min(iy1[inside_y]));
+    last = max(np.max(iy0[inside_y]), np.max(iy1[inside_y]));
+    source = np.asarray(read_rows(first, last + 1), dtype=float);
+    ix0, ix1, wx = index.ix0[inside_x], index.ix1[inside_x], index.wx[inside_x];
+    rows0, rows1 = iy0[inside_y] - first, iy1[inside_y] - first;
+    w = wy[inside_y][:, np.newaxis];
+
+    def interpolate(grid):
+        # along x on both bracketing rows, then along y
+        lower = blend(grid[rows0][:, ix0], grid[rows0][:, ix1], wx);
+        upper = blend(grid[rows1][:, ix0], grid[rows1][:, ix1], wx);
+        return blend(lower, upper, w);
+
+    if axial:
+        doubled = np.radians(2 * source);
+        values = np.mod(np.degrees(np.arctan2(interpolate(np.sin(doubled)), interpolate(np.cos(doubled)))) / 2, 180);
+    else:
+        values = interpolate(source);
+    output[np.ix_(inside_y, inside_x)] = values;
+    return output;
+
+
+def blend(first, second, weight):
+    # first * (1 - weight) + second * weight, where a neighbour with zero weight (even a nan one) contributes nothing
+    with np.errstate(invalid='ignore'):
+        return np.where(weight == 1, 0, first * (1 - weight)) + np.where(weight == 0, 0, second * weight);
+
+
+def regrid_values(index, values, axial=False):
+    # Resample a whole source grid onto the target grid
+    return regrid_rows(index, lambda start, end: values[start:end], 0, len(index.wy), axial);
+
+
+def is_axial(filename):
+    # Quantities that are axial angles and must not be blended linearly across the 0/180 wrap
+    return filename == "azimuth.nc";
+
+
+def regrid_strain_values(strain_values_dict, target_lon, target_lat, method='bilinear', index_cache=None,
+                         axial=False):
+    """
+    Put every method's grid onto the target grid, in place. Grids that already match are left untouched.
+    strain_values_dict: {method: [lon, lat, val]}
+    index_cache: optional dictionary shared across calls, so each distinct source grid is indexed only once
+    axial: the values are azimuths in degrees, see regrid_rows
+    """
+    if method == 'none':
+        return strain_values_dict;
+    if index_cache is None:
+        index_cache = {};
+    for key in strain_values_dict.keys():
+        lon, lat, val = strain_values_dict[key];
+        if grid_matches(lon, lat, target_lon, target_lat):
+            continue;
+        print("Regridding %s onto the comparison grid (%s)" % (key, method));
+        source_key = (np.asarray(lon, dtype=float).tobytes(), np.asarray(lat, dtype=float).tobytes());
+        if source_key not in index_cache:
+            index_cache[source_key] = build_regrid_index(lon, lat, target_lon, target_lat, method);
+        strain_values_dict[key] = [target_lon, target_lat, regrid_values(index_cache[source_key], val, axial)];
+    return strain_values_dict;
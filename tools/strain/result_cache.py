@@ -0,0 +1,116 @@
+# An on-disk cache of computed strain grids, addressed by the content of a run's inputs.
+# The key is a sha256 hash of the cleaned velocity arrays and every parameter that affects the strain calculation,
+# so a rerun with the same data and configuration skips straight to the output stage.
+# The store is bounded in size; the least recently used results are evicted first.
+
+import hashlib
+import json
+import os
+import numpy as np
+from . import velocity_io
+
+CACHE_VERSION = 2;  # bump when the stored layout or the meaning of a key changes
+GRID_NAMES = ['lons', 'lats', 'rot', 'exx', 'exy', 'eyy'];
+UNCERTAINTY_PREFIX = 'uncertainty_';  # stored uncertainty and chi2 grids, for methods that report them
+
+
+def cache_key(MyParams, myVelfield):
+    # Hash of the cleaned velocities and the parameters of one strain method
+    myVelfield = velocity_io.as_velocity_field(myVelfield);
+    digest = hashlib.sha256();
+    for column in myVelfield.columns:
+        digest.update(np.ascontiguousarray(getattr(myVelfield, column), dtype=float).tobytes());
+    parameters = {'version': CACHE_VERSION, 'strain_method': MyParams.strain_method,
+                  'range_strain': [float(x) for x in MyParams.range_strain],
+                  'range_data': [float(x) for x in MyParams.range_data],
+                  'inc': [float(x) for x in MyParams.inc],
+                  'method_specific': {str(k): str(v) for k, v in MyParams.method_specific.items()}};
+    digest.update(json.dumps(parameters, sort_keys=True).encode());
+    return digest.hexdigest();
+
+
+def cache_filename(cache_dir, key):
+    return os.path.join(cache_dir, key + '.npz');
+
+
+def load_result(cache_dir, key, uncertainties=None):
+    """
+    Stored result for key, or None on a miss.
+    Returns [[lons, lats, rot, exx, exy, eyy], misfit]; a hit marks the entry as recently used.
+    uncertainties: optional dictionary, filled with the stored uncertainty grids on a hit
+    """
+    filename = cache_filename(cache_dir, key);
+    try:
+        with np.load(filename) as stored:
+            grids = [stored[name] for name in GRID_NAMES];
+            misfit = float(stored['misfit']) if 'misfit' in stored.files else None;
+            stored_uncertainties = {name[len(UNCERTAINTY_PREFIX):]: stored[name] for name in stored.files
+                                    if name.startswith(UNCERTAINTY_PREFIX)};
+        os.utime(filename);
+    except (OSError, KeyError, ValueError):
+        return None;
+    print("Using cached strain result %s" % filename);
+    if uncertainties is not None:
+        uncertainties.update(stored_uncertainties);
+    return [grids, None if misfit is None or np.isnan(misfit) else misfit];
+
+
+def store_result(cache_dir, key, grids, misfit=None, max_size_mb=1024, uncertainties=None):
+    # Store one result (written to a temporary file and renamed, so readers never see a partial file), then evict
+    os.makedirs(cache_dir, exist_ok=True);
+    filename = cache_filename(cache_dir, key);
+    temp_filename = filename + '.%d.tmp' % os.getpid();
+    arrays = dict(zip(GRID_NAMES, grids));
+    for name, values in (uncertainties or {}).items():
+        arrays[UNCERTAINTY_PREFIX + name] = values;
+    with open(temp_filename, 'wb') as ofile:
+        np.savez(ofile, misfit=np.nan if misfit is None else misfit, **arrays);
+    os.replace(temp_filename, filename);
+    print("Cached strain result %s" % filename);
+    evict(cache_dir, max_size_mb);
+    return;
+
+
+def evict(cache_dir, max_size_mb):
+    # Remove the least recently used entries until the store fits in max_size_mb
+    entries = [];
+    for name in os.listdir(cache_dir):
+        if not name.endswith('.npz'):
+            continue;
+        try:
+            status = os.stat(os.path.join(cache_dir, name));
+        except OSError:
+            continue;  # removed by another process
+        entries.append((status.st_mtime_ns, status.st_size, name));
+    entries.sort();
+    total = sum([entry[1] for entry in entries]);
+    max_size = max_size_mb * 1024 * 1024;
+    for _, size, name in entries[:-1]:  # never evict the newest entry
+        if total <= max_size:
+            break;
+        try:
+            os.remove(os.path.join(cache_dir, name));
+        except OSError:
+            pass;
+        total -= size;
+    return;
+
+
+def cached_compute(MyParams, myVelfield, compute, cache_options, uncertainties=None):
+    """
+    Run compute() (returning [[lons, lats, rot, exx, exy, eyy], misfit]) through the cache.
+    cache_options: from configure_functions.get_cache_options; force = True recomputes and replaces the entry.
+    uncertainties: optional dictionary that compute() fills with uncertainty grids; cached with the result,
+                   and filled from the cache on a hit
+    Returns [[lons, lats, rot, exx, exy, eyy], misfit or None if the method reports none].
+    """
+    if not cache_options['enabled']:
+        return compute();
+    key = cache_key(MyParams, myVelfield);
+    if not cache_options['force']:
+        result = load_result(cache_options['directory'], key, uncertainties);
+        if result is not None:
+            return result;
+    [grids, misfit] = compute();
+    store_result(cache_options['directory'], key, grids, misfit, cache_options['max_size_mb'], uncertainties);
+    return [grids, misfit];
@@ -8,7 +8,6 @@
 
 
 import numpy as np
-import math as m
 
 
 def second_invariant(exx, exy, eyy):
@@ -62,66 +61,48 @@ def compute_strain_components_from_dx(dudx, dvdx, dudy, dvdy):
 
 
 def max_shortening_azimuth(e1, e2, v00, v01, v10, v11):
-    dshape = np.shape(e1);
-    az = np.zeros(dshape);
-    if len(dshape) == 1:
-        for i in range(len(e1)):
-            az[i] = azimuth_math(e1[i], e2[i], v00[i], v01[i], v10[i], v11[i]);
-            if az[i] > 180:
-                print("Found an azimuth over 180 degrees. Please fix this.  %d " % i)
-    if len(dshape) == 2:
-        for i in range(len(e1)):
-            for j in range(len(e1[0])):
-                az[i][j] = azimuth_math(e1[i][j], e2[i][j], v00[i][j], v01[i][j], v10[i][j], v11[i][j]);
-                if az[i][j] > 179.999:
-                    print("Found an azimuth over 180 degrees. Please fix this.  %d " % i, j)
+    # e1, e2, v00... can be 1d arrays (triangles) or 2D arrays (grids)
+    az = azimuth_math(np.asarray(e1), np.asarray(e2), np.asarray(v00), np.asarray(v01), np.asarray(v10),
+                      np.asarray(v11));
+    if np.any(az > 179.999):
+        print("Found %d azimuths over 180 degrees. Please fix this." % np.sum(az > 179.999));
     print("Minimum azimuth: %.3f degrees" % np.nanmin(az))
     print("Maximum azimuth: %.3f degrees" % np.nanmax(az))
     return az;
 
 
 def azimuth_math(e1, e2, v00, v01, v10, v11):
-    if e1 < e2:
-        maxv = np.array([v00, v10])
-    else:
-        maxv = np.array([v01, v11])
-    strike = np.arctan2(maxv[1], maxv[0])
-    theta = 90 - m.degrees(strike)
-    if theta < 0:
-        theta = 180 + theta
-    elif theta > 180:
-        theta = theta - 180
-    return theta
+    # Works on scalars or on arrays of any shape.
+    # The azimuth of the eigenvector with the smaller (most compressive) eigenvalue, in degrees from north, 0-180.
+    use_first = e1 < e2;
+    maxv_x = np.where(use_first, v00, v01);
+    maxv_y = np.where(use_first, v10, v11);
+    strike = np.arctan2(maxv_y, maxv_x)
+    theta = 90 - np.degrees(strike)
+    theta = np.where(theta < 0, 180 + theta, np.where(theta > 180, theta - 180, theta));
+    return theta[()];
 
 
 def compute_eigenvectors(exx, exy, eyy):
     # exx, eyy can be 1d arrays or 2D arrays
-    e1 = np.zeros(np.shape(exx));
-    e2 = np.zeros(np.shape(exx));  # eigenvalues
-    v00 = np.zeros(np.shape(exx));
-    v01 = np.zeros(np.shape(exx));
-    v10 = np.zeros(np.shape(exx));
-    v11 = np.zeros(np.shape(exx));  # eigenvectors
-    dshape = np.shape(exx);
-    if len(dshape) == 1:
-        for i in range(len(exx)):
-            [e11, e22, v] = eigenvector_eigenvalue(exx[i], exy[i], eyy[i]);
-            e1[i] = e11;  # the convention of this code returns negative eigenvalues compared to my other codes.
-            e2[i] = e22;
-            v00[i] = v[0][0];
-            v10[i] = v[1][0];
-            v01[i] = v[0][1];
-            v11[i] = v[1][1];
-    elif len(dshape) == 2:
-        for j in range(dshape[0]):
-            for i in range(dshape[1]):
-                [e11, e22, v] = eigenvector_eigenvalue(exx[j][i], exy[j][i], eyy[j][i]);
-                e1[j][i] = e11;
-                e2[j][i] = e22;
-                v00[j][i] = v[0][0];
-                v01[j][i] = v[0][1];
-                v10[j][i] = v[1][0];
-                v11[j][i] = v[1][1];
+    # Closed form for the symmetric 2x2 tensor, following the order and sign conventions of np.linalg.eig:
+    # e1 is the eigenvalue closer to exx, [v00, v10] is its eigenvector, and [v01, v11] belongs to e2.
+    # Cells with NaN components give NaN eigenvalues and eigenvectors.
+    exx = np.asarray(exx, dtype=float);
+    exy = np.asarray(exy, dtype=float);
+    eyy = np.asarray(eyy, dtype=float);
+    mean = 0.5 * (exx + eyy);
+    half_diff = 0.5 * (exx - eyy);
+    radius = np.hypot(half_diff, exy);
+    sign = np.where(half_diff >= 0, 1.0, -1.0);
+    e1 = mean + sign * radius;
+    e2 = mean - sign * radius;  # the convention of this code returns negative eigenvalues compared to my other codes.
+    angle = 0.5 * np.arctan2(sign * exy, sign * half_diff);  # rotation from the x axis to the e1 eigenvector
+    vector_sign = np.where(exy == 0, 1.0, sign);
+    v00 = vector_sign * np.cos(angle);
+    v10 = vector_sign * np.sin(angle);
+    v01 = -v10;
+    v11 = v00.copy();
     return [e1, e2, v00, v01, v10, v11];
 
 
@@ -129,28 +110,57 @@ def compute_derived_quantities(exx, exy, eyy):
     # Given the basic components of the strain tensor, compute the rest of the derived quantities
     # like 2nd invariant, azimuth of maximum strain, dilatation, etc.
     # exx, eyy can be 1d arrays or 2D arrays
-
-    I2nd = np.zeros(np.shape(exx));
-    max_shear = np.zeros(np.shape(exx));
-    dilatation = np.zeros(np.shape(exx));
-    azimuth = np.zeros(np.shape(exx));
-    [e1, e2, v00, v01, v10, v11] = compute_eigenvectors(exx, exy, eyy);
-
-    dshape = np.shape(exx);
-    if len(dshape) == 1:
-        datalength = dshape[0];
-        print("Computing strain invariants for 1d dataset with length %d." % datalength);
-        for i in range(datalength):
-            dilatation[i] = e1[i] + e2[i];
-            I2nd[i] = np.log10(np.abs(second_invariant(e1[i], 0, e2[i])));
-            max_shear[i] = abs((-e1[i] + e2[i]) / 2);
-            azimuth[i] = azimuth_math(e1[i], e2[i], v00[i], v01[i], v10[i], v11[i]);
-    elif len(dshape) == 2:
-        print("Computing strain invariants for 2d dataset.");
-        for j in range(dshape[0]):
-            for i in range(dshape[1]):
-                I2nd[j][i] = np.log10(np.abs(second_invariant(e1[j][i], 0, e2[j][i])));
-                max_shear[j][i] = abs((e1[j][i] - e2[j][i]) / 2);
-                dilatation[j][i] = e1[j][i] + e2[j][i];
-                azimuth[j][i] = azimuth_math(e1[j][i], e2[j][i], v00[j][i], v01[j][i], v10[j][i], v11[j][i]);
-    return [I2nd, max_shear, dilatation, azimuth];
+    derived = derived_quantities_kernel(exx, exy, eyy, quantities=['I2nd', 'max_shear', 'dilatation', 'azimuth']);
+    return [derived['I2nd'], derived['max_shear'], derived['dilatation'], derived['azimuth']];
+
+
+DERIVED_QUANTITIES = ['I2nd', 'max_shear', 'dilatation', 'azimuth', 'e1', 'e2', 'v00', 'v01', 'v10', 'v11'];
+
+
+def derived_quantities_kernel(exx, exy, eyy, quantities=None, out=None, block_size=262144):
+    """
+    Compute the derived quantities of a strain-rate field in one pass over the data.
+    The eigen-decomposition is done once per cell and shared by every output.
+
+    exx, exy, eyy: arrays of any shape (triangles or grids)
+    quantities: names from DERIVED_QUANTITIES to return (default: all of them)
+    out: optional dictionary of preallocated arrays, shaped like exx and C-contiguous, to write into
+    block_size: cells per block; temporaries never grow beyond this, whatever the grid size
+    Returns a dictionary of name: array.
+    """
+    if quantities is None:
+        quantities = DERIVED_QUANTITIES;
+    for name in quantities:
+        if name not in DERIVED_QUANTITIES:
+            raise ValueError("Error! Unknown derived quantity %s. Choose from %s" % (name, DERIVED_QUANTITIES));
+    exx = np.asarray(exx, dtype=float);
+    exy = np.asarray(exy, dtype=float);
+    eyy = np.asarray(eyy, dtype=float);
+    if out is None:
+        out = {};
+    for name in quantities:
+        if name not in out:
+            out[name] = np.empty(np.shape(exx));
+        elif np.shape(out[name]) != np.shape(exx) or not out[name].flags['C_CONTIGUOUS']:
+            raise ValueError("Error! Output array for %s must be C-contiguous with shape %s" % (name, np.shape(exx)));
+    print("Computing strain invariants for %dd dataset with shape %s." % (np.ndim(exx), np.shape(exx)));
+
+    flat_in = [np.ravel(exx), np.ravel(exy), np.ravel(eyy)];
+    flat_out = {name: out[name].reshape(-1) for name in quantities};  # views into the output arrays
+    for start in range(0, len(flat_in[0]), block_size):
+        block = slice(start, start + block_size);
+        [e1, e2, v00, v01, v10, v11] = compute_eigenvectors(flat_in[0][block], flat_in[1][block], flat_in[2][block]);
+        eigen = {'e1': e1, 'e2': e2, 'v00': v00, 'v01': v01, 'v10': v10, 'v11': v11};
+        for name in quantities:
+            if name in eigen:
+                flat_out[name][block] = eigen[name];
+            elif name == 'I2nd':
+                with np.errstate(divide='ignore'):
+                    np.log10(np.abs(second_invariant(e1, 0, e2)), out=flat_out[name][block]);
+            elif name == 'max_shear':
+                np.abs((e1 - e2) / 2, out=flat_out[name][block]);
+            elif name == 'dilatation':
+                np.add(e1, e2, out=flat_out[name][block]);
+            elif name == 'azimuth':
+                flat_out[name][block] = azimuth_math(e1, e2, v00, v01, v10, v11);
+    return {name: out[name] for name in quantities};
@@ -0,0 +1,205 @@
+# Out-of-core comparison of many strain runs.
+# Input grids are read lazily, a block of rows at a time, and statistics are accumulated across runs:
+# running means and variances (Welford), circular statistics for azimuth, and optional percentiles.
+# Output grids are written block by block, so peak memory depends on the block size, not on the number of runs.
+
+import os
+import warnings
+import numpy as np
+from . import compare_grd_functions as comp
+from . import regrid
+from .output_manager import COMBINED_FILENAME
+
+
+class RunningStats:
+    """
+    Welford accumulator of the nan-aware mean and (population) variance of a block of rows, across runs.
+    Matches np.nanmean and np.nanstd along the run axis.
+    """
+    def __init__(self, shape):
+        self.count = np.zeros(shape);
+        self.mean = np.zeros(shape);
+        self.m2 = np.zeros(shape);
+
+    def add(self, values):
+        valid = ~np.isnan(values);
+        self.count += valid;
+        delta = np.where(valid, values - self.mean, 0);
+        self.mean += np.divide(delta, self.count, out=np.zeros(np.shape(delta)), where=valid);
+        self.m2 += np.where(valid, delta * (values - self.mean), 0);
+        return;
+
+    def results(self):
+        # mean and standard deviation; nan where no run had a value
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = np.where(self.count > 0, self.mean, np.nan);
+            std = np.sqrt(np.where(self.count > 0, self.m2 / self.count, np.nan));
+        return mean, std;
+
+
+class RunningAngles:
+    """ Accumulator of the doubled-angle mean vector of azimuths (degrees), across runs """
+    def __init__(self, shape):
+        self.count = np.zeros(shape);
+        self.sin_sum = np.zeros(shape);
+        self.cos_sum = np.zeros(shape);
+
+    def add(self, azimuths):
+        valid = ~np.isnan(azimuths);
+        doubled = 2 * np.radians(90 - np.where(valid, azimuths, 0));
+        self.count += valid;
+        self.sin_sum += np.where(valid, np.sin(doubled), 0);
+        self.cos_sum += np.where(valid, np.cos(doubled), 0);
+        return;
+
+    def results(self):
+        # circular mean and deviation, with the conventions of compare_grd_functions.angle_means
+        with np.errstate(invalid='ignore', divide='ignore'):
+            s = self.sin_sum / self.count;
+            c = self.cos_sum / self.count;
+        theta, sd = comp.angle_stats_from_mean_vector(s, c);
+        sd = np.where(sd == float("inf"), np.nan, sd);
+        return theta, sd;
+
+
+def open_run_grid(directory, filename):
+    """
+    Open one run's grid lazily. Uses the separate grd file if present, otherwise the variable of the combined file.
+    Returns [dataset, lon, lat, variable]; only the coordinates are read.
+    """
+    import netCDF4
+    specific_filename = directory + "/" + filename;
+    combined_filename = directory + "/" + COMBINED_FILENAME;
+    if os.path.isfile(specific_filename):
+        dataset = netCDF4.Dataset(specific_filename, 'r');
+        variable = [v for v in dataset.variables.values() if v.ndim == 2][0];
+    elif os.path.isfile(combined_filename):
+        dataset = netCDF4.Dataset(combined_filename, 'r');
+        variable = dataset.variables[filename.replace('.nc', '')];
+    else:
+        raise Exception("Error! Can't find file %s " % specific_filename);
+    lat = dataset.variables[variable.dimensions[0]][:].astype(float);
+    lon = dataset.variables[variable.dimensions[1]][:].astype(float);
+    return [dataset, np.ma.filled(lon, np.nan), np.ma.filled(lat, np.nan), variable];
+
+
+def read_rows(variable, row_start, row_end):
+    # One block of rows of a lazily-opened grid, as floats with nan for missing values
+    return np.ma.filled(variable[row_start:row_end, :].astype(float), np.nan);
+
+
+def create_output_grid(lons, lats, units, filename):
+    # An empty x/y/z netcdf grid (the layout of netcdf_read_write.produce_output_netcdf), to be filled by rows
+    print("Writing output netcdf to file %s " % filename);
+    import netCDF4
+    dataset = netCDF4.Dataset(filename, 'w', format='NETCDF3_64BIT_OFFSET');
+    dataset.history = 'Created by Strain_2D streaming comparison';
+    dataset.createDimension('x', len(lons));
+    dataset.createDimension('y', len(lats));
+    x = dataset.createVariable('x', float, ('x',));
+    x[:] = lons;
+    x.units = 'range';
+    y = dataset.createVariable('y', float, ('y',));
+    y[:] = lats;
+    y.units = 'azimuth';
+    z = dataset.createVariable('z', float, ('y', 'x',));
+    z.units = units;
+    return dataset;
+
+
+def compare_streaming(MyParams, filename, statistic='linear', block_rows=256, percentiles=(), regrid_method='none'):
+    """
+    Streaming version of the comparison of one quantity across all runs in MyParams.strain_dict.
+    statistic: 'linear' (means/deviations), 'log' (statistics of 10**value, like I2nd), or 'angle' (azimuths)
+    percentiles: optional list of percentiles (0-100) to write as percentile<p>_<filename>.
+                 These need every run's values for one block, so they cost nruns * block_rows * nx floats.
+    regrid_method: 'bilinear' or 'nearest' resamples runs that are not on the comparison grid, as they are read
+    Writes means_<filename> and deviations_<filename> into MyParams.outdir, block by block.
+    """
+    runs = {method: open_run_grid(MyParams.strain_dict[method], filename) for method in MyParams.strain_dict.keys()};
+    regrid_indices = regrid_runs(MyParams, runs, regrid_method);
+    check_values = {};
+    for method in runs.keys():
+        values = runs[method][3];
+        if method in regrid_indices:  # regridded values only exist per block; check the target shape instead
+            values = np.broadcast_to(np.nan, (len(runs[method][2]), len(runs[method][1])));
+        check_values[method] = [runs[method][1], runs[method][2], values];
+    comp.defensive_programming(MyParams, check_values);
+    method1 = list(runs.keys())[0];
+    lons, lats = runs[method1][1], runs[method1][2];
+    nrows, ncols = len(lats), len(lons);
+    print("Streaming %s across %d runs in blocks of %d rows" % (filename, len(runs), block_rows));
+
+    outputs = {'means': create_output_grid(lons, lats, 'per year', MyParams.outdir + "/means_" + filename),
+               'deviations': create_output_grid(lons, lats, 'per year', MyParams.outdir + "/deviations_" + filename)};
+    for p in percentiles:
+        outputs['percentile%g' % p] = create_output_grid(lons, lats, 'per year',
+                                                         MyParams.outdir + "/percentile%g_" % p + filename);
+    for row_start in range(0, nrows, block_rows):
+        row_end = min(row_start + block_rows, nrows);
+        shape = (row_end - row_start, ncols);
+        stats = RunningAngles(shape) if statistic == 'angle' else RunningStats(shape);
+        block_values = [];
+        for method in runs.keys():
+            if method in regrid_indices:
+                variable = runs[method][3];
+                values = regrid.regrid_rows(regrid_indices[method],
+                                            lambda start, end: read_rows(variable, start, end), row_start, row_end,
+                                            axial=(statistic == 'angle'));
+            else:
+                values = read_rows(runs[method][3], row_start, row_end);
+            if statistic == 'log':
+                values = np.power(10, values);
+            stats.add(values);
+            if percentiles:
+                block_values.append(values);
+        mean, sd = stats.results();
+        if statistic == 'log':
+            mean, sd = comp.log10_positive(mean), comp.log10_positive(sd);
+        outputs['means'].variables['z'][row_start:row_end, :] = mean;
+        outputs['deviations'].variables['z'][row_start:row_end, :] = sd;
+        if percentiles:
+            block_percentiles = block_percentile_values(np.stack(block_values), percentiles, statistic);
+            for p, values in zip(percentiles, block_percentiles):
+                outputs['percentile%g' % p].variables['z'][row_start:row_end, :] = values;
+
+    for dataset in outputs.values():
+        dataset.close();
+    for method in runs.keys():
+        runs[method][0].close();
+    return;
+
+
+def regrid_runs(MyParams, runs, regrid_method):
+    # Regrid indices for the runs that are not on the comparison grid; their coordinates become the target's
+    regrid_indices, index_cache = {}, {};
+    if regrid_method == 'none':
+        return regrid_indices;
+    target_lon, target_lat = regrid.target_axes(MyParams.range_strain, MyParams.inc);
+    for method in runs.keys():
+        lon, lat = runs[method][1], runs[method][2];
+        if regrid.grid_matches(lon, lat, target_lon, target_lat):
+            continue;
+        source_key = (lon.tobytes(), lat.tobytes());
+        if source_key not in index_cache:
+            index_cache[source_key] = regrid.build_regrid_index(lon, lat, target_lon, target_lat, regrid_method);
+        print("Regridding %s onto the comparison grid (%s)" % (method, regrid_method));
+        regrid_indices[method] = index_cache[source_key];
+        runs[method][1], runs[method][2] = target_lon, target_lat;
+    return regrid_indices;
+
+
+def block_percentile_values(block_cube, percentiles, statistic='linear'):
+    # Percentiles along the run axis of a (nruns, rows, ncols) block; log quantities are returned in log space.
+    # Azimuths are axial: they are unwrapped to within 90 degrees of their circular mean before taking percentiles.
+    if statistic == 'angle':
+        center, _ = comp.angle_mean_math(block_cube, axis=0);
+        block_cube = np.mod(block_cube - center + 90, 180) - 90;
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", category=RuntimeWarning);  # all-nan cells
+        values = np.nanpercentile(block_cube, percentiles, axis=0);
+    if statistic == 'angle':
+        values = np.mod(values + center, 180);
+    elif statistic == 'log':
+        values = comp.log10_positive(values);
+    return values;
@@ -0,0 +1,35 @@
+# A triangle-index structure shared by the Delaunay strain methods.
+# Stations are located by their index in the velocity field, never by comparing coordinates,
+# so later stages (strain solvers, gridding, polygon outputs) can gather per-vertex values with fancy indexing.
+
+import collections
+import numpy as np
+from scipy.spatial import Delaunay
+
+TriangleIndex = collections.namedtuple('TriangleIndex', ['points', 'simplices', 'neighbors', 'vertices',
+                                                         'xcentroid', 'ycentroid', 'delaunay']);
+
+
+def build_triangle_index(elon, nlat):
+    """
+    Triangulate a set of stations and keep everything the Delaunay methods need.
+
+    points:    (nstations, 2) array of lon, lat
+    simplices: (ntri, 3) station indices of each triangle
+    neighbors: (ntri, 3) index of the neighboring triangle across from each vertex, -1 on the hull
+    vertices:  (ntri, 3, 2) lon, lat of each triangle vertex
+    xcentroid, ycentroid: (ntri,) centroid of each triangle
+    delaunay:  the scipy.spatial.Delaunay object, for point location
+    """
+    points = np.column_stack((np.asarray(elon, dtype=float), np.asarray(nlat, dtype=float)));
+    tri = Delaunay(points);
+    vertices = points[tri.simplices];
+    centroids = np.mean(vertices, axis=1);
+    print("Number of triangle elements: %d" % (len(tri.simplices)));
+    return TriangleIndex(points=points, simplices=tri.simplices, neighbors=tri.neighbors, vertices=vertices,
+                         xcentroid=centroids[:, 0], ycentroid=centroids[:, 1], delaunay=tri);
+
+
+def gather(tri_index, values):
+    """ Per-station values -> (ntri, 3) array of the values at each triangle's vertices """
+    return np.asarray(values)[tri_index.simplices];
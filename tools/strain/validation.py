@@ -0,0 +1,154 @@
+# Validation of an input velocity field before any strain method sees it.
+# Every check is an array operation over the whole field: bounding box, zero or NaN uncertainties,
+# and non-finite velocities. Colocated or duplicate stations (common when merging networks) are found with a
+# KD-tree and merged, weight-averaged, or dropped, since they make degenerate Delaunay triangles.
+# The stage returns a summary of what it did, which is also written as JSON into the output directory.
+
+import json
+import numpy as np
+from . import velocity_io
+from .configure_functions import MERGE_POLICIES, INVALID_POLICIES
+from .projection import MEAN_RADIUS
+
+SUMMARY_FILENAME = 'validation_summary.json';
+
+
+def validate_velfield(myVelfield, coord_box=None, merge_distance=0.0, merge_policy='weighted', invalid='raise'):
+    """
+    Check and clean a velocity field.
+    coord_box: optional [W, E, S, N]; stations outside it are removed
+    merge_distance: stations within this distance (km) of each other form one group; 0 groups only exact duplicates
+    merge_policy: 'mean' (plain average of each group), 'weighted' (inverse-variance average),
+                  or 'drop' (keep the station with the smallest horizontal uncertainty in each group)
+    invalid: 'raise' (stop on zero/NaN uncertainties or non-finite velocities) or 'drop' (remove those stations)
+    Returns [VelocityField, summary dictionary].
+    """
+    if merge_policy not in MERGE_POLICIES:
+        raise ValueError("Error! Merge policy %s not supported. Choose from %s" % (merge_policy, MERGE_POLICIES));
+    if invalid not in INVALID_POLICIES:
+        raise ValueError("Error! Invalid-station policy %s not supported. Choose from %s" % (invalid,
+                                                                                            INVALID_POLICIES));
+    myVelfield = velocity_io.as_velocity_field(myVelfield);
+    summary = {'input_stations': len(myVelfield), 'merge_distance_km': float(merge_distance),
+               'merge_policy': merge_policy, 'invalid_policy': invalid};
+
+    if coord_box is not None:
+        inside = ((coord_box[0] < myVelfield.elon) & (myVelfield.elon < coord_box[1]) &
+                  (coord_box[2] < myVelfield.nlat) & (myVelfield.nlat < coord_box[3]));
+        summary['outside_box'] = int(np.sum(~inside));
+        myVelfield = myVelfield.mask(inside);
+
+    checks = invalid_station_checks(myVelfield);
+    bad = np.zeros(len(myVelfield), dtype=bool);
+    for key in checks.keys():
+        summary[key] = int(np.sum(checks[key]));
+        bad |= checks[key];
+    summary['invalid_stations'] = [str(x) for x in myVelfield.name[bad]];
+    if np.any(bad):
+        if invalid == 'raise':
+            raise ValueError("Error! %d stations have zero or NaN uncertainties or non-finite velocities: %s" %
+                             (np.sum(bad), summary['invalid_stations'][0:10]));
+        myVelfield = myVelfield.mask(~bad);
+
+    labels = colocated_groups(myVelfield.elon, myVelfield.nlat, merge_distance);
+    counts = np.bincount(labels);
+    grouped = np.flatnonzero(counts[labels] > 1);
+    grouped = grouped[np.argsort(labels[grouped], kind='stable')];
+    boundaries = np.flatnonzero(np.diff(labels[grouped])) + 1;
+    summary['colocated_groups'] = [[str(x) for x in names] for names in
+                                   np.split(myVelfield.name[grouped], boundaries)] if len(grouped) else [];
+    summary['stations_in_colocated_groups'] = int(np.sum(counts[counts > 1]));
+    myVelfield = merge_groups(myVelfield, labels, merge_policy);
+    summary['output_stations'] = len(myVelfield);
+    print("Validation: %d stations in, %d out (%d outside the box, %d invalid, %d colocated groups merged by %s)" %
+          (summary['input_stations'], summary['output_stations'], summary.get('outside_box', 0), np.sum(bad),
+           len(summary['colocated_groups']), merge_policy));
+    return [myVelfield, summary];
+
+
+def invalid_station_checks(myVelfield):
+    # Boolean arrays of the stations that fail each check
+    sigmas = np.column_stack((myVelfield.se, myVelfield.sn, myVelfield.su));
+    velocities = np.column_stack((myVelfield.e, myVelfield.n, myVelfield.u));
+    return {'zero_uncertainty': np.any(sigmas == 0, axis=1),
+            'nan_uncertainty': np.any(np.isnan(sigmas), axis=1),
+            'nonfinite_velocity': ~np.all(np.isfinite(velocities), axis=1)};
+
+
+def colocated_groups(elon, nlat, merge_distance=0.0):
+    """
+    Label each station with its group of colocated stations, numbered in order of first appearance.
+    Stations closer than merge_distance (km) are linked, and groups are the connected components of those links,
+    so chains of nearby stations form one group. Distances are chords between points on a sphere.
+    """
+    nstations = len(elon);
+    if nstations == 0:
+        return np.zeros(0, dtype=int);
+    lon, lat = np.radians(elon), np.radians(nlat);
+    xyz = np.column_stack((np.cos(lat) * np.cos(lon), np.cos(lat) * np.sin(lon), np.sin(lat))) * MEAN_RADIUS;
+    if merge_distance <= 0:
+        _, labels = np.unique(xyz, axis=0, return_inverse=True);  # exact duplicates only; no need for scipy
+    else:
+        from scipy.spatial import cKDTree
+        from scipy.sparse import coo_matrix
+        from scipy.sparse.csgraph import connected_components
+        chord = 2 * MEAN_RADIUS * np.sin(min(merge_distance * 1000 / (2 * MEAN_RADIUS), np.pi / 2));
+        pairs = cKDTree(xyz).query_pairs(chord, output_type='ndarray');
+        links = coo_matrix((np.ones(len(pairs)), (pairs[:, 0], pairs[:, 1])), shape=(nstations, nstations));
+        _, labels = connected_components(links, directed=False);
+    labels = np.reshape(labels, -1);
+    _, first, labels = np.unique(labels, return_index=True, return_inverse=True);
+    order = np.argsort(np.argsort(first));  # renumber groups by their first station
+    return order[labels];
+
+
+def merge_groups(myVelfield, labels, merge_policy='weighted'):
+    """
+    One station per group. Positions are averaged as unit vectors, so groups across the antimeridian stay in place;
+    longitudes keep the convention (e.g. 0-360) of the group's first station, as does the name.
+    'mean': plain average of velocities, sigma = sqrt(sum sigma^2) / n
+    'weighted': inverse-variance average of each component, sigma = 1 / sqrt(sum 1/sigma^2)
+    'drop': keep only the station with the smallest horizontal uncertainty
+    """
+    ngroups = np.max(labels) + 1 if len(labels) else 0;
+    if ngroups == len(myVelfield):
+        return myVelfield;
+    if merge_policy == 'drop':
+        horizontal = myVelfield.se**2 + myVelfield.sn**2;
+        order = np.lexsort((np.arange(len(labels)), horizontal, labels));
+        keep = order[np.r_[True, labels[order][1:] != labels[order][:-1]]];
+        return myVelfield[keep];
+    counts = np.bincount(labels);
+    _, first = np.unique(labels, return_index=True);
+    columns = mean_positions(myVelfield.elon, myVelfield.nlat, labels, first);
+    for component, sigma in [('e', 'se'), ('n', 'sn'), ('u', 'su')]:
+        values, sigmas = getattr(myVelfield, component), getattr(myVelfield, sigma);
+        if merge_policy == 'mean':
+            columns[component] = np.bincount(labels, values) / counts;
+            columns[sigma] = np.sqrt(np.bincount(labels, sigmas**2)) / counts;
+        else:
+            weights = 1 / sigmas**2;
+            weight_sums = np.bincount(labels, weights);
+            columns[component] = np.bincount(labels, weights * values) / weight_sums;
+            columns[sigma] = 1 / np.sqrt(weight_sums);
+    return velocity_io.VelocityField(name=myVelfield.name[first], **columns);
+
+
+def mean_positions(elon, nlat, labels, first):
+    # Mean position of each group, from the sum of its unit vectors, with longitudes near the first station's
+    lon, lat = np.radians(elon), np.radians(nlat);
+    x = np.bincount(labels, np.cos(lat) * np.cos(lon));
+    y = np.bincount(labels, np.cos(lat) * np.sin(lon));
+    z = np.bincount(labels, np.sin(lat));
+    mean_lon = np.degrees(np.arctan2(y, x));
+    reference = np.asarray(elon, dtype=float)[first];
+    mean_lon = reference + np.mod(mean_lon - reference + 180, 360) - 180;
+    return {'elon': mean_lon, 'nlat': np.degrees(np.arctan2(z, np.hypot(x, y)))};
+
+
+def write_summary(summary, outdir):
+    filename = outdir + "/" + SUMMARY_FILENAME;
+    print("Writing validation summary to %s " % filename);
+    with open(filename, 'w') as ofile:
+        json.dump(summary, ofile, indent=2);
+    return;
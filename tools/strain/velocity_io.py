@@ -1,49 +1,245 @@
 
 import collections
+import io
+import itertools
+import os
+import numpy as np
 
 StationVel = collections.namedtuple('StationVel', ['elon', 'nlat', 'e', 'n', 'u', 'se', 'sn', 'su', 'name']);
 
 
-def read_stationvels(input_file):
+class VelocityField:
+    """
+    A velocity field stored by column: one contiguous float64 array per StationVel field, plus an array of names.
+    Columns are plain attributes (myVelfield.elon, myVelfield.e, ...), so reading them copies nothing.
+    Indexing with a slice, an index array or a boolean mask returns a smaller VelocityField;
+    indexing with an integer, or iterating, yields StationVel tuples for code that works one station at a time.
+    """
+    columns = ['elon', 'nlat', 'e', 'n', 'u', 'se', 'sn', 'su'];
+
+    def __init__(self, elon, nlat, e, n, u=None, se=None, sn=None, su=None, name=None):
+        nstations = len(elon);
+        values = {'elon': elon, 'nlat': nlat, 'e': e, 'n': n, 'u': u, 'se': se, 'sn': sn, 'su': su};
+        for column in self.columns:
+            if values[column] is None:
+                values[column] = np.zeros(nstations);
+            array = np.ascontiguousarray(values[column], dtype=float).reshape(-1);
+            if len(array) != nstations:
+                raise ValueError("Error! Column %s has %d values for %d stations" % (column, len(array), nstations));
+            setattr(self, column, array);
+        self.name = np.array([''] * nstations if name is None else name, dtype=str).reshape(-1);
+
+    @classmethod
+    def from_stationvels(cls, station_vels):
+        # Build from a list of StationVel (or any objects with the same attributes)
+        station_vels = list(station_vels);
+        columns = {column: [getattr(item, column) for item in station_vels] for column in cls.columns};
+        return cls(name=[item.name for item in station_vels], **columns);
+
+    def __len__(self):
+        return len(self.elon);
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i];
+
+    def __getitem__(self, key):
+        if isinstance(key, (int, np.integer)):
+            return StationVel(elon=self.elon[key], nlat=self.nlat[key], e=self.e[key], n=self.n[key], u=self.u[key],
+                              se=self.se[key], sn=self.sn[key], su=self.su[key], name=str(self.name[key]));
+        columns = {column: getattr(self, column)[key] for column in self.columns};
+        return VelocityField(name=self.name[key], **columns);
+
+    def __repr__(self):
+        return "VelocityField(%d stations)" % len(self);
+
+    def mask(self, keep):
+        # Stations where the boolean array keep is True
+        return self[np.asarray(keep, dtype=bool)];
+
+    def select_box(self, coord_box):
+        # Stations strictly inside coord_box = [W, E, S, N]
+        keep = ((coord_box[0] < self.elon) & (self.elon < coord_box[1]) &
+                (coord_box[2] < self.nlat) & (self.nlat < coord_box[3]));
+        return self.mask(keep);
+
+    def to_stationvels(self):
+        return list(self);
+
+
+def as_velocity_field(myVelfield):
+    # Accept either a VelocityField or a list of StationVel
+    if isinstance(myVelfield, VelocityField):
+        return myVelfield;
+    return VelocityField.from_stationvels(myVelfield);
+
+
+# Column layouts (0-based) of the community velocity formats, with velocities in m/yr
+# MIDAS: UNR MIDAS velocity files (e.g. midas.NA12.txt)
+# NAM08: PBO/NAM08 .vel files, after a 37-line header
+VELOCITY_FORMATS = {
+    'midas': {'columns': {'name': 0, 'elon': 25, 'nlat': 24, 'e': 8, 'n': 9, 'u': 10, 'se': 11, 'sn': 12, 'su': 13},
+              'extra_columns': {'start': 2, 'end': 3}, 'header_lines': 0, 'velocity_scale': 1000},
+    'nam08': {'columns': {'name': 0, 'elon': 8, 'nlat': 7, 'e': 20, 'n': 19, 'u': 21, 'se': 23, 'sn': 22, 'su': 24},
+              'extra_columns': {'rne': 25, 'rnu': 26, 'reu': 27, 'start': 28, 'end': 29}, 'header_lines': 37,
+              'velocity_scale': 1000}};
+
+
+def detect_velocity_format(filename):
+    # Guess the format from the file name, the way the tape scripts did
+    basename = os.path.basename(filename).lower();
+    if "midas" in basename or "unr" in basename:
+        return 'midas';
+    if "nam" in basename or "pbo" in basename or basename.endswith('.vel'):
+        return 'nam08';
+    return 'stationvels';
+
+
+def read_velocity_file(filename, file_format='auto', coord_box=None, use_cache=False):
+    """
+    Read any supported velocity file into a VelocityField, in mm/yr.
+    file_format: 'auto' (from the file name), 'stationvels', 'midas', or 'nam08'
+    coord_box: optional [W, E, S, N]; stations outside it are dropped while parsing
+    use_cache: sidecar cache, for the stationvels format
+    """
+    if file_format == 'auto':
+        file_format = detect_velocity_format(filename);
+    if file_format == 'stationvels':
+        myVelfield = read_stationvels(filename, use_cache=use_cache);
+        return myVelfield if coord_box is None else myVelfield.select_box(coord_box);
+    if file_format not in VELOCITY_FORMATS:
+        raise ValueError("Error! Velocity format %s not supported. Choose from %s" %
+                         (file_format, ['auto', 'stationvels'] + list(VELOCITY_FORMATS.keys())));
+    [myVelfield, _] = stream_velocity_columns(filename, file_format, coord_box);
+    return myVelfield;
+
+
+def read_midas(filename, coord_box=None):
+    return stream_velocity_columns(filename, 'midas', coord_box)[0];
+
+
+def read_nam08(filename, coord_box=None):
+    return stream_velocity_columns(filename, 'nam08', coord_box)[0];
+
+
+def stream_velocity_columns(filename, file_format, coord_box=None, chunk_lines=100000):
+    """
+    Parse a MIDAS or NAM08 file a chunk of lines at a time. Within each chunk, columns are parsed in bulk,
+    longitudes are wrapped to [-180, 180), velocities converted to mm/yr, and stations outside coord_box dropped,
+    so only the selected stations are ever kept.
+    Returns [VelocityField, dictionary of the format's extra columns (epochs, correlations) for the same stations].
+    """
+    spec = VELOCITY_FORMATS[file_format];
+    numeric = [name for name in spec['columns'].keys() if name != 'name'];
+    extras = list(spec['extra_columns'].keys());
+    usecols = [spec['columns'][name] for name in numeric] + [spec['extra_columns'][name] for name in extras];
+    print("Reading %s file %s " % (file_format, filename));
+    kept_values, kept_names = [], [];
+    ifile = open(filename, 'r');
+    list(itertools.islice(ifile, spec['header_lines']));  # skip the header
+    while True:
+        lines = list(itertools.islice(ifile, chunk_lines));
+        if len(lines) == 0:
+            break;
+        lines = [line for line in lines if line.strip() and line.lstrip()[0] != '#'];
+        if len(lines) == 0:
+            continue;
+        values = np.loadtxt(lines, usecols=usecols, ndmin=2, dtype=float);
+        names = np.loadtxt(lines, usecols=spec['columns']['name'], ndmin=1, dtype=str);
+        elon, nlat = values[:, numeric.index('elon')], values[:, numeric.index('nlat')];
+        elon[elon >= 180] -= 360;
+        if coord_box is not None:
+            keep = (coord_box[0] < elon) & (elon < coord_box[1]) & (coord_box[2] < nlat) & (nlat < coord_box[3]);
+            values, names = values[keep], names[keep];
+        kept_values.append(values);
+        kept_names.append(names);
+    ifile.close();
+    values = np.vstack(kept_values) if kept_values else np.zeros((0, len(usecols)));
+    names = np.concatenate(kept_names) if kept_names else np.array([], dtype=str);
+    columns = {name: values[:, i] for i, name in enumerate(numeric)};
+    for name in ['e', 'n', 'u', 'se', 'sn', 'su']:
+        columns[name] = columns[name] * spec['velocity_scale'];
+    extra_values = {name: values[:, len(numeric) + i] for i, name in enumerate(extras)};
+    print("%d stations read" % len(names));
+    return [VelocityField(name=names, **columns), extra_values];
+
+
+def read_stationvels(input_file, use_cache=False):
     # Reading a simple velocity format
     # Format: lon(deg) lat(deg) VE(mm) VN(mm) VU(mm) SE(mm) SN(mm) SU(mm) name(optional)
+    # Returns a VelocityField
+    # use_cache: load from (or create) a binary sidecar file next to input_file, valid while the file is unchanged
+    if use_cache:
+        myVelfield = read_velocity_cache(input_file);
+        if myVelfield is not None:
+            return myVelfield;
     print("Reading file %s " % input_file);
-    myVelfield = [];
     ifile = open(input_file, 'r');
-    for line in ifile:
-        if len(line.split()) == 0:
-            continue;
-        if line.split()[0] == "#":
-            continue;
-        temp = line.split();
-        lon = float(temp[0]);
-        lat = float(temp[1]);
-        VE = float(temp[2]);
-        VN = float(temp[3]);
-        VU = float(temp[4]);
-        SE = float(temp[5]);
-        SN = float(temp[6]);
-        SU = float(temp[7]);
-        if len(temp) > 8:
-            name = temp[8];
-        else:
-            name = '';
-        mystation = StationVel(elon=lon, nlat=lat, e=VE, n=VN, u=VU, se=SE, sn=SN, su=SU, name=name);
-        myVelfield.append(mystation);
+    text = ifile.read();
     ifile.close();
+    data = read_columns(text, range(8));
+    myVelfield = VelocityField(elon=data[:, 0], nlat=data[:, 1], e=data[:, 2], n=data[:, 3], u=data[:, 4],
+                               se=data[:, 5], sn=data[:, 6], su=data[:, 7], name=read_name_column(text, 8));
+    if use_cache:
+        write_velocity_cache(myVelfield, input_file);
     return myVelfield;
 
 
+def read_columns(text, columns):
+    # One bulk parse of the numeric columns of a whitespace-delimited text; '#' starts a comment
+    return np.loadtxt(io.StringIO(text), comments='#', usecols=columns, ndmin=2, dtype=float);
+
+
+def read_name_column(text, column):
+    # The optional name column, one entry per data row (as read by read_columns); rows without a name get ''
+    rows = [line.split('#')[0].split() for line in text.splitlines()];
+    return np.array([row[column] if len(row) > column else '' for row in rows if len(row) > 0], dtype=str);
+
+
+def velocity_cache_filename(input_file):
+    return input_file + '.cache.npz';
+
+
+def velocity_cache_key(input_file):
+    # The cache is valid for this path, size and modification time of the input file
+    stat = os.stat(input_file);
+    return np.array([os.path.abspath(input_file), str(stat.st_size), str(stat.st_mtime_ns)]);
+
+
+def read_velocity_cache(input_file):
+    # Returns the cached VelocityField, or None if there is no valid cache
+    cache_file = velocity_cache_filename(input_file);
+    if not os.path.isfile(cache_file):
+        return None;
+    with np.load(cache_file, allow_pickle=False) as cached:
+        if 'key' not in cached or not np.array_equal(cached['key'], velocity_cache_key(input_file)):
+            return None;
+        print("Reading file %s from cache %s " % (input_file, cache_file));
+        columns = {column: cached[column] for column in VelocityField.columns};
+        return VelocityField(name=cached['name'], **columns);
+
+
+def write_velocity_cache(myVelfield, input_file):
+    cache_file = velocity_cache_filename(input_file);
+    columns = {column: getattr(myVelfield, column) for column in VelocityField.columns};
+    try:
+        with open(cache_file, 'wb') as ofile:
+            np.savez(ofile, key=velocity_cache_key(input_file), name=myVelfield.name, **columns);
+    except OSError as e:
+        print("Warning! Could not write velocity cache %s: %s" % (cache_file, e));
+    return;
+
+
 def write_stationvels(myVelfield, output_file):
     # Writing a simple velocity format
     print("writing human-readable velfile in station-vel format, %s" % output_file);
+    v = as_velocity_field(myVelfield);
+    rows = zip(v.elon.tolist(), v.nlat.tolist(), v.e.tolist(), v.n.tolist(), v.u.tolist(), v.se.tolist(),
+               v.sn.tolist(), v.su.tolist(), v.name.tolist());
     ofile = open(output_file, 'w');
     ofile.write(
         "# Format: lon(deg) lat(deg) VE(mm) VN(mm) VU(mm) SE(mm) SN(mm) SU(mm) name(optional)\n");
-    for station_vel in myVelfield:
-        ofile.write("%f %f %f %f %f %f %f %f %s\n" % (
-            station_vel.elon, station_vel.nlat, station_vel.e, station_vel.n, station_vel.u, station_vel.se,
-            station_vel.sn, station_vel.su, station_vel.name));
+    ofile.write("".join(["%f %f %f %f %f %f %f %f %s\n" % row for row in rows]));
     ofile.close();
     return;
 
@@ -51,32 +247,18 @@ def write_stationvels(myVelfield, output_file):
 def read_horiz_vels(filename):
     # An even simpler format for 2D data, no error ellipses
     print("reading file %s " % filename);
-    myVelfield = [];
     ifile = open(filename, 'r');
-    for line in ifile:
-        if len(line.split()) == 0:
-            continue;
-        if line.split()[0] == "#":
-            continue;
-        temp = line.split();
-        lon = float(temp[0]);
-        lat = float(temp[1]);
-        VE = float(temp[2]);
-        VN = float(temp[3]);
-        VU = 0;
-        se = 0;
-        sn = 0;
-        su = 0;
-        mystation = StationVel(elon=lon, nlat=lat, e=VE, n=VN, u=VU, se=se, sn=sn, su=su, name='');
-        myVelfield.append(mystation);
+    text = ifile.read();
     ifile.close();
-    return myVelfield;
+    data = read_columns(text, range(4));
+    return VelocityField(elon=data[:, 0], nlat=data[:, 1], e=data[:, 2], n=data[:, 3]);
 
 
 def write_simple_gmt_format(myVelfield, outfile):
     # Write function for the even simpler format
+    v = as_velocity_field(myVelfield);
+    rows = zip(v.elon.tolist(), v.nlat.tolist(), v.e.tolist(), v.n.tolist(), v.se.tolist(), v.sn.tolist());
     ofile = open(outfile, 'w');
-    for item in myVelfield:
-        ofile.write("%f %f %f %f %f %f 0.0\n" % (item.elon, item.nlat, item.e, item.n, item.se, item.sn));
+    ofile.write("".join(["%f %f %f %f %f %f 0.0\n" % row for row in rows]));
     ofile.close();
     return;